@@ -0,0 +1,62 @@
+import argparse
+import datetime
+from sqlalchemy import select, insert, delete, inspect, func, and_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from create import Sales, ArchivedMonths, archive_table, refresh_sales_history, bump_write_versions, get_engine
+from query_data import current_month
+
+### Archiving closed months
+# Sales are only recorded for the current month (and the odd late one for the month before), so older months
+# are closed. archive_sales() moves the sales of closed months from the sales table to the archive table of
+# their year (see create.archive_table), a month per transaction, and adds their totals to ArchivedMonths.
+# The archive tables are in the same database file, so a month is moved atomically: in WAL mode, a commit
+# across attached database files isn't. Sales recorded later for an archived month are moved by the next run.
+# The newest sale always stays in the sales table, since SQLite gives the next sale the ID after the highest
+# one left in the table, which would otherwise be the ID of an archived sale.
+
+def archive_sales(before=None, bind=None):
+    """
+    Move the sales of every month before before (a month key, by default the current month) to the archive
+    tables. Returns a dictionary of each month archived to the number of its sales moved.
+    """
+    bind = get_engine() if bind is None else bind
+    before = current_month() if before is None else before
+    with bind.connect() as conn:
+        months = conn.execute(select(Sales.month_sold).where(Sales.month_sold < before).distinct().order_by(Sales.month_sold)).scalars().all()
+
+    columns = [column.name for column in Sales.__table__.columns]
+    archived = {}
+    for month in months:
+        table = archive_table(month // 100)
+        with bind.begin() as conn:
+            newest = conn.execute(select(func.max(Sales.sale_id))).scalar()
+            moving = and_(Sales.month_sold == month, Sales.sale_id < newest)
+            if conn.execute(select(Sales.sale_id).where(moving).limit(1)).first() is None:
+                continue
+            if not inspect(conn).has_table(table.name):
+                table.create(conn)
+                refresh_sales_history(conn)
+            conn.execute(insert(table).from_select(columns, select(*[Sales.__table__.c[name] for name in columns]).where(moving)))
+            # totals of the sales copied, read after the copy started the write transaction so no other sale comes in between
+            count, volume, commission = conn.execute(
+                select(func.count(Sales.sale_id), func.sum(Sales.price_sold), func.sum(Sales.commission)).where(moving)).first()
+            conn.execute(delete(Sales).where(moving))
+            insertion = sqlite_insert(ArchivedMonths).values(month=month, table_name=table.name, sale_count=count, sale_volume=volume or 0,
+                                                             commission_amount=commission or 0, archived_at=datetime.datetime.now())
+            conn.execute(insertion.on_conflict_do_update(index_elements=['month'], set_={
+                'sale_count': ArchivedMonths.sale_count + insertion.excluded.sale_count,
+                'sale_volume': ArchivedMonths.sale_volume + insertion.excluded.sale_volume,
+                'commission_amount': ArchivedMonths.commission_amount + insertion.excluded.commission_amount,
+                'archived_at': insertion.excluded.archived_at,
+            }))
+            bump_write_versions(conn, [Sales, ArchivedMonths], [month])
+        archived[month] = count
+    return archived
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Move the sales of closed months to the archive tables')
+    parser.add_argument('--before', type=int, help='archive the months before this month key (by default, the current month)')
+    args = parser.parse_args()
+    for month, count in archive_sales(args.before).items():
+        print('{}: {} sales archived'.format(month, count))
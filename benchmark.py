@@ -0,0 +1,409 @@
+import argparse
+import datetime
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+### Benchmarks
+# Run with: python3 benchmark.py startup
+#           python3 benchmark.py writers --threads 8 --sales 500
+#           python3 benchmark.py reports --scales tiny small
+#           python3 benchmark.py compare
+#           python3 benchmark.py parallel --scales small --concurrency 4
+#           python3 benchmark.py search --homes 1000000
+#           python3 benchmark.py leaderboards --scales small
+#           python3 benchmark.py profiles --agents 10 100 1000 10000
+
+
+### STARTUP: cold import time of each module
+# Every run imports the module in a fresh interpreter, so nothing is cached from an earlier import.
+# Importing a module should not touch the database, so these times stay flat as the database grows.
+STARTUP_MODULES = ['create', 'insert_data', 'query_data']
+
+IMPORT_TIMER = "import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)"
+
+def time_import(module):
+    output = subprocess.run([sys.executable, '-c', IMPORT_TIMER.format(module=module)],
+                            capture_output=True, text=True, check=True).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def benchmark_startup(repeat=5, modules=STARTUP_MODULES):
+    """
+    Time a cold import of each module repeat times. Returns a dictionary of module name to
+    (best, median) import time in seconds.
+    """
+    results = {}
+    for module in modules:
+        times = [time_import(module) for _ in range(repeat)]
+        results[module] = (min(times), statistics.median(times))
+    return results
+
+
+### WRITERS: concurrent sales writers against one SQLite file
+# Each thread records its sales one at a time through a shared SalesWriter, into a fresh database file.
+def benchmark_writers(threads=8, sales_per_thread=500, homes=1000):
+    """
+    Stress the sales writer with several threads. Returns the writer's stats, plus the number
+    of sales found in the database afterwards and how many were lost.
+    """
+    # imported here so the startup benchmark doesn't pay for them
+    from sqlalchemy import func
+    from create import Offices, Homes, Agents, Buyers, Sales, get_session, create_writer_engine
+    from sales_writer import SalesWriter
+
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_writer_engine('sqlite:///' + os.path.join(directory, 'real_estate.db'), pool_size=threads)
+        session = get_session(engine)
+        session.add(Offices(name='Benchmark Real Estate'))
+        session.add_all([Homes(address=str(number)) for number in range(homes)])
+        session.add_all([Agents(office_id=1, first_name=str(number)) for number in range(threads)])
+        session.add(Buyers(first_name='Benchmark'))
+        session.commit()
+
+        writer = SalesWriter(bind=engine)
+        def record(agent_id):
+            for number in range(sales_per_thread):
+                writer.record(number % homes + 1, agent_id, 1, 100000.00 + number)
+        workers = [threading.Thread(target=record, args=(agent_id,)) for agent_id in range(1, threads + 1)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        stats = writer.stats()
+        stats['in_database'] = session.query(func.count(Sales.sale_id)).scalar()
+        stats['lost'] = threads * sales_per_thread - stats['in_database']
+        session.close()
+        engine.dispose()
+    return stats
+
+
+### REPORTS: the five report queries against generated data
+# Each scale is generated once (see generate_data.py) into a database file in data_dir, which is reused by
+# later runs. Every report is timed for one month (read from the summary tables) and for a 30 day period
+# (read from the sales), keeping the best of repeat runs. Results are appended to a JSON lines file, tagged
+# with the git commit, so the compare command can show the times of each version side by side.
+RESULTS_FILE = 'benchmark_results.jsonl'
+
+# The generated sales run from 2020 to 2022, so these periods are always full
+REPORT_PERIODS = {'month': 202206, 'rolling_30_days': (30, datetime.date(2022, 6, 15))}
+
+def current_version():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def generated_engine(scale, data_dir, name=None):
+    """
+    An engine on the database generated at scale (named after it, or name for a Scale), generating it
+    first if data_dir doesn't have it yet.
+    """
+    from sqlalchemy import create_engine
+    from create import init_db
+    from generate_data import generate
+
+    path = os.path.join(data_dir, 'generated_{}.db'.format(name or scale))
+    exists = os.path.exists(path)
+    engine = create_engine('sqlite:///' + path)
+    if not exists:
+        init_db(engine)
+        try:
+            generate(scale, bind=engine)
+        except BaseException:
+            engine.dispose()
+            os.remove(path)
+            raise
+    return engine
+
+
+def time_query(query, repeat):
+    """
+    Run a query repeat times. Returns the best time in seconds and the peak memory (in bytes) allocated by a run.
+    """
+    times = []
+    tracemalloc.start()
+    for _ in range(repeat):
+        tracemalloc.reset_peak()
+        start = time.perf_counter()
+        query.all()
+        times.append(time.perf_counter() - start)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(times), peak
+
+
+def benchmark_reports(scales=('tiny',), repeat=3, data_dir=None):
+    """
+    Time each report query at each scale. Returns a list of results, one dictionary per scale, period and report,
+    with the best time, the number of sales in the period and the rate they were reported at, and the peak memory.
+    """
+    from sqlalchemy import func
+    from create import Sales, get_session
+    from query_data import report_queries, rolling_days, sales_in_period
+
+    version, timestamp = current_version(), datetime.datetime.now().isoformat(timespec='seconds')
+    periods = {name: rolling_days(*period) if isinstance(period, tuple) else period for name, period in REPORT_PERIODS.items()}
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for scale in scales:
+            engine = generated_engine(scale, data_dir or directory)
+            session = get_session(engine)
+            for period_name, period in periods.items():
+                rows = session.query(func.count(Sales.sale_id)).filter(sales_in_period(period)).scalar()
+                for report, query in report_queries(session, period).items():
+                    seconds, peak_memory = time_query(query, repeat)
+                    results.append({
+                        'version': version, 'timestamp': timestamp, 'scale': scale, 'period': period_name,
+                        'report': report, 'seconds': seconds, 'rows': rows,
+                        'rows_per_second': rows / seconds if seconds else 0.0, 'peak_memory': peak_memory,
+                    })
+            session.close()
+            engine.dispose()
+    return results
+
+
+def save_results(results, path=RESULTS_FILE):
+    with open(path, 'a') as file:
+        for result in results:
+            file.write(json.dumps(result) + '\n')
+
+
+def compare_results(path=RESULTS_FILE, versions=None):
+    """
+    Read saved results. Returns the versions compared (by default, every version in the file, oldest first) and a
+    dictionary of (scale, period, report) to a dictionary of version to its latest time in seconds.
+    """
+    with open(path) as file:
+        saved = [json.loads(line) for line in file if line.strip()]
+    if versions is None:
+        versions = list(dict.fromkeys(result['version'] for result in saved))
+    table = {}
+    for result in saved:
+        if result['version'] in versions:
+            table.setdefault((result['scale'], result['period'], result['report']), {})[result['version']] = result['seconds']
+    return versions, table
+
+
+### PARALLEL: the monthly report run sequentially and by the parallel report runner
+def benchmark_parallel(scales=('tiny',), concurrency=4, repeat=3, data_dir=None):
+    """
+    Time the monthly report (see report_runner.MONTHLY_REPORTS) at each scale and period, one report at a time
+    and concurrency at a time. Returns a list of (scale, period, sequential seconds, parallel seconds), best of repeat.
+    """
+    from create import create_reader_engine
+    from query_data import rolling_days
+    from report_runner import run_reports
+
+    periods = {name: rolling_days(*period) if isinstance(period, tuple) else period for name, period in REPORT_PERIODS.items()}
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for scale in scales:
+            generated = generated_engine(scale, data_dir or directory)
+            reader = create_reader_engine(str(generated.url), pool_size=concurrency)
+            for period_name, period in periods.items():
+                sequential = min(run_reports(period, concurrency=1, bind=reader).elapsed for _ in range(repeat))
+                parallel = min(run_reports(period, concurrency=concurrency, bind=reader).elapsed for _ in range(repeat))
+                results.append((scale, period_name, sequential, parallel))
+            reader.dispose()
+            generated.dispose()
+    return results
+
+
+### SEARCH: home search pages deep into the results, by keyset and by OFFSET
+# Every home is unsold in this dataset, so the broad search below matches a large share of them
+SEARCH_FILTERS = {'min_beds': 2, 'min_price': 200000, 'max_price': 800000}
+SEARCH_DEPTHS = (1, 10, 100, 1000, 5000)
+
+def benchmark_search(homes=200000, page_size=20, depths=SEARCH_DEPTHS, data_dir=None):
+    """
+    Page through a search of generated homes (with no sales), timing the pages at each depth found by keyset
+    pagination and by OFFSET. Returns a list of (page, keyset seconds, offset seconds), for the depths reached.
+    """
+    from sqlalchemy import create_engine
+    from create import init_db, get_session
+    from generate_data import generate, Scale
+    from search_homes import search_homes, search_query
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(data_dir or directory, 'search_{}.db'.format(homes))
+        exists = os.path.exists(path)
+        engine = create_engine('sqlite:///' + path)
+        if not exists:
+            init_db(engine)
+            generate(Scale(offices=10, agents=100, sellers=1000, buyers=10, homes=homes, sales=0), bind=engine)
+        session = get_session(engine)
+        after = None
+        for page in range(1, max(depths) + 1):
+            start = time.perf_counter()
+            homes_page, after = search_homes(session, **SEARCH_FILTERS, after=after, page_size=page_size)
+            keyset = time.perf_counter() - start
+            session.expunge_all()
+            if page in depths:
+                start = time.perf_counter()
+                search_query(session, **SEARCH_FILTERS).offset((page - 1) * page_size).limit(page_size).all()
+                results.append((page, keyset, time.perf_counter() - start))
+                session.expunge_all()
+            if after is None:
+                break
+        session.close()
+        engine.dispose()
+    return results
+
+
+### LEADERBOARDS: the top agents and offices of a month, queried and from memory
+def benchmark_leaderboards(scales=('tiny',), repeat=1000, data_dir=None):
+    """
+    Time the top agents and offices of a month, read with the report queries and from Leaderboards held in
+    memory. Returns a list of (scale, report, query seconds, leaderboard seconds), best of repeat.
+    """
+    from create import get_session
+    from query_data import top_agents, top_office_sale_counts
+    from leaderboards import Leaderboards
+
+    month = REPORT_PERIODS['month']
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for scale in scales:
+            engine = generated_engine(scale, data_dir or directory)
+            session = get_session(engine)
+            leaderboards = Leaderboards(bind=engine, month=month)
+            for report, query, held in [('top_agents', lambda: top_agents(session, month).all(), leaderboards.top_agents),
+                                        ('top_office_sale_counts', lambda: top_office_sale_counts(session, month).all(), leaderboards.top_offices)]:
+                timings = []
+                for run in (query, held):
+                    best = None
+                    for _ in range(repeat):
+                        start = time.perf_counter()
+                        run()
+                        elapsed = time.perf_counter() - start
+                        best = elapsed if best is None else min(best, elapsed)
+                    timings.append(best)
+                results.append((scale, report) + tuple(timings))
+            session.close()
+            engine.dispose()
+    return results
+
+
+### PROFILES: rendering every agent of an office, with their listings and sales, lazily and batched
+PROFILE_SIZES = (10, 100, 1000, 10000)
+
+def benchmark_profiles(sizes=PROFILE_SIZES, data_dir=None):
+    """
+    Render the profile of an office of each size (in agents, with three homes listed and one sold per agent), loading
+    its relationships lazily and through profiles.office_profile(). Returns a list of (agents, lazy seconds,
+    lazy queries, batched seconds, batched queries).
+    """
+    from create import Offices, get_session
+    from generate_data import Scale
+    from instrumentation import Instrumentation
+    from profiles import office_profile, profile_dict
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for agents in sizes:
+            scale = Scale(offices=1, agents=agents, sellers=max(agents // 10, 1), buyers=max(agents // 10, 1), homes=3 * agents, sales=agents)
+            engine = generated_engine(scale, data_dir or directory, 'office_{}_agents'.format(agents))
+            instrumentation = Instrumentation(slow_threshold=60, explain_full_scans=False).attach(engine)
+            timings = []
+            for load in (lambda session: session.query(Offices).get(1), lambda session: office_profile(session, 1)):
+                session = get_session(engine)
+                instrumentation.reset()
+                start = time.perf_counter()
+                [profile_dict(agent) for agent in load(session).agents]
+                timings += [time.perf_counter() - start, sum(stats.count for stats in instrumentation.statements.values())]
+                session.close()
+            instrumentation.detach()
+            engine.dispose()
+            results.append((agents,) + tuple(timings))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks for the real estate database')
+    commands = parser.add_subparsers(dest='command', required=True)
+    startup = commands.add_parser('startup', help='cold import time of each module')
+    startup.add_argument('--repeat', type=int, default=5)
+    writers = commands.add_parser('writers', help='concurrent sales writers against one database file')
+    writers.add_argument('--threads', type=int, default=8)
+    writers.add_argument('--sales', type=int, default=500, help='sales recorded by each thread')
+    reports = commands.add_parser('reports', help='the report queries against generated data')
+    reports.add_argument('--scales', nargs='+', default=['tiny'], help='tiny, small, medium or large')
+    reports.add_argument('--repeat', type=int, default=3)
+    reports.add_argument('--data-dir', help='keep the generated databases here, to reuse them in later runs')
+    reports.add_argument('--results', default=RESULTS_FILE)
+    parallel = commands.add_parser('parallel', help='the monthly report run sequentially and in parallel')
+    parallel.add_argument('--scales', nargs='+', default=['tiny'], help='tiny, small, medium or large')
+    parallel.add_argument('--concurrency', type=int, default=4)
+    parallel.add_argument('--repeat', type=int, default=3)
+    parallel.add_argument('--data-dir', help='keep the generated databases here, to reuse them in later runs')
+    search = commands.add_parser('search', help='home search pages deep into the results, by keyset and by OFFSET')
+    search.add_argument('--homes', type=int, default=200000)
+    search.add_argument('--page-size', type=int, default=20)
+    search.add_argument('--data-dir', help='keep the generated database here, to reuse it in later runs')
+    leaderboards = commands.add_parser('leaderboards', help='the top agents and offices of a month, queried and from memory')
+    leaderboards.add_argument('--scales', nargs='+', default=['tiny'], help='tiny, small, medium or large')
+    leaderboards.add_argument('--repeat', type=int, default=1000)
+    leaderboards.add_argument('--data-dir', help='keep the generated databases here, to reuse them in later runs')
+    profiles = commands.add_parser('profiles', help='office profiles loaded lazily and in batches')
+    profiles.add_argument('--agents', nargs='+', type=int, default=list(PROFILE_SIZES), help='agents in each office')
+    profiles.add_argument('--data-dir', help='keep the generated databases here, to reuse them in later runs')
+    compare = commands.add_parser('compare', help='report query times of each version saved in the results')
+    compare.add_argument('versions', nargs='*', help='git commits to compare (by default, all of them)')
+    compare.add_argument('--results', default=RESULTS_FILE)
+    args = parser.parse_args()
+
+    if args.command == 'startup':
+        print('Cold import time (best / median of {} runs):'.format(args.repeat))
+        for module, (best, median) in benchmark_startup(args.repeat).items():
+            print('{:<12} {:8.1f} ms {:8.1f} ms'.format(module, best * 1000, median * 1000))
+
+    elif args.command == 'writers':
+        stats = benchmark_writers(args.threads, args.sales)
+        print('{} threads x {} sales: {recorded} recorded in {elapsed:.2f} s ({sales_per_second:.0f} sales/s), '
+              '{retries} retries, {failed} failed, {lost} lost'.format(args.threads, args.sales, **stats))
+
+    elif args.command == 'reports':
+        results = benchmark_reports(args.scales, args.repeat, args.data_dir)
+        save_results(results, args.results)
+        print('{:<8} {:<16} {:<24} {:>10} {:>10} {:>14} {:>12}'.format('scale', 'period', 'report', 'ms', 'sales', 'sales/s', 'peak KiB'))
+        for result in results:
+            print('{scale:<8} {period:<16} {report:<24} {:10.2f} {rows:>10} {rows_per_second:14.0f} {:12.1f}'.format(
+                result['seconds'] * 1000, result['peak_memory'] / 1024, **result))
+        print('Saved to', args.results)
+
+    elif args.command == 'compare':
+        versions, table = compare_results(args.results, args.versions or None)
+        print('{:<8} {:<16} {:<24}'.format('scale', 'period', 'report') + ''.join(' {:>10}'.format(version) for version in versions) + '  (ms)')
+        for (scale, period, report), times in sorted(table.items()):
+            print('{:<8} {:<16} {:<24}'.format(scale, period, report) + ''.join(
+                ' {:>10}'.format('{:.2f}'.format(times[version] * 1000) if version in times else '-') for version in versions))
+
+    elif args.command == 'parallel':
+        print('{:<8} {:<16} {:>14} {:>14} {:>8}'.format('scale', 'period', 'sequential ms', 'parallel ms', 'speedup'))
+        for scale, period, sequential, parallel in benchmark_parallel(args.scales, args.concurrency, args.repeat, args.data_dir):
+            print('{:<8} {:<16} {:14.2f} {:14.2f} {:7.2f}x'.format(scale, period, sequential * 1000, parallel * 1000, sequential / parallel))
+
+    elif args.command == 'search':
+        print('{:>6} {:>12} {:>12}'.format('page', 'keyset ms', 'offset ms'))
+        for page, keyset, offset in benchmark_search(args.homes, args.page_size, data_dir=args.data_dir):
+            print('{:6} {:12.2f} {:12.2f}'.format(page, keyset * 1000, offset * 1000))
+
+    elif args.command == 'leaderboards':
+        print('{:<8} {:<24} {:>10} {:>16}'.format('scale', 'report', 'query ms', 'leaderboard us'))
+        for scale, report, query, held in benchmark_leaderboards(args.scales, args.repeat, args.data_dir):
+            print('{:<8} {:<24} {:10.3f} {:16.2f}'.format(scale, report, query * 1000, held * 1000000))
+
+    elif args.command == 'profiles':
+        print('{:>8} {:>10} {:>12} {:>12} {:>14}'.format('agents', 'lazy ms', 'lazy queries', 'batched ms', 'batched queries'))
+        for agents, lazy, lazy_queries, batched, batched_queries in benchmark_profiles(args.agents, args.data_dir):
+            print('{:8} {:10.1f} {:12} {:12.1f} {:14}'.format(agents, lazy * 1000, lazy_queries, batched * 1000, batched_queries))
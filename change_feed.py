@@ -0,0 +1,85 @@
+from sqlalchemy import select, delete, func
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from create import SaleChanges, ChangeConsumers, get_engine
+
+### Sales change feed consumers
+# Downstream processes (commission payouts, dashboards, exports) read the sales change log (create.SaleChanges)
+# from their own saved position, a batch at a time, so each run only reads the changes since the last one: a
+# range scan of the log's primary key. Positions are saved in the database once a batch has been processed,
+# so a consumer which crashes mid-batch reads that batch again when it restarts (at-least-once delivery).
+# Changes every consumer has processed can be compacted away, a segment at a time.
+
+class ChangeFeedConsumer:
+    """
+    Reads the change feed for one named consumer, from the position it saved last (or from the start of the
+    feed, for a new consumer).
+    """
+    def __init__(self, name, bind=None, batch_size=1000):
+        self.name = name
+        self.bind = get_engine() if bind is None else bind
+        self.batch_size = batch_size
+        with self.bind.connect() as conn:
+            self.position = conn.execute(select(ChangeConsumers.position).where(ChangeConsumers.name == name)).scalar() or 0
+
+    def __repr__(self):
+        return "<ChangeFeedConsumer(Name ={}, Position ={})>".format(self.name, self.position)
+
+    def poll(self):
+        """
+        The next batch of changes after the consumer's position, oldest first (an empty list when it is up to date).
+        The position doesn't move until the batch is acknowledged.
+        """
+        with self.bind.connect() as conn:
+            return conn.execute(
+                select(SaleChanges).
+                where(SaleChanges.change_id > self.position).
+                order_by(SaleChanges.change_id).
+                limit(self.batch_size)
+            ).all()
+
+    def acknowledge(self, changes):
+        """
+        Save the position after a batch of changes, once they have been processed.
+        """
+        if not changes:
+            return
+        position = changes[-1].change_id
+        with self.bind.begin() as conn:
+            insertion = sqlite_insert(ChangeConsumers).values(name=self.name, position=position)
+            conn.execute(insertion.on_conflict_do_update(index_elements=['name'], set_={'position': position}))
+        self.position = position
+
+    def consume(self, handler):
+        """
+        Call handler with each batch of new changes, acknowledging each after handler returns, until the
+        consumer is up to date. Returns the number of changes handled.
+        """
+        handled = 0
+        changes = self.poll()
+        while changes:
+            handler(changes)
+            self.acknowledge(changes)
+            handled += len(changes)
+            changes = self.poll()
+        return handled
+
+
+def compact_changes(bind=None, segment_size=10000):
+    """
+    Delete the changes every consumer has processed, a segment of segment_size changes per transaction, so
+    the write lock is only held briefly. Nothing is deleted until at least one consumer has saved a position.
+    Returns the number of changes deleted.
+    """
+    bind = get_engine() if bind is None else bind
+    with bind.connect() as conn:
+        processed = conn.execute(select(func.min(ChangeConsumers.position))).scalar()
+        oldest = conn.execute(select(func.min(SaleChanges.change_id))).scalar()
+    if processed is None or oldest is None:
+        return 0
+
+    deleted = 0
+    for segment_start in range(oldest, processed + 1, segment_size):
+        segment_end = min(segment_start + segment_size - 1, processed)
+        with bind.begin() as conn:
+            deleted += conn.execute(delete(SaleChanges).where(SaleChanges.change_id.between(segment_start, segment_end))).rowcount
+    return deleted
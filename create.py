@@ -1,16 +1,155 @@
 import sqlalchemy
 import datetime
-from sqlalchemy import create_engine, Column, Text, Integer, ForeignKey, DateTime, Float, Boolean
+import math
+import os
+from sqlalchemy import create_engine, event, inspect, text, select, insert, update, delete, func, case, and_, literal, union_all, MetaData, Table, Column, Text, Integer, ForeignKey, DateTime, Float, Boolean, Index
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, sessionmaker, Session as OrmSession
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.pool import QueuePool
 
-# Connect to database, with echo=True to follow requests
-engine = create_engine('sqlite:///real_estate.db', echo=True)
-engine.connect()
+### Database configuration
+# The engine is only created (and the database file opened) when it is first needed, not when this module 
+# is imported. It is configured from the environment, or by calling configure() before first use:
+#   REAL_ESTATE_DB_URL   database to connect to (sqlite:///real_estate.db by default)
+#   REAL_ESTATE_DB_ECHO  set to 1 to log every SQL statement, to follow requests
+#   REAL_ESTATE_DB_SLOW_QUERY_MS  set to instrument the engine (see instrumentation.py), logging
+#                        statements slower than this many milliseconds
+DEFAULT_DATABASE_URL = 'sqlite:///real_estate.db'
+_config = {}
+_engine = None
+_instrumentation = None
+
+def configure(url=None, echo=None):
+    """
+    Set the database URL and SQL logging used by get_engine(), replacing any engine already created. 
+    """
+    global _engine, _instrumentation
+    if url is not None:
+        _config['url'] = url
+    if echo is not None:
+        _config['echo'] = echo
+    if _engine is not None:
+        _engine.dispose()
+        _engine = None
+        _instrumentation = None
+
+
+def get_engine():
+    """
+    Return the shared engine, creating it and bringing the database schema up to date on first use. 
+    """
+    global _engine, _instrumentation
+    if _engine is None:
+        engine = create_engine(database_url(), echo=_echo())
+        threshold = os.environ.get('REAL_ESTATE_DB_SLOW_QUERY_MS')
+        if threshold:
+            from instrumentation import Instrumentation
+            _instrumentation = Instrumentation(slow_threshold=float(threshold) / 1000).attach(engine)
+        init_db(engine)
+        _engine = engine
+    return _engine
+
+
+def get_instrumentation():
+    """
+    The instrumentation attached to the shared engine, or None unless REAL_ESTATE_DB_SLOW_QUERY_MS is set. 
+    """
+    get_engine()
+    return _instrumentation
+
+
+def database_url():
+    return _config.get('url') or os.environ.get('REAL_ESTATE_DB_URL', DEFAULT_DATABASE_URL)
+
+def _echo():
+    return _config.get('echo', os.environ.get('REAL_ESTATE_DB_ECHO', '') not in ('', '0'))
+
+
+### Concurrent writers
+# Several threads or processes writing sales to the same SQLite file need WAL journaling (so readers and 
+# the writer do not block each other), a busy timeout (so a writer waits for the write lock instead of 
+# failing straight away with "database is locked"), and transactions which take the write lock as soon as 
+# they begin, so two transactions never both read and then both try to upgrade to writing.
+SQLITE_WRITER_PRAGMAS = ['PRAGMA journal_mode=WAL', 'PRAGMA synchronous=NORMAL']
+
+def create_writer_engine(url=None, pool_size=4, busy_timeout=5.0):
+    """
+    Create an engine for writing concurrently to the configured database (or url): WAL journaling, 
+    a busy timeout in seconds, BEGIN IMMEDIATE transactions, and a pool of at most pool_size 
+    connections shared by all threads. The schema is brought up to date first, as for get_engine(). 
+    """
+    engine = create_engine(url or database_url(), echo=_echo(), poolclass=QueuePool, pool_size=pool_size, max_overflow=0,
+                           connect_args={'timeout': busy_timeout, 'check_same_thread': False})
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None # transactions are started by the begin listener below instead
+        cursor = dbapi_connection.cursor()
+        for pragma in SQLITE_WRITER_PRAGMAS:
+            cursor.execute(pragma)
+        cursor.close()
+
+    @event.listens_for(engine, 'begin')
+    def begin_immediate(conn):
+        conn.exec_driver_sql('BEGIN IMMEDIATE')
+
+    init_db(engine)
+    return engine
+
+
+def create_reader_engine(url=None, pool_size=4, busy_timeout=5.0):
+    """
+    Create an engine for reading the configured database (or url) from several threads at once: a pool 
+    of at most pool_size connections, each read-only (PRAGMA query_only), so reports can't write by mistake. 
+    The database must be a file, since every connection to an in-memory database gets an empty one. 
+    """
+    url = url or database_url()
+    engine = create_engine(url, echo=_echo(), poolclass=QueuePool, pool_size=pool_size, max_overflow=0,
+                           connect_args={'timeout': busy_timeout, 'check_same_thread': False})
+    if engine.url.database in (None, '', ':memory:'):
+        engine.dispose()
+        raise ValueError('Reader engines need a database file, not {}'.format(url))
+
+    @event.listens_for(engine, 'connect')
+    def set_query_only(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA query_only=ON')
+        cursor.close()
+
+    return engine
+
+
+# Sessions are bound to the shared engine when they are opened, unless given another engine
+Session = sessionmaker()
+
+def get_session(bind=None):
+    return Session(bind=get_engine() if bind is None else bind)
+
+
+# `create.engine` still works, and creates the engine on first access
+def __getattr__(name):
+    if name == 'engine':
+        return get_engine()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
 # provide the base for declarative method to create tables
 Base = declarative_base()
 
+### Period keys
+# A month is keyed as year * 100 + month (2022-01 is 202201 and 2021-12 is 202112), so keys sort in
+# time order and a range of months, like a quarter or a year, can be read with an index range scan
+def month_key(day):
+    return day.year * 100 + day.month
+
+# Column default for a month key, taken from the row's date column (or today, if the row has no date)
+def month_key_default(date_column):
+    def default(context):
+        day = context.get_current_parameters().get(date_column)
+        return month_key(day or datetime.date.today())
+    return default
+
 ### Offices table, this is mostly to help query office-specific information, which is commonly done
 class Offices(Base):
     __tablename__ = 'offices'
@@ -33,7 +172,7 @@ class Homes(Base):
     zipcode = Column(Text)
     price_listed = Column(Float) # allow for decimals for a cost 
     date_listed = Column(DateTime)
-    month_listed = Column(Integer)
+    month_listed = Column(Integer, default=month_key_default('date_listed'))
     sold = Column(Boolean, default=False) 
     # Homes will also be included in listing and sale entries
     listings = relationship("Listings") 
@@ -80,6 +219,8 @@ class Listings(Base):
     home_id = Column(Integer, ForeignKey('homes.home_id'))
     agent_id = Column(Integer, ForeignKey('agents.agent_id'))
     seller_id = Column(Integer, ForeignKey('sellers.seller_id'))
+    # The home listed, for loading listings together with their homes (see profiles.py)
+    home = relationship("Homes", viewonly=True)
 
     
 ### Buyers (individuals purchasing property) table
@@ -95,19 +236,39 @@ class Buyers(Base):
         return "<Buyers(ID ={}, First Name ={}, Last Name ={})".format(self.buyer_id, self.first_name, self.last_name)
 
 
-# Function used to calculate the commission, based off the price a property is sold for
-def calculate_commission(context):
-    price_sold = context.get_current_parameters()["price_sold"]
-    if price_sold < 100000.00:
-        return price_sold*0.1
-    if price_sold <= 200000.00:
-        return price_sold*0.075
-    if price_sold <= 500000.00:
-        return price_sold*0.06
-    if price_sold <= 1000000.00:
-        return price_sold*0.05
-    else:
-        return price_sold*0.04
+### Commission tiers: the commission rate of a sale depends on the price it is sold for.
+# Tiers are stored as data so they can change over time: each set of tiers applies to the sales made from its 
+# effective_from date until the next set takes effect. Within a set, a sale falls in the tier with the lowest 
+# max_price it does not exceed (max_price itself is included in the tier when max_inclusive), and the tier 
+# without a max_price covers everything above.
+class CommissionTiers(Base):
+    __tablename__ = 'commission_tiers'
+    tier_id = Column(Integer, primary_key = True)
+    effective_from = Column(DateTime)
+    max_price = Column(Float)
+    max_inclusive = Column(Boolean, default=True)
+    rate = Column(Float)
+
+    def __repr__(self):
+        return "<CommissionTiers(Effective From ={}, Max Price ={}, Rate ={})".format(self.effective_from, self.max_price, self.rate)
+
+# The tiers every database starts with: 10% under 100k, 7.5% up to 200k, 6% up to 500k, 5% up to 1M and 4% above
+DEFAULT_TIERS_EFFECTIVE_FROM = datetime.datetime(1900, 1, 1)
+DEFAULT_COMMISSION_TIERS = [
+    (100000.00, False, 0.1),
+    (200000.00, True, 0.075),
+    (500000.00, True, 0.06),
+    (1000000.00, True, 0.05),
+    (None, True, 0.04),
+]
+
+def _insert_default_tiers(table, conn, **kw):
+    conn.execute(table.insert(), [
+        {'effective_from': DEFAULT_TIERS_EFFECTIVE_FROM, 'max_price': max_price, 'max_inclusive': max_inclusive, 'rate': rate}
+        for max_price, max_inclusive, rate in DEFAULT_COMMISSION_TIERS
+    ])
+
+event.listen(CommissionTiers.__table__, 'after_create', _insert_default_tiers)
 
 ### Sales information recording sale information and linking to the property, buyer & agent involved
 class Sales(Base):
@@ -118,22 +279,696 @@ class Sales(Base):
     buyer_id = Column(Integer, ForeignKey('buyers.buyer_id'))
     price_sold = Column(Float)
     # The timing of a sale is assumed to be when we are entering the data entry
-    date_sold = Column(DateTime, default=datetime.date.today())
-    month_sold = Column(Integer, default=int(str(datetime.date.today().year) + str(datetime.date.today().month)))
-    commission = Column(Float, default=calculate_commission) # use function specified above when sale entry is made
+    date_sold = Column(DateTime, default=datetime.date.today)
+    month_sold = Column(Integer, default=month_key_default('date_sold'))
+    commission = Column(Float) # set from the commission tiers by price_sales() when the sale is recorded
+    days_on_market = Column(Float) # days from the home's listing to the sale, also set by price_sales()
+    # The home sold, for loading sales together with their homes (see profiles.py)
+    home = relationship("Homes", viewonly=True)
 
     def __repr__(self):
         return "<Sales(ID ={}, Price Sold ={}, Commission ={})".format(self.sale_id, self.price_sold, self.commission)
 
 
-# Commission table used for querying in question 4 
+# Newly recorded sales, for pricing them and adding them to the summary tables and change feed:
+# every sale with an ID of at least first_sale_id, or the sales with the given IDs
+def _new_sales(first_sale_id=None, sale_ids=None):
+    return Sales.sale_id.in_(list(sale_ids)) if first_sale_id is None else Sales.sale_id >= first_sale_id
+
+
+# Commission ledger used for querying in question 3: the commission each agent has earned in a month.
+# Rows are kept up to date as sales are recorded (see record_sale_summaries below), rather than rebuilt for every report
 class Commission(Base):
     __tablename__ = 'commission'
-    commission_id = Column(Integer, primary_key = True)
-    first_name = Column(Text)
-    last_name = Column(Text)
-    email = Column(Text)
-    commission_amount = Column(Float)
+    agent_id = Column(Integer, ForeignKey('agents.agent_id'), primary_key = True)
+    month = Column(Integer, primary_key = True) # same format as Sales.month_sold
+    commission_amount = Column(Float, default=0)
+    sale_count = Column(Integer, default=0)
+
+    def __repr__(self):
+        return "<Commission(Agent ={}, Month ={}, Commission ={})".format(self.agent_id, self.month, self.commission_amount)
+
+# Monthly leaderboard tables used for querying in questions 1 & 2: the number and total price of
+# the sales made by each office or agent in a month, kept up to date as sales are recorded.
+# Sales count towards the office the agent belonged to when the sale was recorded.
+class OfficeMonthlySales(Base):
+    __tablename__ = 'office_monthly_sales'
+    office_id = Column(Integer, ForeignKey('offices.office_id'), primary_key = True)
+    month = Column(Integer, primary_key = True) # same format as Sales.month_sold
+    sale_count = Column(Integer, default=0)
+    sale_volume = Column(Float, default=0)
+
+    def __repr__(self):
+        return "<OfficeMonthlySales(Office ={}, Month ={}, Sales ={}, Volume ={})".format(self.office_id, self.month, self.sale_count, self.sale_volume)
+
+
+class AgentMonthlySales(Base):
+    __tablename__ = 'agent_monthly_sales'
+    agent_id = Column(Integer, ForeignKey('agents.agent_id'), primary_key = True)
+    month = Column(Integer, primary_key = True) # same format as Sales.month_sold
+    sale_count = Column(Integer, default=0)
+    sale_volume = Column(Float, default=0)
+
+    def __repr__(self):
+        return "<AgentMonthlySales(Agent ={}, Month ={}, Sales ={}, Volume ={})".format(self.agent_id, self.month, self.sale_count, self.sale_volume)
+
+
+### Write versions
+# A counter per table, bumped in the same transaction as each write to it, so a cache of report results
+# (see report_cache.py) can tell whether the tables a report reads have changed since it was cached, even
+# when the writes come from another process. Writes to the sales of months before the current one also bump
+# the 'history' version: reports of past months only depend on it, since sales are normally recorded in
+# the current month, so their cached results stay valid as new sales come in.
+HISTORY_VERSION = 'history'
+
+class WriteVersions(Base):
+    __tablename__ = 'write_versions'
+    table_name = Column(Text, primary_key = True) # a table name, or HISTORY_VERSION
+    version = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return "<WriteVersions(Table ={}, Version ={})".format(self.table_name, self.version)
+
+
+def bump_write_versions(conn, tables, months=(), history=False):
+    """
+    Bump the write version of each table, as part of the caller's transaction. The history version 
+    is bumped too if history is true or any of the months written to (as month keys) is already over. 
+    """
+    names = sorted({table.__tablename__ for table in tables})
+    current = month_key(datetime.date.today())
+    if history or any(month is not None and month < current for month in months):
+        names.append(HISTORY_VERSION)
+    if not names:
+        return
+    insertion = sqlite_insert(WriteVersions).values([{'table_name': name, 'version': 1} for name in names])
+    conn.execute(insertion.on_conflict_do_update(index_elements=['table_name'], set_={'version': WriteVersions.version + 1}))
+
+
+def write_versions(conn):
+    """
+    The current write version of every table written to so far, by table name.
+    """
+    return dict(conn.execute(select(WriteVersions.table_name, WriteVersions.version)).all())
+
+
+# Rows changed through any session bump their table's version when they are flushed. Edits to the
+# tables reports read names from (offices, agents, homes) don't bump the history version.
+@event.listens_for(OrmSession, 'after_flush')
+def _bump_flushed_tables(session, flush_context):
+    tables = {type(row) for row in list(session.new) + list(session.dirty) + list(session.deleted)} - {WriteVersions}
+    if tables:
+        months = [row.month_sold for row in session.new if isinstance(row, Sales)]
+        bump_write_versions(session.connection(), tables, months)
+
+
+### Sales change feed
+# An append-only log of every sale recorded and every home whose sold flag flips, written in the same transaction
+# as the change itself, so downstream consumers (see change_feed.py) can read just the changes since they last
+# looked, by change_id, instead of re-reading the sales table. Within one transaction, the homes flipping are
+# logged before the sales that sold them. change_id is never reused, even after old changes are compacted away.
+CHANGE_SALE = 'sale'
+CHANGE_HOME_SOLD = 'home_sold'
+CHANGE_HOME_UNSOLD = 'home_unsold'
+
+class SaleChanges(Base):
+    __tablename__ = 'sale_changes'
+    __table_args__ = {'sqlite_autoincrement': True}
+    change_id = Column(Integer, primary_key = True)
+    kind = Column(Text, nullable=False) # one of the CHANGE_ kinds above
+    home_id = Column(Integer)
+    # the sale's details, for sale changes
+    sale_id = Column(Integer)
+    agent_id = Column(Integer)
+    buyer_id = Column(Integer)
+    price_sold = Column(Float)
+    commission = Column(Float)
+    date_sold = Column(DateTime)
+    month_sold = Column(Integer)
+
+    def __repr__(self):
+        return "<SaleChanges(ID ={}, Kind ={}, Home ={}, Sale ={})".format(self.change_id, self.kind, self.home_id, self.sale_id)
+
+# The saved position of each consumer of the change feed: the last change_id it has processed
+class ChangeConsumers(Base):
+    __tablename__ = 'change_consumers'
+    name = Column(Text, primary_key = True)
+    position = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return "<ChangeConsumers(Name ={}, Position ={})".format(self.name, self.position)
+
+
+def record_sale_changes(conn, first_sale_id=None, sale_ids=None):
+    """
+    Log newly recorded sales (every sale with an ID of at least first_sale_id, or the sales with the 
+    given IDs) to the change feed, as part of the caller's transaction, once their commission has been priced. 
+    """
+    columns = ['home_id', 'sale_id', 'agent_id', 'buyer_id', 'price_sold', 'commission', 'date_sold', 'month_sold']
+    conn.execute(insert(SaleChanges).from_select(
+        ['kind'] + columns,
+        select(literal(CHANGE_SALE), *[getattr(Sales, column) for column in columns]).
+        where(_new_sales(first_sale_id, sale_ids)).order_by(Sales.sale_id)
+    ))
+
+
+def record_sold_flips(conn, home_ids, sold=True):
+    """
+    Log homes whose sold flag was flipped (to sold, or back) to the change feed, as part of the caller's transaction. 
+    """
+    kind = CHANGE_HOME_SOLD if sold else CHANGE_HOME_UNSOLD
+    if home_ids:
+        conn.execute(insert(SaleChanges), [{'kind': kind, 'home_id': home_id} for home_id in sorted(home_ids)])
+
+
+# Homes flipped through any session (like transaction() in insert_data.py) are logged when they are flushed
+@event.listens_for(OrmSession, 'after_flush')
+def _record_flushed_sold_flips(session, flush_context):
+    flips = {True: [], False: []}
+    for home in session.dirty:
+        if isinstance(home, Homes):
+            history = inspect(home).attrs.sold.history
+            if history.added and bool(history.added[0]) != bool(history.deleted and history.deleted[0]):
+                flips[bool(history.added[0])].append(home.home_id)
+    for sold, home_ids in flips.items():
+        record_sold_flips(session.connection(), home_ids, sold)
+
+
+### Archived sales
+# Sales of closed months can be moved out of the sales table into one archive table per year (sales_archive_2021,
+# ...) by archive.archive_sales(), so the sales table and its indexes only hold recent months. The archive tables
+# have the same columns, and the sales_history view is every sale, archived or not: summary rebuilds and checks
+# read it, as do reports asked for history (see query_data.sales_source). The commission ledger and monthly
+# leaderboards keep their rows for archived months, and ArchivedMonths records the totals of each month moved.
+# Archive tables and the view aren't declared on Base, since archive tables are only created as years are archived.
+ARCHIVE_PREFIX = 'sales_archive_'
+ARCHIVE_METADATA = MetaData()
+
+SalesHistory = Table('sales_history', ARCHIVE_METADATA, *[Column(column.name, column.type) for column in Sales.__table__.columns])
+
+def archive_table(year):
+    """
+    The archive table of a year's sales (not necessarily created yet), with the sales table's columns.
+    """
+    name = ARCHIVE_PREFIX + str(year)
+    if name not in ARCHIVE_METADATA.tables:
+        Table(name, ARCHIVE_METADATA,
+              *[Column(column.name, column.type, primary_key=column.primary_key) for column in Sales.__table__.columns],
+              # archived sales are read by month or by day, as the sales table is for reports
+              Index('idx_{}_month'.format(name), 'month_sold', 'agent_id', 'price_sold', 'commission'),
+              Index('idx_{}_date'.format(name), 'date_sold', 'agent_id', 'home_id', 'price_sold', 'commission'))
+    return ARCHIVE_METADATA.tables[name]
+
+
+def refresh_sales_history(conn):
+    """
+    (Re)create the sales_history view over the sales table and every archive table in the database.
+    """
+    years = sorted(int(name[len(ARCHIVE_PREFIX):]) for name in inspect(conn).get_table_names() if name.startswith(ARCHIVE_PREFIX))
+    columns = [column.name for column in Sales.__table__.columns]
+    history = union_all(*[select(*[table.c[name] for name in columns]) for table in [Sales.__table__] + [archive_table(year) for year in years]])
+    conn.execute(text('DROP VIEW IF EXISTS sales_history'))
+    conn.execute(text('CREATE VIEW sales_history AS ' + str(history.compile(conn, compile_kwargs={'literal_binds': True}))))
+
+@event.listens_for(Sales.__table__, 'after_create')
+def _create_sales_history(table, conn, **kw):
+    refresh_sales_history(conn)
+
+
+# The totals of the sales of each month moved to the archive (added to, if sales recorded for a month later are archived too)
+class ArchivedMonths(Base):
+    __tablename__ = 'archived_months'
+    month = Column(Integer, primary_key = True) # same format as Sales.month_sold
+    table_name = Column(Text)
+    sale_count = Column(Integer, default=0)
+    sale_volume = Column(Float, default=0)
+    commission_amount = Column(Float, default=0)
+    archived_at = Column(DateTime)
+
+    def __repr__(self):
+        return "<ArchivedMonths(Month ={}, Table ={}, Sales ={})".format(self.month, self.table_name, self.sale_count)
+
+
+### Indexes used by the monthly report queries in query_data.py
+# Covering indexes: every column a report reads from sales is in the index, so SQLite never visits the table rows
+# Q3 & Q5: filter by month, group by agent (and their office), sum the price or commission
+Index('idx_sales_month_agent', Sales.month_sold, Sales.agent_id, Sales.price_sold, Sales.commission)
+# Q4: filter by month and join each sale to its home, reading the stored days on the market (or the sale
+# date, to compare with the listing date for sales recorded without them)
+Index('idx_sales_month_days', Sales.month_sold, Sales.home_id, Sales.days_on_market, Sales.date_sold)
+# Reports over a range of days (like the last 30 days) rather than whole months: every column the reports read from sales
+Index('idx_sales_date', Sales.date_sold, Sales.agent_id, Sales.home_id, Sales.price_sold, Sales.commission)
+# Looking up the sales of a home (from the Homes side of a join) in date order
+Index('idx_sales_home_date', Sales.home_id, Sales.date_sold)
+# Grouping agents by their office
+Index('idx_agents_office', Agents.office_id, Agents.agent_id)
+# Loading the listings and sales of a batch of agents at once (agent_id IN (...), see profiles.py)
+Index('idx_listings_agent', Listings.agent_id)
+Index('idx_sales_agent', Sales.agent_id, Sales.date_sold)
+# Q3: reading one month of the commission ledger, largest commission first
+Index('idx_commission_month', Commission.month, Commission.commission_amount)
+# Q1 & Q2: reading the leaderboard rows of a month or a range of months
+Index('idx_office_monthly', OfficeMonthlySales.month, OfficeMonthlySales.office_id, OfficeMonthlySales.sale_count, OfficeMonthlySales.sale_volume)
+Index('idx_agent_monthly', AgentMonthlySales.month, AgentMonthlySales.agent_id, AgentMonthlySales.sale_count, AgentMonthlySales.sale_volume)
+
+### Indexes used by the home search in search_homes.py
+# Searches match sold (and usually zipcode) exactly, and read homes newest first, so those columns lead, followed
+# by the listing date and home ID the results are ordered and paginated by. The beds, baths and price filters are
+# checked from the index too, so only homes on the page are read from the table.
+Index('idx_homes_search_zipcode', Homes.zipcode, Homes.sold, Homes.date_listed, Homes.home_id, Homes.beds, Homes.baths, Homes.price_listed)
+Index('idx_homes_search_recent', Homes.sold, Homes.date_listed, Homes.home_id, Homes.beds, Homes.baths, Homes.price_listed)
+
+# The index each report query in query_data.py is expected to use
+REPORT_INDEXES = {
+    'top_office_sale_counts': 'idx_office_monthly',
+    'top_office_sale_amount': 'idx_office_monthly',
+    'top_agents': 'idx_agent_monthly',
+    'agent_commissions': 'idx_commission_month',
+    'days_on_market': 'idx_sales_month_days',
+    'average_days_on_market': 'idx_sales_month_days',
+    'average_selling_price': 'idx_sales_month_agent',
+}
+# The index every report is expected to use for a range of days that is not made of whole months
+PERIOD_REPORT_INDEX = 'idx_sales_date'
+
+
+def ensure_indexes(bind):
+    """
+    Migrate an existing database in place: create any of the indexes declared above which 
+    are missing (create_all only creates indexes along with new tables), and refresh the 
+    statistics SQLite's query planner uses to choose between them. Returns the created index names. 
+    """
+    created = []
+    existing_tables = set(inspect(bind).get_table_names())
+    with bind.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing_indexes = {index['name'] for index in inspect(conn).get_indexes(table.name)}
+            for index in sorted(table.indexes, key=lambda index: index.name):
+                if index.name not in existing_indexes:
+                    index.create(conn)
+                    created.append(index.name)
+        if created:
+            conn.execute(text('ANALYZE'))
+    return created
+
+
+def explain_query_plan(bind, statement):
+    """
+    Return SQLite's EXPLAIN QUERY PLAN lines for a Core statement or ORM query. 
+    """
+    statement = getattr(statement, 'statement', statement) # ORM queries wrap a Core select
+    with bind.connect() as conn:
+        compiled = statement.compile(dialect=conn.dialect)
+        params = tuple(compiled.params[name] for name in compiled.positiontup)
+        return [row[-1] for row in conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + str(compiled), params)]
+
+
+def verify_report_indexes(bind, reports, indexes=REPORT_INDEXES):
+    """
+    Check that each report query (a dictionary of name to query) is planned as a search on the index 
+    listed for it in indexes, rather than a scan of the whole index. Returns a dictionary of report 
+    name to (uses index, plan lines). 
+    """
+    results = {}
+    for name, statement in reports.items():
+        plan = explain_query_plan(bind, statement)
+        searched = ' INDEX {} ('.format(indexes[name])
+        results[name] = (any(line.startswith('SEARCH ') and searched in line for line in plan), plan)
+    return results
+
+
+### Pricing commission
+def commission_expression(conn, sales=Sales.__table__):
+    """
+    Build the commission of a sale from the commission tiers as one SQL CASE expression over the 
+    date_sold and price_sold of sales (the sales table, or an archive table), so whole batches of sales 
+    are priced by a single UPDATE. The tiers table is small, so it is read once and its values written 
+    into the expression. 
+    """
+    price = sales.c.price_sold
+    tier_sets = {}
+    for tier in conn.execute(select(CommissionTiers).order_by(CommissionTiers.effective_from, CommissionTiers.max_price.is_(None), CommissionTiers.max_price)):
+        tier_sets.setdefault(tier.effective_from, []).append(tier)
+
+    # within a set, tiers are ordered by max_price with the unbounded tier last
+    def tier_case(tiers):
+        whens = []
+        else_ = None
+        for tier in tiers:
+            if tier.max_price is None:
+                else_ = price * tier.rate
+            elif tier.max_inclusive:
+                whens.append((price <= tier.max_price, price * tier.rate))
+            else:
+                whens.append((price < tier.max_price, price * tier.rate))
+        return case(*whens, else_=else_) if whens else else_
+
+    if not tier_sets:
+        raise ValueError('There are no commission tiers to price sales with')
+    # the newest set of tiers in effect on the sale date, and the oldest set for sales without a date
+    effective_dates = sorted(tier_sets, reverse=True)
+    whens = [(sales.c.date_sold >= effective_from, tier_case(tier_sets[effective_from])) for effective_from in effective_dates[:-1]]
+    oldest = tier_case(tier_sets[effective_dates[-1]])
+    return case(*whens, else_=oldest) if whens else oldest
+
+
+# Days from the listing of a sale's home to the sale, for an UPDATE of sales (the sales table, or an archive table)
+def days_on_market_expression(sales=Sales.__table__):
+    date_listed = select(Homes.date_listed).where(Homes.home_id == sales.c.home_id).scalar_subquery()
+    return func.julianday(sales.c.date_sold) - func.julianday(date_listed)
+
+
+# A sale's days on the market, in queries joining sales (or an alias of them) to their homes: the days stored
+# with the sale, or the days from the listing to the sale for sales stored without them
+def sale_days_on_market(sales=Sales):
+    return func.coalesce(sales.days_on_market, func.julianday(sales.date_sold) - func.julianday(Homes.date_listed))
+
+
+def price_sales(conn, first_sale_id=None, sale_ids=None):
+    """
+    Set the commission of newly recorded sales (every sale with an ID of at least first_sale_id, or 
+    the sales with the given IDs) from the commission tiers, and store their days on the market, as 
+    part of the caller's transaction. 
+    """
+    conn.execute(update(Sales).where(_new_sales(first_sale_id, sale_ids)).values(
+        commission=commission_expression(conn), days_on_market=days_on_market_expression()))
+
+
+def recompute_commissions(since=None, chunk_size=50000, bind=None):
+    """
+    Re-price the commission of every sale made on or after since (a date), or of every sale, archived 
+    or not, after the commission tiers change. Sales are updated in chunks of chunk_size sale IDs, each 
+    in its own transaction, so memory use and lock time stay bounded however long the history is. The 
+    commission ledger, and the totals of archived months, are rebuilt for the affected months at the end. 
+    Returns the number of sales re-priced. 
+    """
+    bind = get_engine() if bind is None else bind
+    archive_years = sorted(int(name[len(ARCHIVE_PREFIX):]) for name in inspect(bind).get_table_names() if name.startswith(ARCHIVE_PREFIX))
+    repriced = 0
+    months = set()
+    for sales in [Sales.__table__] + [archive_table(year) for year in archive_years]:
+        in_range = sales.c.sale_id.isnot(None) if since is None else \
+            sales.c.date_sold >= datetime.datetime.combine(since, datetime.time())
+        affected_months = sales.c.month_sold.isnot(None) if since is None else sales.c.month_sold >= month_key(since)
+        with bind.connect() as conn:
+            first_id, last_id = conn.execute(select(func.min(sales.c.sale_id), func.max(sales.c.sale_id)).where(in_range)).first()
+            months.update(conn.execute(select(sales.c.month_sold).where(affected_months).distinct()).scalars())
+        if first_id is None:
+            continue
+
+        for chunk_start in range(first_id, last_id + 1, chunk_size):
+            with bind.begin() as conn:
+                repriced += conn.execute(
+                    update(sales).
+                    where(and_(in_range, sales.c.sale_id >= chunk_start, sales.c.sale_id < chunk_start + chunk_size)).
+                    values(commission=commission_expression(conn, sales))
+                ).rowcount
+                bump_write_versions(conn, [Sales], [month_key(since)] if since else (), history=since is None)
+        if sales is not Sales.__table__:
+            archived_months = ArchivedMonths.table_name == sales.name
+            if since is not None:
+                archived_months = and_(archived_months, ArchivedMonths.month >= month_key(since))
+            with bind.begin() as conn:
+                conn.execute(update(ArchivedMonths).where(archived_months).values(commission_amount=
+                    select(func.coalesce(func.sum(sales.c.commission), 0)).where(sales.c.month_sold == ArchivedMonths.month).scalar_subquery()))
+                bump_write_versions(conn, [ArchivedMonths])
+    for month in sorted(months):
+        rebuild_commissions(month=month, bind=bind)
+    return repriced
+
+
+### Summary table maintenance
+# The commission ledger and the monthly leaderboards hold running totals of sales per key and month.
+# Each is described by its key columns, its total columns, and a select computing those totals from the rows
+# of a sales table (the sales table itself, or the sales_history view of every sale, archived or not) chosen
+# by a where clause, so the same select serves incremental updates and rebuilds.
+def _commission_totals(sales, where):
+    return select(
+        sales.c.agent_id, sales.c.month_sold, func.sum(sales.c.commission), func.count(sales.c.sale_id)
+        ).\
+            where(where).\
+            group_by(sales.c.agent_id, sales.c.month_sold)
+
+def _office_sales_totals(sales, where):
+    return select(
+        Agents.office_id, sales.c.month_sold, func.count(sales.c.sale_id), func.sum(sales.c.price_sold)
+        ).\
+            join(Agents, sales.c.agent_id == Agents.agent_id).\
+            where(where).\
+            group_by(Agents.office_id, sales.c.month_sold)
+
+def _agent_sales_totals(sales, where):
+    return select(
+        sales.c.agent_id, sales.c.month_sold, func.count(sales.c.sale_id), func.sum(sales.c.price_sold)
+        ).\
+            where(where).\
+            group_by(sales.c.agent_id, sales.c.month_sold)
+
+COMMISSION_SUMMARY = (Commission, ['agent_id', 'month'], ['commission_amount', 'sale_count'], _commission_totals)
+MONTHLY_SALES_SUMMARIES = [
+    (OfficeMonthlySales, ['office_id', 'month'], ['sale_count', 'sale_volume'], _office_sales_totals),
+    (AgentMonthlySales, ['agent_id', 'month'], ['sale_count', 'sale_volume'], _agent_sales_totals),
+]
+
+
+def _sales_in_month(sales, month):
+    return sales.c.month_sold.isnot(None) if month is None else sales.c.month_sold == month
+
+
+def record_sale_summaries(conn, first_sale_id=None, sale_ids=None):
+    """
+    Add newly recorded sales (every sale with an ID of at least first_sale_id, or the sales with the 
+    given IDs) to the commission ledger and monthly leaderboards, as part of the caller's transaction. 
+    One upsert per table covers a whole batch of sales. The write versions of the sales and summary 
+    tables are bumped too. 
+    """
+    summaries = [COMMISSION_SUMMARY] + MONTHLY_SALES_SUMMARIES
+    for table, keys, totals, select_totals in summaries:
+        insertion = sqlite_insert(table).from_select(keys + totals, select_totals(Sales.__table__, _new_sales(first_sale_id, sale_ids)))
+        conn.execute(insertion.on_conflict_do_update(
+            index_elements=keys,
+            set_={total: getattr(table, total) + insertion.excluded[total] for total in totals}
+        ))
+    months = conn.execute(select(Sales.month_sold).where(_new_sales(first_sale_id, sale_ids)).distinct()).scalars().all()
+    bump_write_versions(conn, [Sales] + [summary[0] for summary in summaries], months)
+
+
+# Sales added through any session (like transaction() in insert_data.py) are recorded when they are flushed, 
+# as record_sales() records them: priced, added to the summary tables and logged to the change feed
+@event.listens_for(OrmSession, 'after_flush')
+def _record_flushed_sales(session, flush_context):
+    sales = {row.sale_id: row for row in session.new if isinstance(row, Sales)}
+    if sales:
+        conn = session.connection()
+        price_sales(conn, sale_ids=list(sales))
+        record_sale_summaries(conn, sale_ids=list(sales))
+        record_sale_changes(conn, sale_ids=list(sales))
+        # the sales in the session get the priced values too
+        for sale_id, commission, days in conn.execute(select(Sales.sale_id, Sales.commission, Sales.days_on_market).where(Sales.sale_id.in_(list(sales)))):
+            set_committed_value(sales[sale_id], 'commission', commission)
+            set_committed_value(sales[sale_id], 'days_on_market', days)
+
+
+def _rebuild_summaries(summaries, month, bind):
+    bind = get_engine() if bind is None else bind
+    with bind.begin() as conn:
+        for table, keys, totals, select_totals in summaries:
+            if month is None:
+                conn.execute(delete(table))
+            else:
+                conn.execute(delete(table).where(table.month == month))
+            conn.execute(sqlite_insert(table).from_select(keys + totals, select_totals(SalesHistory, _sales_in_month(SalesHistory, month))))
+        bump_write_versions(conn, [summary[0] for summary in summaries], [month], history=month is None)
+
+
+def rebuild_commissions(month=None, bind=None):
+    """
+    Recompute the commission ledger from every sale, archived or not, for one month, or for every month if no 
+    month is given. Only needed to repair the ledger, since it is kept up to date as sales are recorded. 
+    """
+    _rebuild_summaries([COMMISSION_SUMMARY], month, bind)
+
+
+def rebuild_monthly_sales(month=None, bind=None):
+    """
+    Recompute the office and agent monthly leaderboards from every sale, archived or not, for one month or every month. 
+    """
+    _rebuild_summaries(MONTHLY_SALES_SUMMARIES, month, bind)
+
+
+def check_monthly_sales(month=None, bind=None):
+    """
+    Compare the office and agent monthly leaderboards against totals aggregated from the raw 
+    sales joined to agents, for one month or every month. Returns a list of 
+    (table name, key, stored totals, expected totals) for each row that disagrees, so an empty list means consistent. 
+    Offices are taken from each agent's current office, so agents changing office also show up here. 
+    """
+    bind = get_engine() if bind is None else bind
+    mismatches = []
+    with bind.connect() as conn:
+        for table, keys, totals, select_totals in MONTHLY_SALES_SUMMARIES:
+            stored_rows = select(*[getattr(table, column) for column in keys + totals])
+            if month is not None:
+                stored_rows = stored_rows.where(table.month == month)
+            stored = {tuple(row[:2]): tuple(row[2:]) for row in conn.execute(stored_rows)}
+            expected = {tuple(row[:2]): tuple(row[2:]) for row in conn.execute(select_totals(SalesHistory, _sales_in_month(SalesHistory, month)))}
+            for key in sorted(set(stored) | set(expected)):
+                stored_totals, expected_totals = stored.get(key), expected.get(key)
+                if stored_totals is None or expected_totals is None or \
+                        not all(math.isclose(a, b) for a, b in zip(stored_totals, expected_totals)):
+                    mismatches.append((table.__tablename__, key, stored_totals, expected_totals))
+    return mismatches
+
+
+### Migrations
+# Migrations which backfill existing rows record their progress here, so a database is only scanned the
+# first time a migration runs, and a backfill interrupted part way carries on from the last chunk it wrote.
+class Migrations(Base):
+    __tablename__ = 'migrations'
+    name = Column(Text, primary_key = True) # a migration, or a migration and the table it fills
+    position = Column(Integer) # the last sale ID a backfill has reached
+    finished = Column(Boolean, nullable=False, default=False)
+
+    def __repr__(self):
+        return "<Migrations(Name ={}, Position ={}, Finished ={})>".format(self.name, self.position, self.finished)
+
+
+def _migration(conn, name):
+    return conn.execute(select(Migrations.position, Migrations.finished).where(Migrations.name == name)).first()
+
+def _record_migration(conn, name, position=None, finished=False):
+    insertion = sqlite_insert(Migrations).values(name=name, position=position, finished=finished)
+    conn.execute(insertion.on_conflict_do_update(index_elements=['name'], set_={'position': position, 'finished': finished}))
+
+
+def migrate_commission_table(bind):
+    """
+    The commission table used to hold one row per agent, refilled for every report. 
+    Replace a table in that old format with the ledger, filled from the existing sales. 
+    """
+    if 'commission' not in inspect(bind).get_table_names():
+        return False
+    columns = {column['name'] for column in inspect(bind).get_columns('commission')}
+    if 'month' in columns:
+        return False
+    Commission.__table__.drop(bind)
+    Commission.__table__.create(bind)
+    rebuild_commissions(bind=bind)
+    return True
+
+
+def migrate_period_keys(bind):
+    """
+    Month keys used to be built as int(str(year) + str(month)), so 2022-01 was 20221 and did not sort 
+    before 2021-12 (202112). Backfill the month keys of homes and sales from their dates in the 
+    year * 100 + month format (falling back on converting the old key for rows without a date), then 
+    rebuild the summary tables, which are keyed by month. Only looks for old keys once per database. 
+    """
+    with bind.connect() as conn:
+        migration = _migration(conn, 'period_keys')
+        if migration is not None and migration.finished:
+            return False
+        old_sales = conn.execute(select(Sales.sale_id).where(Sales.month_sold < 100000).limit(1)).first()
+        old_homes = conn.execute(select(Homes.home_id).where(Homes.month_listed < 100000).limit(1)).first()
+    if old_sales is None and old_homes is None:
+        with bind.begin() as conn:
+            _record_migration(conn, 'period_keys', finished=True)
+        return False
+    with bind.begin() as conn:
+        for table, month_column, date_column in [(Sales, 'month_sold', 'date_sold'), (Homes, 'month_listed', 'date_listed')]:
+            conn.execute(text(
+                "UPDATE {table} SET {month} = CASE "
+                "WHEN {date} IS NOT NULL THEN CAST(strftime('%Y%m', {date}) AS INTEGER) "
+                "WHEN {month} < 100000 THEN ({month} / 10) * 100 + {month} % 10 "
+                "ELSE {month} END".format(table=table.__tablename__, month=month_column, date=date_column)
+            ))
+    _rebuild_summaries([COMMISSION_SUMMARY] + MONTHLY_SALES_SUMMARIES, None, bind)
+    with bind.begin() as conn:
+        _record_migration(conn, 'period_keys', finished=True)
+    return True
+
+
+def migrate_monthly_sales(bind):
+    """
+    Fill the monthly leaderboards from the existing sales when they are first added to a database. 
+    """
+    with bind.connect() as conn:
+        leaderboards_empty = conn.execute(select(OfficeMonthlySales.month).limit(1)).first() is None
+        have_sales = conn.execute(select(Sales.sale_id).limit(1)).first() is not None
+    if leaderboards_empty and have_sales:
+        rebuild_monthly_sales(bind=bind)
+        return True
+    return False
+
+
+def migrate_sales_history(bind):
+    """
+    Create the sales_history view in a database created before it was added.
+    """
+    if 'sales_history' not in inspect(bind).get_view_names():
+        with bind.begin() as conn:
+            refresh_sales_history(conn)
+        return True
+    return False
+
+
+def migrate_days_on_market(bind, chunk_size=50000):
+    """
+    Add the days_on_market column to the sales (and archived sales) of a database created before it, and 
+    replace the index Q4 used before with one including it. The sales of each table the column is added to 
+    are then filled in from their listing and sale dates, in chunks of chunk_size sale IDs, each recorded in 
+    the migrations table, so a fill interrupted part way carries on from its last chunk the next time it 
+    runs. Returns whether anything changed. 
+    """
+    existing_tables = inspect(bind).get_table_names()
+    years = sorted(int(name[len(ARCHIVE_PREFIX):]) for name in existing_tables if name.startswith(ARCHIVE_PREFIX))
+    tables = ([Sales.__table__] if 'sales' in existing_tables else []) + [archive_table(year) for year in years]
+    missing = [table for table in tables if 'days_on_market' not in {column['name'] for column in inspect(bind).get_columns(table.name)}]
+    if missing:
+        with bind.begin() as conn:
+            for table in missing:
+                conn.execute(text('ALTER TABLE {} ADD COLUMN days_on_market FLOAT'.format(table.name)))
+                _record_migration(conn, 'days_on_market ' + table.name, position=0)
+            conn.execute(text('DROP INDEX IF EXISTS idx_sales_month_home'))
+            refresh_sales_history(conn)
+
+    filled = False
+    for table in tables:
+        name = 'days_on_market ' + table.name
+        with bind.connect() as conn:
+            migration = _migration(conn, name)
+            if migration is None or migration.finished:
+                continue
+            last_id = conn.execute(select(func.max(table.c.sale_id))).scalar() or 0
+        for chunk_start in range(migration.position + 1, last_id + 1, chunk_size):
+            chunk_end = min(chunk_start + chunk_size - 1, last_id)
+            with bind.begin() as conn:
+                conn.execute(update(table).
+                             where(and_(table.c.days_on_market.is_(None), table.c.sale_id.between(chunk_start, chunk_end))).
+                             values(days_on_market=days_on_market_expression(table)))
+                bump_write_versions(conn, [Sales], history=True)
+                _record_migration(conn, name, position=chunk_end)
+        with bind.begin() as conn:
+            _record_migration(conn, name, position=last_id, finished=True)
+        filled = True
+    return bool(missing) or filled
+
+
+def init_db(bind):
+    """
+    Create all the tables defined above, and bring a database created before the latest changes up to date. 
+    """
+    Base.metadata.create_all(bind=bind)
+    migrate_days_on_market(bind)
+    migrate_commission_table(bind)
+    migrate_period_keys(bind)
+    migrate_sales_history(bind)
+    migrate_monthly_sales(bind)
+    ensure_indexes(bind)
+
 
-# create all the tables defined above 
-Base.metadata.create_all(bind=engine)
\ No newline at end of file
+# Running this file creates the database, or brings an existing one up to date
+if __name__ == '__main__':
+    get_engine()
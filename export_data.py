@@ -0,0 +1,88 @@
+import argparse
+import csv
+import datetime
+import json
+import sys
+from create import get_session
+from query_data import report, columns, stream, rolling_days, REPORTS
+
+### Streaming report export
+# Writes a report as CSV or JSON lines, a batch of rows at a time (see query_data.stream), so exporting
+# the whole sales history runs in constant memory. Writing to stdout lets the output be piped to other tools:
+#     python3 export_data.py days_on_market --format jsonl | gzip > days_on_market.jsonl.gz
+
+# Dates are written in ISO format in both formats
+def _value(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return value
+
+
+def write_csv(rows, file, header=None):
+    """
+    Write rows to a file as CSV, with a header row if given. Returns the number of rows written.
+    """
+    writer = csv.writer(file)
+    if header is not None:
+        writer.writerow(header)
+    count = 0
+    for row in rows:
+        writer.writerow([_value(value) for value in row])
+        count += 1
+    return count
+
+
+def write_jsonl(rows, file, header):
+    """
+    Write rows to a file as JSON lines, one object per row keyed by the header. Returns the number of rows written.
+    """
+    count = 0
+    for row in rows:
+        file.write(json.dumps({name: _value(value) for name, value in zip(header, row)}) + '\n')
+        count += 1
+    return count
+
+
+WRITERS = {'csv': write_csv, 'jsonl': write_jsonl}
+
+def export_report(session, name, file, period=None, format='csv', batch_size=1000, history=False):
+    """
+    Stream a report by name (see query_data.REPORTS) to a file as CSV or JSON lines, including the archived
+    sales with history. Returns the number of rows written.
+    """
+    if format not in WRITERS:
+        raise ValueError('Unknown format {!r}, expected one of {}'.format(format, ', '.join(WRITERS)))
+    query = report(session, name, period, history)
+    return WRITERS[format](stream(query, batch_size), file, columns(query))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export a report as CSV or JSON lines')
+    parser.add_argument('report', choices=list(REPORTS))
+    parser.add_argument('--format', choices=list(WRITERS), default='csv')
+    period = parser.add_mutually_exclusive_group()
+    period.add_argument('--month', type=int, help='month key, like 202206')
+    period.add_argument('--days', type=int, help='the last number of days')
+    parser.add_argument('--output', help='file to write (by default, stdout)')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--history', action='store_true', help='include the sales of archived months')
+    args = parser.parse_args()
+
+    if args.month:
+        period = args.month
+    elif args.days:
+        period = rolling_days(args.days)
+    else:
+        period = None
+
+    session = get_session()
+    file = open(args.output, 'w', newline='') if args.output else sys.stdout
+    try:
+        export_report(session, args.report, file, period, args.format, args.batch_size, args.history)
+    except BrokenPipeError:
+        # the tool reading stdout (like head) stopped early, which is fine
+        sys.stdout = None
+    finally:
+        if args.output:
+            file.close()
+        session.close()
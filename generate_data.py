@@ -0,0 +1,126 @@
+import argparse
+import datetime
+import random
+from array import array
+from collections import namedtuple
+from sqlalchemy import create_engine, insert, text
+from create import Offices, Agents, Sellers, Buyers, Homes, Listings, month_key, get_engine, init_db
+from insert_data import record_sales
+
+### Synthetic data generator
+# Streams a realistic dataset of any size into the database, to see how the report queries behave at scale.
+# The same seed always produces the same data. Rows are generated lazily and written in batches (Core
+# executemany for the reference tables, record_sales() for the sales, so the summary tables are kept up to
+# date too), so memory use doesn't grow with the size of the dataset, apart from one small number per home.
+
+# The number of rows of each table to generate
+Scale = namedtuple('Scale', ['offices', 'agents', 'sellers', 'buyers', 'homes', 'sales'])
+
+SCALES = {
+    'tiny': Scale(offices=5, agents=50, sellers=500, buyers=500, homes=1000, sales=2000),
+    'small': Scale(offices=20, agents=500, sellers=5000, buyers=5000, homes=10000, sales=50000),
+    'medium': Scale(offices=100, agents=5000, sellers=50000, buyers=50000, homes=100000, sales=1000000),
+    'large': Scale(offices=500, agents=25000, sellers=500000, buyers=500000, homes=1000000, sales=10000000),
+}
+
+FIRST_NAMES = ['Dwight', 'Jim', 'Pam', 'Michael', 'Angela', 'Stanley', 'Kevin', 'Oscar', 'Erin', 'Andy',
+               'Toph', 'Katara', 'Sokka', 'Zuko', 'Aang', 'Iroh', 'Suki', 'Yue', 'Azula', 'Mai']
+LAST_NAMES = ['Schrute', 'Halpert', 'Beesly', 'Scott', 'Martin', 'Hudson', 'Malone', 'Martinez', 'Hannon',
+              'Bernard', 'Beifong', 'Kyoshi', 'Ozai', 'Bird', 'Macken', 'Ware', 'Ruiz', 'Rubin', 'Palmer', 'Vance']
+CITIES = ['SF', 'London', 'Nice', 'Buenos Aires', 'Berlin', 'Seoul', 'Hyderabad', 'Taipei']
+STREETS = ['Market St', 'Turk St', 'Nathaniel', 'Esmeralda', 'Rue Delille', 'Exmouth', 'Clerkenwell Rd', 'Peter St']
+
+
+def _chunks(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _people(rng, count):
+    for number in range(1, count + 1):
+        first_name, last_name = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        yield {'first_name': first_name, 'last_name': last_name,
+               'email': '{}.{}{}@example.com'.format(first_name, last_name, number).lower()}
+
+
+def generate(scale='tiny', seed=162, bind=None, start=datetime.date(2020, 1, 1), end=datetime.date(2022, 12, 31), batch_size=10000):
+    """
+    Fill an empty database with generated offices, agents, sellers, buyers, homes, listings and sales,
+    at one of the SCALES (or a Scale). Homes are listed between start and end, and sold some days later.
+    Returns the Scale generated.
+    """
+    scale = SCALES[scale] if isinstance(scale, str) else scale
+    bind = get_engine() if bind is None else bind
+    rng = random.Random(seed)
+    days = (end - start).days
+
+    def write(table, rows):
+        for chunk in _chunks(rows, batch_size):
+            with bind.begin() as conn:
+                conn.execute(insert(table), chunk)
+
+    write(Offices, ({'name': '{} Real Estate {}'.format(rng.choice(CITIES), number)} for number in range(1, scale.offices + 1)))
+    write(Agents, (dict(person, office_id=rng.randint(1, scale.offices)) for person in _people(rng, scale.agents)))
+    write(Sellers, _people(rng, scale.sellers))
+    write(Buyers, _people(rng, scale.buyers))
+
+    # The listing day (as days after start) and price of every home are kept, so each sale can follow its listing
+    listed = array('H')
+    prices = array('f')
+    def homes():
+        for number in range(1, scale.homes + 1):
+            listed.append(rng.randint(0, days))
+            prices.append(round(rng.lognormvariate(12.9, 0.6), -3))
+            date_listed = start + datetime.timedelta(days=listed[-1])
+            beds = rng.randint(1, 5)
+            yield {
+                'beds': beds,
+                'baths': min(beds, rng.choice([1, 1.5, 2, 2.5, 3])),
+                'address': '{} {}'.format(rng.randint(1, 999), rng.choice(STREETS)),
+                'zipcode': '{:05d}'.format(rng.randint(10000, 10000 + scale.homes // 20 + 10)),
+                'price_listed': prices[-1],
+                'date_listed': date_listed,
+                'month_listed': month_key(date_listed),
+            }
+    write(Homes, homes())
+    write(Listings, ({'home_id': home_id, 'agent_id': rng.randint(1, scale.agents), 'seller_id': rng.randint(1, scale.sellers)}
+                     for home_id in range(1, scale.homes + 1)))
+
+    # Homes take about 45 days to sell, and sell for a little above or below their listing price
+    def sales():
+        for _ in range(scale.sales):
+            home_id = rng.randint(1, scale.homes)
+            days_on_market = min(int(rng.expovariate(1 / 45)) + 1, 365)
+            yield {
+                'home_id': home_id,
+                'agent_id': rng.randint(1, scale.agents),
+                'buyer_id': rng.randint(1, scale.buyers),
+                'price_sold': round(prices[home_id - 1] * rng.uniform(0.9, 1.1), -2),
+                'date_sold': datetime.datetime.combine(start + datetime.timedelta(days=listed[home_id - 1] + days_on_market), datetime.time()),
+            }
+    record_sales(sales(), batch_size=batch_size, bind=bind)
+
+    # refresh the statistics the query planner uses to choose indexes
+    with bind.begin() as conn:
+        conn.execute(text('ANALYZE'))
+    return scale
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fill an empty database with generated data')
+    parser.add_argument('--scale', choices=sorted(SCALES), default='tiny')
+    parser.add_argument('--seed', type=int, default=162)
+    parser.add_argument('--url', help='database to fill (by default, the configured database)')
+    args = parser.parse_args()
+
+    bind = None
+    if args.url:
+        bind = create_engine(args.url)
+        init_db(bind)
+    print(generate(args.scale, args.seed, bind))
@@ -1,107 +1,268 @@
+import math
 from datetime import date
-from create import Offices, Agents, Listings, Homes, Buyers, Sales, Sellers, engine, Base
-from sqlalchemy.orm import sessionmaker
-
-# Before inserting data, start a session
-Session = sessionmaker(bind=engine)
-session = Session()
-
-### DATA TO BE INSERTED ###
-offices = [
-    Offices(name = 'SF Real Estate'),
-    Offices(name = 'London Real Estate'),
-    Offices(name = 'Nice Real Estate'),
-    Offices(name = 'Buenos Aires Real Estate')
-]
-
-homes = [
-    Homes(beds=1, baths=1, address='22 Nathaniel', zipcode='94103', price_listed= 800000.00, date_listed=date(2021,9,21), month_listed=20219),
-    Homes(beds=1, baths=1, address='73A Peter St', zipcode='06000', price_listed= 400000.00, date_listed=date(2021,9,28), month_listed=20219),
-    Homes(beds=3, baths=3, address='100 Esmeralda', zipcode='24012', price_listed= 90000.00, date_listed=date(2021,9,24), month_listed=20219),
-    Homes(beds=2, baths=1.5, address='5 Rue Delille', zipcode='10009', price_listed= 100000.00, date_listed=date(2021,1,1), month_listed=20211),
-    Homes(beds=1, baths=1, address='16 Turk St', zipcode='94102', price_listed= 50000.00, date_listed=date(2021,6,12), month_listed=20216),
-    Homes(beds=1, baths=1, address='110 Market St', zipcode='94101', price_listed= 2000000.00, date_listed=date(2021,12,25), month_listed=202112),
-    Homes(beds=2, baths=2.5, address='33 Exmouth', zipcode='EC1R 4QL', price_listed= 570000.00, date_listed=date(2021,4,16), month_listed=20214, sold=True),
-    Homes(beds=3, baths=1.5, address='91 Clerkenwell Rd', zipcode='EC1R 5BX', price_listed= 200000.00, date_listed=date(2021,1,17), month_listed=20211),
-]
-
-agents = [
-    Agents(office_id=1, first_name = 'Dwight', last_name='Schrute', email='dwight@estates.com'),
-    Agents(office_id=2, first_name = 'Jim', last_name='Halpert', email='jim@estates.com'),
-    Agents(office_id=3, first_name = 'Michael', last_name='Scott',  email='michael@estates.com'),
-    Agents(office_id=4, first_name = 'Pam', last_name='Beesly', email='pam@estates.com'),
-    Agents(office_id=1, first_name = 'Angela', last_name='Martin', email='angela@estates.com'),
-    Agents(office_id=1, first_name = 'Stanley', last_name='Hudson', email='stanley@estates.com'),
-    Agents(office_id=2, first_name = 'Toby', last_name='Flenderson', email='toby@estates.com'),
-    Agents(office_id=2, first_name = 'Kevin', last_name='Malone', email='kev@estates.com'),
-    Agents(office_id=3, first_name = 'Andy', last_name='Bernard', email='andy@estates.com'),
-    Agents(office_id=4, first_name = 'Erin', last_name='Hannon', email='erin@estates.com'),
-    Agents(office_id=4, first_name = 'Oscar', last_name='Martinez', email='oscar@estates.com'),
-    Agents(office_id=4, first_name = 'Phyllis', last_name='Vance', email='phylissvance@estates.com'),
-    Agents(office_id=4, first_name = 'Meredith', last_name='Palmer', email='meredith@estates.com'),
-    Agents(office_id=4, first_name = 'Kelly', last_name='Kapoor', email='kelly@estates.com'),
-    Agents(office_id=4, first_name = 'Ryan', last_name='Howard', email='ryan@estates.com')
-]
-
-sellers = [
-    Sellers(first_name = 'Malia', last_name='Bird', email='mbird@gmail.com'),
-    Sellers(first_name = 'Finn', last_name='Macken', email='finnian@gmail.com'),
-    Sellers(first_name = 'Leo', last_name='Ware', email='beware@gmail.com'),
-    Sellers(first_name = 'Laura', last_name='Ruiz', email='lau@gmail.com'),
-    Sellers(first_name = 'Gal', last_name='Rubin', email='rubs@gmail.com')
-]
-
-# Including edgecase where multiple listings are listed by the same agent 
-listings = [
-    Listings(home_id=1, agent_id=1, seller_id=4),
-    Listings(home_id=2, agent_id=2, seller_id=1),
-    Listings(home_id=3, agent_id=2, seller_id=1),
-    Listings(home_id=4, agent_id=7, seller_id=1),
-    Listings(home_id=5, agent_id=8, seller_id=3),
-    Listings(home_id=6, agent_id=3, seller_id=3),
-    Listings(home_id=7, agent_id=6, seller_id=4)
-]
-
-buyers = [
-    Buyers(first_name = 'Toph', last_name='Beifong', email='metal_bender@gmail.com'),
-    Buyers(first_name = 'Firelord', last_name='Ozai', email='crazy@yahoo.com'),
-    Buyers(first_name = 'Avatar', last_name='Kyoshi',  email='kyoshi@gmail.com'),
-    Buyers(first_name = 'Princess', last_name='Yue', email='moon@sky.com')
-]
-
-# adding all the data defined in the lists above
-session.add_all(offices)
-session.add_all(homes)
-session.add_all(agents)
-session.add_all(sellers)
-session.add_all(listings)
-session.add_all(buyers)
-# Including one old sale (won't be included in this month's sales for checking query filters)
-session.add(Sales(home_id=7, agent_id=13, buyer_id=1, price_sold=200000.00, date_sold=date(2022,9,21), month_sold=20222))
-session.commit() # commit all database additions in this session
-
+from collections import namedtuple
+from create import Offices, Agents, Listings, Homes, Buyers, Sales, Sellers, Base, get_engine, get_session, price_sales, record_sale_summaries, \
+    record_sale_changes, record_sold_flips
+from sqlalchemy import select, insert, update, func
+from sqlalchemy.exc import SQLAlchemyError
 
 ## Transaction Function 
 # Referencing: https://riptutorial.com/sqlalchemy/example/6625/transactions and https://docs.sqlalchemy.org/en/20/core/connections.html 
-def transaction(home_id, agent_id, buyer_id, price_sold):
-    session = Session() # start individual session for a transaction
+def transaction(home_id, agent_id, buyer_id, price_sold, bind=None):
+    session = get_session(bind) # start individual session for a transaction
     # Try completing the sale data entry 
     try: 
-        session.add(Sales(home_id=home_id, agent_id=agent_id, buyer_id=buyer_id, price_sold=price_sold))
-        home_sold = session.query(Homes).get(home_id)
+        _sale_row((home_id, agent_id, buyer_id, price_sold)) # reject bad input before writing anything
+        home_sold = session.query(Homes).get(home_id) # looked up before adding the sale, so the sale isn't flushed before the home flips
         home_sold.sold = True # update the sold status of the the specified home
+        session.add(Sales(home_id=home_id, agent_id=agent_id, buyer_id=buyer_id, price_sold=price_sold))
+        # the sale is priced from the commission tiers, added to the commission ledger and leaderboards for the month,
+        # and logged to the change feed (after the home flipping to sold) as it is flushed (see create.py)
         session.commit()
     # If something interupts or fails in the transaction, do not commit to database and rollback
     except: 
         session.rollback()
         raise
 
-# Including purchases made by the same buyer and sold by the same agent
-# Sold prices include price points in each commission range
-transaction(1, 1, 2, 200000.00)
-transaction(2, 1, 1, 400000.00)
-transaction(3, 9, 2, 1100000.00)
-transaction(4, 4, 2, 2000000.00)
-transaction(5, 3, 3, 90000.00)
-transaction(6, 7, 4, 60000.00)
 
+## Bulk Sales Ingest
+# transaction() pays for a session, a lookup and a commit per sale, which is too slow for a 
+# nightly feed of closings. record_sales() writes each batch with one executemany INSERT into 
+# sales and one set-based UPDATE of Homes.sold, inside a single database transaction.
+SALE_FIELDS = ('home_id', 'agent_id', 'buyer_id', 'price_sold')
+
+# A sale that was not written, with its position in the input and the reason it was rejected
+RejectedSale = namedtuple('RejectedSale', ['index', 'sale', 'reason'])
+
+class SalesLoadResult:
+    """
+    Summary of a record_sales() run: how many sales were written, and which were rejected. 
+    """
+    def __init__(self):
+        self.inserted = 0
+        self.batches = 0
+        self.rejected = []
+
+    def __repr__(self):
+        return "<SalesLoadResult(Inserted={}, Rejected={}, Batches={})>".format(self.inserted, len(self.rejected), self.batches)
+
+
+# Accept either (home_id, agent_id, buyer_id, price_sold) tuples, matching transaction(), or 
+# dictionaries which may also carry a date_sold for historical sales (month_sold follows from it)
+def _sale_row(sale):
+    if isinstance(sale, dict):
+        row = dict(sale)
+    else:
+        row = dict(zip(SALE_FIELDS, sale))
+    # IDs are allocated by the database, so the IDs of a batch can be worked out from the last one inserted
+    extra = sorted(set(row) - set(SALE_FIELDS) - {'date_sold'})
+    if extra:
+        raise ValueError("unexpected {}".format(", ".join(extra)))
+    missing = [field for field in SALE_FIELDS if row.get(field) is None]
+    if missing:
+        raise ValueError("missing {}".format(", ".join(missing)))
+    for field in ('home_id', 'agent_id', 'buyer_id'):
+        if isinstance(row[field], bool) or not isinstance(row[field], int):
+            raise ValueError("{} must be an integer, got {!r}".format(field, row[field]))
+    row['price_sold'] = float(row['price_sold'])
+    if not (math.isfinite(row['price_sold']) and row['price_sold'] > 0):
+        raise ValueError("price_sold must be positive")
+    if 'date_sold' in row and not isinstance(row['date_sold'], date):
+        raise ValueError("date_sold must be a date, got {!r}".format(row['date_sold']))
+    return row
+
+
+# Ids of a column which exist in the database, looked up once for the whole batch
+def _existing_ids(conn, column, ids):
+    return set(conn.execute(select(column).where(column.in_(ids))).scalars())
+
+
+# Write one batch of validated sales in a single transaction. Returns the number of sales written and the 
+# rejections for sales referring to unknown rows; database errors are raised, after rolling back the batch
+def _insert_sales_batch(bind, rows):
+    unknown_rows = []
+    with bind.begin() as conn:
+        # Foreign keys are not enforced by SQLite, so check the referenced rows exist
+        existing = {
+            'home_id': _existing_ids(conn, Homes.home_id, {row['home_id'] for _, _, row in rows}),
+            'agent_id': _existing_ids(conn, Agents.agent_id, {row['agent_id'] for _, _, row in rows}),
+            'buyer_id': _existing_ids(conn, Buyers.buyer_id, {row['buyer_id'] for _, _, row in rows}),
+        }
+        valid = []
+        for index, sale, row in rows:
+            unknown = [field for field in existing if row[field] not in existing[field]]
+            if unknown:
+                unknown_rows.append(RejectedSale(index, sale, "unknown {}".format(", ".join(unknown))))
+            else:
+                valid.append(row)
+        if not valid:
+            return 0, unknown_rows
+
+        # executemany needs the same columns in every row, so group rows with and without dates
+        groups = {}
+        for row in valid:
+            groups.setdefault(tuple(sorted(row)), []).append(row)
+        for group in groups.values():
+            conn.execute(insert(Sales), group)
+        # This transaction holds the write lock from its first insert, so the new sales have consecutive IDs 
+        # ending with the last one inserted (another writer can't slip sales in between them)
+        first_sale_id = conn.execute(select(func.last_insert_rowid())).scalar() - len(valid) + 1
+        sold_homes = {row['home_id'] for row in valid}
+        flipped = set(conn.execute(select(Homes.home_id).where(Homes.home_id.in_(sold_homes), Homes.sold.isnot(True))).scalars())
+        conn.execute(
+            update(Homes).
+            where(Homes.home_id.in_(sold_homes)).
+            values(sold=True)
+        )
+        record_sold_flips(conn, flipped)
+        price_sales(conn, first_sale_id)
+        record_sale_summaries(conn, first_sale_id)
+        record_sale_changes(conn, first_sale_id)
+    return len(valid), unknown_rows
+
+
+def _write_sales_batch(bind, batch, result, retry=None):
+    rows = []
+    for index, sale in batch:
+        try:
+            rows.append((index, sale, _sale_row(sale)))
+        except (TypeError, ValueError) as error:
+            result.rejected.append(RejectedSale(index, sale, str(error)))
+    if not rows:
+        return
+
+    try:
+        write = lambda: _insert_sales_batch(bind, rows)
+        inserted, unknown_rows = write() if retry is None else retry(write)
+        result.inserted += inserted
+        result.rejected.extend(unknown_rows)
+    # A database error rolls back the whole batch, but the load carries on with the next one
+    except SQLAlchemyError as error:
+        reason = "batch rolled back: {}".format(error.__class__.__name__)
+        result.rejected.extend(RejectedSale(index, sale, reason) for index, sale, _ in rows)
+
+
+def record_sales(sales, batch_size=1000, bind=None, retry=None):
+    """
+    Record many sales at once. Each batch of batch_size sales is written all-or-nothing; 
+    invalid sales are rejected individually and reported, without stopping the load. 
+    If given, retry is called with a function writing one batch, to retry it on lock contention 
+    (see sales_writer.SalesWriter). Returns a SalesLoadResult.
+    """
+    if batch_size < 1:
+        raise ValueError("batch_size must be at least 1")
+    bind = get_engine() if bind is None else bind
+    result = SalesLoadResult()
+    batch = []
+    for index, sale in enumerate(sales):
+        batch.append((index, sale))
+        if len(batch) == batch_size:
+            _write_sales_batch(bind, batch, result, retry)
+            result.batches += 1
+            batch = []
+    if batch:
+        _write_sales_batch(bind, batch, result, retry)
+        result.batches += 1
+    result.rejected.sort(key=lambda rejection: rejection.index)
+    return result
+
+
+
+### SAMPLE DATA ###
+def seed(bind=None):
+    """
+    Insert the sample offices, homes, agents, sellers, listings and buyers, and record some sales. 
+    """
+    # Before inserting data, start a session
+    session = get_session(bind)
+
+    ### DATA TO BE INSERTED ###
+    offices = [
+        Offices(name = 'SF Real Estate'),
+        Offices(name = 'London Real Estate'),
+        Offices(name = 'Nice Real Estate'),
+        Offices(name = 'Buenos Aires Real Estate')
+    ]
+
+    homes = [
+        Homes(beds=1, baths=1, address='22 Nathaniel', zipcode='94103', price_listed= 800000.00, date_listed=date(2021,9,21), month_listed=202109),
+        Homes(beds=1, baths=1, address='73A Peter St', zipcode='06000', price_listed= 400000.00, date_listed=date(2021,9,28), month_listed=202109),
+        Homes(beds=3, baths=3, address='100 Esmeralda', zipcode='24012', price_listed= 90000.00, date_listed=date(2021,9,24), month_listed=202109),
+        Homes(beds=2, baths=1.5, address='5 Rue Delille', zipcode='10009', price_listed= 100000.00, date_listed=date(2021,1,1), month_listed=202101),
+        Homes(beds=1, baths=1, address='16 Turk St', zipcode='94102', price_listed= 50000.00, date_listed=date(2021,6,12), month_listed=202106),
+        Homes(beds=1, baths=1, address='110 Market St', zipcode='94101', price_listed= 2000000.00, date_listed=date(2021,12,25), month_listed=202112),
+        Homes(beds=2, baths=2.5, address='33 Exmouth', zipcode='EC1R 4QL', price_listed= 570000.00, date_listed=date(2021,4,16), month_listed=202104, sold=True),
+        Homes(beds=3, baths=1.5, address='91 Clerkenwell Rd', zipcode='EC1R 5BX', price_listed= 200000.00, date_listed=date(2021,1,17), month_listed=202101),
+    ]
+
+    agents = [
+        Agents(office_id=1, first_name = 'Dwight', last_name='Schrute', email='dwight@estates.com'),
+        Agents(office_id=2, first_name = 'Jim', last_name='Halpert', email='jim@estates.com'),
+        Agents(office_id=3, first_name = 'Michael', last_name='Scott',  email='michael@estates.com'),
+        Agents(office_id=4, first_name = 'Pam', last_name='Beesly', email='pam@estates.com'),
+        Agents(office_id=1, first_name = 'Angela', last_name='Martin', email='angela@estates.com'),
+        Agents(office_id=1, first_name = 'Stanley', last_name='Hudson', email='stanley@estates.com'),
+        Agents(office_id=2, first_name = 'Toby', last_name='Flenderson', email='toby@estates.com'),
+        Agents(office_id=2, first_name = 'Kevin', last_name='Malone', email='kev@estates.com'),
+        Agents(office_id=3, first_name = 'Andy', last_name='Bernard', email='andy@estates.com'),
+        Agents(office_id=4, first_name = 'Erin', last_name='Hannon', email='erin@estates.com'),
+        Agents(office_id=4, first_name = 'Oscar', last_name='Martinez', email='oscar@estates.com'),
+        Agents(office_id=4, first_name = 'Phyllis', last_name='Vance', email='phylissvance@estates.com'),
+        Agents(office_id=4, first_name = 'Meredith', last_name='Palmer', email='meredith@estates.com'),
+        Agents(office_id=4, first_name = 'Kelly', last_name='Kapoor', email='kelly@estates.com'),
+        Agents(office_id=4, first_name = 'Ryan', last_name='Howard', email='ryan@estates.com')
+    ]
+
+    sellers = [
+        Sellers(first_name = 'Malia', last_name='Bird', email='mbird@gmail.com'),
+        Sellers(first_name = 'Finn', last_name='Macken', email='finnian@gmail.com'),
+        Sellers(first_name = 'Leo', last_name='Ware', email='beware@gmail.com'),
+        Sellers(first_name = 'Laura', last_name='Ruiz', email='lau@gmail.com'),
+        Sellers(first_name = 'Gal', last_name='Rubin', email='rubs@gmail.com')
+    ]
+
+    # Including edgecase where multiple listings are listed by the same agent 
+    listings = [
+        Listings(home_id=1, agent_id=1, seller_id=4),
+        Listings(home_id=2, agent_id=2, seller_id=1),
+        Listings(home_id=3, agent_id=2, seller_id=1),
+        Listings(home_id=4, agent_id=7, seller_id=1),
+        Listings(home_id=5, agent_id=8, seller_id=3),
+        Listings(home_id=6, agent_id=3, seller_id=3),
+        Listings(home_id=7, agent_id=6, seller_id=4)
+    ]
+
+    buyers = [
+        Buyers(first_name = 'Toph', last_name='Beifong', email='metal_bender@gmail.com'),
+        Buyers(first_name = 'Firelord', last_name='Ozai', email='crazy@yahoo.com'),
+        Buyers(first_name = 'Avatar', last_name='Kyoshi',  email='kyoshi@gmail.com'),
+        Buyers(first_name = 'Princess', last_name='Yue', email='moon@sky.com')
+    ]
+
+    # adding all the data defined in the lists above
+    session.add_all(offices)
+    session.add_all(homes)
+    session.add_all(agents)
+    session.add_all(sellers)
+    session.add_all(listings)
+    session.add_all(buyers)
+    # Including one old sale (won't be included in this month's sales for checking query filters)
+    old_sale = Sales(home_id=7, agent_id=13, buyer_id=1, price_sold=200000.00, date_sold=date(2022,9,21))
+    session.add(old_sale)
+    # the old sale is priced, added to the commission ledger and leaderboards, and logged to the change feed
+    # (as record_sale_changes() logs recorded sales) as it is committed (see create.py)
+    session.commit() # commit all database additions in this session
+
+    # Including purchases made by the same buyer and sold by the same agent
+    # Sold prices include price points in each commission range
+    transaction(1, 1, 2, 200000.00, bind)
+    transaction(2, 1, 1, 400000.00, bind)
+    transaction(3, 9, 2, 1100000.00, bind)
+    transaction(4, 4, 2, 2000000.00, bind)
+    transaction(5, 3, 3, 90000.00, bind)
+    transaction(6, 7, 4, 60000.00, bind)
+
+
+# Running this file fills the database with the sample data (python3 insert_data.py)
+if __name__ == '__main__':
+    seed()
@@ -0,0 +1,183 @@
+import bisect
+import collections
+import datetime
+import json
+import logging
+import re
+import threading
+import time
+from sqlalchemy import event
+
+### Query instrumentation
+# Listens to an engine's statement events instead of echoing every statement, and keeps for each distinct
+# statement (as compiled, with ? placeholders, so the same query with different values is counted together,
+# and IN lists of any length as one): the number of runs, a latency histogram, and the rows written. Past
+# max_statements distinct statements, the rest are counted together under OTHER_STATEMENTS. Statements slower than slow_threshold
+# seconds go to a bounded slow-query log, and are logged as warnings to the 'real_estate.slow_queries' logger.
+# Each distinct SELECT is explained once, the first time it runs, and its plan kept if SQLite scans a whole
+# table or index (rather than searching an index), so reports which need an index show up without checking
+# them by hand. SQLite runs a query until its first row when it is executed, so a query's time includes all of
+# an aggregate's work, but not the time spent fetching the rest of a long result.
+
+logger = logging.getLogger('real_estate.slow_queries')
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+# Statements beyond max_statements are counted under this key
+OTHER_STATEMENTS = '(other statements)'
+
+# Expanding IN parameters render one ? per value, so a query with a list of ids would count once per length
+IN_LIST = re.compile(r'IN \(\?(?:, \?)*\)')
+
+def statement_key(statement):
+    return IN_LIST.sub('IN (?, ...)', statement)
+
+def bucket_label(index):
+    if index == len(LATENCY_BUCKETS):
+        return '>{:g}ms'.format(LATENCY_BUCKETS[-1] * 1000)
+    return '<={:g}ms'.format(LATENCY_BUCKETS[index] * 1000)
+
+
+# In SQLite's EXPLAIN QUERY PLAN output, reading every row of a table or index is a "SCAN <table> [USING ... INDEX]"
+def is_full_scan(plan):
+    return any(detail.startswith('SCAN ') and detail != 'SCAN CONSTANT ROW' for detail in plan)
+
+
+class StatementStats:
+    """
+    Counters for one distinct statement.
+    """
+    def __init__(self):
+        self.count = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.rows = 0
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def __repr__(self):
+        return "<StatementStats(Count ={}, Total ={:.4f}s, Max ={:.4f}s)>".format(self.count, self.total_seconds, self.max_seconds)
+
+    def add(self, seconds, rows):
+        self.count += 1
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.rows += rows
+        self.histogram[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'total_seconds': self.total_seconds,
+            'mean_seconds': self.total_seconds / self.count if self.count else 0.0,
+            'max_seconds': self.max_seconds,
+            'rows': self.rows,
+            'histogram': {bucket_label(index): count for index, count in enumerate(self.histogram) if count},
+        }
+
+
+class Instrumentation:
+    """
+    Statement timings, slow queries and full-scan query plans for every engine attached with attach().
+    Safe to share between threads.
+    """
+    def __init__(self, slow_threshold=0.1, max_slow_queries=100, explain_full_scans=True, max_statements=1000):
+        self.slow_threshold = slow_threshold
+        self.max_statements = max_statements
+        self.explain_full_scans = explain_full_scans
+        self.statements = collections.defaultdict(StatementStats)
+        self.slow_queries = collections.deque(maxlen=max_slow_queries)
+        self.full_scans = {} # statement key -> plan
+        self._explained = set() # statement keys, at most max_statements
+        self._engines = []
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<Instrumentation(Statements ={}, Slow ={}, Full scans ={})>".format(len(self.statements), len(self.slow_queries), len(self.full_scans))
+
+    def attach(self, engine):
+        event.listen(engine, 'before_cursor_execute', self._before_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_execute)
+        event.listen(engine, 'handle_error', self._handle_error)
+        self._engines.append(engine)
+        return self
+
+    def detach(self):
+        for engine in self._engines:
+            event.remove(engine, 'before_cursor_execute', self._before_execute)
+            event.remove(engine, 'after_cursor_execute', self._after_execute)
+            event.remove(engine, 'handle_error', self._handle_error)
+        self._engines = []
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    def _handle_error(self, exception_context):
+        if exception_context.connection is not None:
+            starts = exception_context.connection.info.get('query_start')
+            if starts:
+                starts.pop()
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - conn.info['query_start'].pop()
+        # the driver only counts rows for writes, and reports -1 for queries
+        rows = max(cursor.rowcount, 0)
+        key = statement_key(statement)
+        with self._lock:
+            if key not in self.statements and len(self.statements) >= self.max_statements:
+                self.statements[OTHER_STATEMENTS].add(seconds, rows)
+            else:
+                self.statements[key].add(seconds, rows)
+            if seconds >= self.slow_threshold:
+                self.slow_queries.append({
+                    'timestamp': datetime.datetime.now().isoformat(timespec='milliseconds'),
+                    'statement': statement,
+                    'parameters': repr(parameters)[:200],
+                    'seconds': seconds,
+                })
+            explain = self.explain_full_scans and not executemany and key not in self._explained and \
+                len(self._explained) < self.max_statements and statement.lstrip().upper().startswith(('SELECT', 'WITH'))
+            if explain:
+                self._explained.add(key)
+        if seconds >= self.slow_threshold:
+            logger.warning('slow query (%.3f s): %s', seconds, statement)
+        if explain:
+            self._explain(conn, key, statement, parameters)
+
+    def _explain(self, conn, key, statement, parameters):
+        cursor = conn.connection.cursor()
+        try:
+            cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+            plan = [row[-1] for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+        if is_full_scan(plan):
+            with self._lock:
+                self.full_scans[key] = plan
+
+    def reset(self):
+        with self._lock:
+            self.statements.clear()
+            self.slow_queries.clear()
+            self.full_scans.clear()
+            self._explained.clear()
+
+    def snapshot(self):
+        """
+        Everything collected so far, as a dictionary of plain values: statements (slowest in total first),
+        slow queries (oldest first) and full scans.
+        """
+        with self._lock:
+            statements = sorted(self.statements.items(), key=lambda item: item[1].total_seconds, reverse=True)
+            return {
+                'slow_threshold': self.slow_threshold,
+                'statements': [dict(statement=statement, **stats.as_dict()) for statement, stats in statements],
+                'slow_queries': list(self.slow_queries),
+                'full_scans': [{'statement': statement, 'plan': plan} for statement, plan in self.full_scans.items()],
+            }
+
+    def export_json(self, file):
+        """
+        Write snapshot() to a file as JSON, for monitoring.
+        """
+        json.dump(self.snapshot(), file, indent=2)
@@ -0,0 +1,213 @@
+import heapq
+import math
+import threading
+from collections import namedtuple
+from sqlalchemy import select, func
+from sqlalchemy.exc import SQLAlchemyError
+from create import Offices, Agents, Commission, OfficeMonthlySales, AgentMonthlySales, SaleChanges, CHANGE_SALE, get_engine
+from query_data import current_month
+
+### Real-time leaderboards
+# The sales-floor screens ask for the top agents and offices of the month many times a second. A Leaderboards
+# keeps every agent's and office's totals for the month in memory, so those questions are answered without a
+# query: it is seeded once from the monthly leaderboard tables and commission ledger, then kept up to date
+# from the sales change feed (see create.SaleChanges), which logs every sale recorded, by any process.
+# Following the current month, it starts again from the database's totals for the new month when the month
+# changes; sales recorded for other months (backdated sales) don't count. reconcile() compares its totals with
+# the database and adopts the database's, in case the two have drifted (for example, after a rebuild).
+
+# Totals kept for each agent and office, by position in their lists
+METRICS = ('sale_count', 'sale_volume', 'commission_amount')
+
+AgentStanding = namedtuple('AgentStanding', ['first_name', 'last_name', 'total', 'email'])
+OfficeStanding = namedtuple('OfficeStanding', ['name', 'total'])
+
+# Totals read from the database, and the last change they include
+_Totals = namedtuple('_Totals', ['month', 'position', 'agents', 'offices'])
+
+
+def _read_totals(bind, month):
+    with bind.connect() as conn:
+        # one read transaction, so the totals and the change feed position agree
+        conn.exec_driver_sql('BEGIN')
+        try:
+            position = conn.execute(select(func.max(SaleChanges.change_id))).scalar() or 0
+            agents, offices = {}, {}
+            for agent_id, count, volume in conn.execute(
+                    select(AgentMonthlySales.agent_id, AgentMonthlySales.sale_count, AgentMonthlySales.sale_volume).
+                    where(AgentMonthlySales.month == month)):
+                agents[agent_id] = [count or 0, volume or 0.0, 0.0]
+            for office_id, count, volume in conn.execute(
+                    select(OfficeMonthlySales.office_id, OfficeMonthlySales.sale_count, OfficeMonthlySales.sale_volume).
+                    where(OfficeMonthlySales.month == month)):
+                offices[office_id] = [count or 0, volume or 0.0, 0.0]
+            for agent_id, office_id, commission in conn.execute(
+                    select(Commission.agent_id, Agents.office_id, Commission.commission_amount).
+                    join(Agents, Commission.agent_id == Agents.agent_id, isouter=True).
+                    where(Commission.month == month)):
+                agents.setdefault(agent_id, [0, 0.0, 0.0])[2] += commission or 0.0
+                if office_id is not None:
+                    offices.setdefault(office_id, [0, 0.0, 0.0])[2] += commission or 0.0
+        finally:
+            conn.exec_driver_sql('ROLLBACK')
+    return _Totals(month, position, agents, offices)
+
+
+class Leaderboards:
+    """
+    In-memory totals of the sales of every agent and office in a month (by default, following the current
+    month), answering the top agents and offices by sale_count, sale_volume or commission_amount. Call update()
+    to apply the sales recorded since, or start() to do so in the background. Safe to share between threads.
+    """
+    def __init__(self, bind=None, month=None, batch_size=1000):
+        self.bind = get_engine() if bind is None else bind
+        self.follow = month is None
+        self.batch_size = batch_size
+        self.last_error = None
+        self._lock = threading.Lock() # held briefly, to change or read the totals
+        self._update_lock = threading.Lock() # held by the one thread updating from the database
+        self._stopping = None
+        self._thread = None
+        self._names()
+        self._adopt(_read_totals(self.bind, current_month() if month is None else month))
+
+    def __repr__(self):
+        return "<Leaderboards(Month ={}, Position ={}, Agents ={}, Offices ={})>".format(self.month, self.position, len(self._agents), len(self._offices))
+
+    def _names(self):
+        # agents' offices and names, and office names: re-read when a sale by an agent not seen yet comes in
+        with self.bind.connect() as conn:
+            agents = {row.agent_id: row for row in conn.execute(select(Agents.agent_id, Agents.office_id, Agents.first_name, Agents.last_name, Agents.email))}
+            offices = dict(conn.execute(select(Offices.office_id, Offices.name)).all())
+        with self._lock:
+            self._agent_names, self._office_names = agents, offices
+
+    def _adopt(self, totals):
+        with self._lock:
+            self.month, self.position = totals.month, totals.position
+            self._agents, self._offices = totals.agents, totals.offices
+            self._top = {}
+
+    def _apply(self, changes):
+        with self._lock:
+            for change in changes:
+                self.position = change.change_id
+                if change.kind != CHANGE_SALE or change.month_sold != self.month:
+                    continue
+                increments = (1, change.price_sold or 0.0, change.commission or 0.0)
+                agent = self._agent_names.get(change.agent_id)
+                boards = [(self._agents, change.agent_id)]
+                if agent is not None and agent.office_id is not None:
+                    boards.append((self._offices, agent.office_id))
+                for board, key in boards:
+                    totals = board.setdefault(key, [0, 0.0, 0.0])
+                    for index, increment in enumerate(increments):
+                        totals[index] += increment
+            self._top = {}
+
+    def _catch_up(self, until=None):
+        applied = 0
+        while until is None or self.position < until:
+            query = select(SaleChanges).where(SaleChanges.change_id > self.position)
+            if until is not None:
+                query = query.where(SaleChanges.change_id <= until)
+            with self.bind.connect() as conn:
+                changes = conn.execute(query.order_by(SaleChanges.change_id).limit(self.batch_size)).all()
+            if not changes:
+                break
+            if changes[0].change_id != self.position + 1:
+                # the changes in between were compacted away before they were read
+                self._adopt(_read_totals(self.bind, self.month))
+                continue
+            if any(change.agent_id not in self._agent_names for change in changes if change.kind == CHANGE_SALE):
+                self._names()
+            self._apply(changes)
+            applied += len(changes)
+        return applied
+
+    def update(self):
+        """
+        Apply the sales recorded since the last update, starting again from the database's totals if the
+        current month has changed. Returns the number of changes read.
+        """
+        with self._update_lock:
+            if self.follow and current_month() != self.month:
+                self._adopt(_read_totals(self.bind, current_month()))
+            return self._catch_up()
+
+    def reconcile(self):
+        """
+        Compare the totals with the database's, and adopt the database's. Returns a list of
+        ('agents' or 'offices', ID, totals in memory, totals in the database) for each that disagreed.
+        """
+        with self._update_lock:
+            database = _read_totals(self.bind, self.month)
+            self._catch_up(until=database.position)
+            mismatches = []
+            with self._lock:
+                for name, memory, stored in [('agents', self._agents, database.agents), ('offices', self._offices, database.offices)]:
+                    for key in sorted(set(memory) | set(stored)):
+                        memory_totals, stored_totals = memory.get(key, [0, 0.0, 0.0]), stored.get(key, [0, 0.0, 0.0])
+                        if not all(math.isclose(a, b, abs_tol=1e-6) for a, b in zip(memory_totals, stored_totals)):
+                            mismatches.append((name, key, tuple(memory_totals), tuple(stored_totals)))
+            self._adopt(database)
+        return mismatches
+
+    ### Top agents and offices
+    def _ranked(self, board, by, limit):
+        index = METRICS.index(by)
+        with self._lock:
+            cached = self._top.get((board, by, limit))
+            if cached is None:
+                totals = self._agents if board == 'agents' else self._offices
+                # highest total first, and the lowest ID first among equal totals
+                cached = self._top[(board, by, limit)] = [(key, entry[index]) for key, entry in
+                                                          heapq.nsmallest(limit, totals.items(), key=lambda item: (-item[1][index], item[0]))]
+            return cached
+
+    def top_agents(self, limit=5, by='sale_volume'):
+        """
+        The agents with the highest totals this month, as query_data.top_agents() lists them.
+        """
+        names = self._agent_names
+        return [AgentStanding(names[key].first_name, names[key].last_name, total, names[key].email) if key in names else AgentStanding(None, None, total, None)
+                for key, total in self._ranked('agents', by, limit)]
+
+    def top_offices(self, limit=5, by='sale_count'):
+        """
+        The offices with the highest totals this month, as query_data.top_office_sale_counts() lists them.
+        """
+        return [OfficeStanding(self._office_names.get(key), total) for key, total in self._ranked('offices', by, limit)]
+
+    ### Background updates
+    def start(self, interval=1.0, reconcile_interval=300):
+        """
+        Update every interval seconds, and reconcile every reconcile_interval seconds, in a background thread
+        until stop(). Errors are kept in last_error, and the next update is still attempted.
+        """
+        if self._thread is not None:
+            return
+        self._stopping = threading.Event()
+
+        def run():
+            waited = 0.0
+            while not self._stopping.wait(interval):
+                waited += interval
+                try:
+                    if waited >= reconcile_interval:
+                        waited = 0.0
+                        self.reconcile()
+                    else:
+                        self.update()
+                    self.last_error = None
+                except SQLAlchemyError as error:
+                    self.last_error = error
+
+        self._thread = threading.Thread(target=run, name='leaderboards', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopping.set()
+            self._thread.join()
+            self._thread = None
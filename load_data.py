@@ -0,0 +1,178 @@
+import argparse
+import csv
+import datetime
+import sys
+import time
+from collections import namedtuple
+from sqlalchemy import create_engine, select, insert
+from sqlalchemy.exc import SQLAlchemyError
+from create import Offices, Agents, Sellers, Buyers, Homes, Listings, get_engine, init_db, bump_write_versions
+
+### Bulk CSV loader for the reference tables
+# Reads a CSV file a batch at a time and writes each batch with one Core executemany INSERT, instead of
+# building ORM objects. Rows refer to other tables by natural key (an office by name, an agent or seller by
+# email, a home by address and zipcode), which are resolved to IDs through lookups read once per load.
+# Rows whose own natural key is already in the database (or earlier in the file) are rejected as duplicates,
+# so loading the same file twice doesn't duplicate anything. Load them in order: offices, agents, sellers,
+# buyers, homes and then listings.
+
+def _text(value):
+    return value.strip() or None
+
+def _date(value):
+    return datetime.datetime.fromisoformat(value.strip())
+
+# A column of a referenced table found from the natural key in some CSV fields
+Reference = namedtuple('Reference', ['column', 'fields', 'key_columns', 'id_column'])
+
+# A table loadable from CSV: the CSV fields and how to convert them, the fields of its natural key,
+# and its references. Empty fields are left out of the row (so the column gets its default).
+CsvTable = namedtuple('CsvTable', ['table', 'fields', 'key', 'references'])
+
+PEOPLE_FIELDS = {'first_name': _text, 'last_name': _text, 'email': _text}
+
+CSV_TABLES = {
+    'offices': CsvTable(Offices, {'name': _text}, ('name',), []),
+    'agents': CsvTable(Agents, PEOPLE_FIELDS, ('email',), [
+        Reference('office_id', ('office',), (Offices.name,), Offices.office_id),
+    ]),
+    'sellers': CsvTable(Sellers, PEOPLE_FIELDS, ('email',), []),
+    'buyers': CsvTable(Buyers, PEOPLE_FIELDS, ('email',), []),
+    'homes': CsvTable(Homes, {'address': _text, 'zipcode': _text, 'beds': int, 'baths': float, 'price_listed': float, 'date_listed': _date},
+                      ('address', 'zipcode'), []),
+    'listings': CsvTable(Listings, {}, (), [
+        Reference('home_id', ('address', 'zipcode'), (Homes.address, Homes.zipcode), Homes.home_id),
+        Reference('agent_id', ('agent_email',), (Agents.email,), Agents.agent_id),
+        Reference('seller_id', ('seller_email',), (Sellers.email,), Sellers.seller_id),
+    ]),
+}
+
+# A row that was not loaded, with its line in the CSV file and the reason it was rejected
+RejectedRow = namedtuple('RejectedRow', ['line', 'row', 'reason'])
+
+class CsvLoadResult:
+    """
+    Summary of a load_csv() run: how many rows were loaded, how fast, and which were rejected.
+    """
+    def __init__(self, table):
+        self.table = table
+        self.loaded = 0
+        self.batches = 0
+        self.rejected = []
+        self.seconds = 0.0
+
+    def __repr__(self):
+        return "<CsvLoadResult(Table={}, Loaded={}, Rejected={}, Rows/s={:.0f})>".format(self.table, self.loaded, len(self.rejected), self.rows_per_second())
+
+    def rows_per_second(self):
+        return (self.loaded + len(self.rejected)) / self.seconds if self.seconds else 0.0
+
+
+# Natural keys (as tuples of text) of a table, mapped to its IDs: one query for the whole load
+def _lookup(conn, key_columns, id_column):
+    return {tuple(row[:-1]): row[-1] for row in conn.execute(select(*key_columns, id_column))}
+
+def _key(row, fields):
+    return tuple(_text(row.get(field) or '') for field in fields)
+
+
+def _convert(spec, row, lookups, seen):
+    values = {}
+    for field, convert in spec.fields.items():
+        value = (row.get(field) or '').strip()
+        if value:
+            try:
+                values[field] = convert(value)
+            except ValueError:
+                raise ValueError("invalid {} {!r}".format(field, value))
+    for reference in spec.references:
+        key = _key(row, reference.fields)
+        if None in key:
+            raise ValueError("missing {}".format(", ".join(field for field, part in zip(reference.fields, key) if part is None)))
+        if key not in lookups[reference.column]:
+            raise ValueError("unknown {} {}".format(reference.column[:-3], ", ".join(key)))
+        values[reference.column] = lookups[reference.column][key]
+    if spec.key:
+        key = _key(row, spec.key)
+        if None not in key:
+            if key in seen:
+                raise ValueError("duplicate {}".format(", ".join(key)))
+            seen.add(key)
+    return values
+
+
+def _write_batch(bind, spec, batch, result):
+    # executemany needs the same columns in every row, so group rows by the fields they have
+    groups = {}
+    for _, _, values in batch:
+        groups.setdefault(tuple(sorted(values)), []).append(values)
+    try:
+        with bind.begin() as conn:
+            for rows in groups.values():
+                conn.execute(insert(spec.table), rows)
+            bump_write_versions(conn, [spec.table])
+        result.loaded += len(batch)
+    except SQLAlchemyError as error:
+        reason = "batch rolled back: {}".format(error.__class__.__name__)
+        result.rejected.extend(RejectedRow(line, row, reason) for line, row, _ in batch)
+    result.batches += 1
+
+
+def load_csv(table, file, batch_size=5000, bind=None):
+    """
+    Load a CSV file (a path or an open file, with a header row) into one of the CSV_TABLES. Each batch of
+    batch_size rows is written all-or-nothing; invalid rows are rejected individually and reported, without
+    stopping the load. Returns a CsvLoadResult.
+    """
+    spec = CSV_TABLES[table]
+    bind = get_engine() if bind is None else bind
+    result = CsvLoadResult(table)
+    start = time.perf_counter()
+    with bind.connect() as conn:
+        lookups = {reference.column: _lookup(conn, reference.key_columns, reference.id_column) for reference in spec.references}
+        seen = {tuple(row) for row in conn.execute(select(*[getattr(spec.table, field) for field in spec.key]))} if spec.key else set()
+
+    opened = open(file, newline='') if isinstance(file, str) else None
+    try:
+        reader = csv.DictReader(opened or file)
+        batch = []
+        for row in reader:
+            try:
+                batch.append((reader.line_num, row, _convert(spec, row, lookups, seen)))
+            except ValueError as error:
+                result.rejected.append(RejectedRow(reader.line_num, row, str(error)))
+            if len(batch) == batch_size:
+                _write_batch(bind, spec, batch, result)
+                batch = []
+        if batch:
+            _write_batch(bind, spec, batch, result)
+    finally:
+        if opened is not None:
+            opened.close()
+    result.seconds = time.perf_counter() - start
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load CSV files into the reference tables, in the order given')
+    parser.add_argument('files', nargs='+', metavar='TABLE=FILE', help='one of {}, and its CSV file'.format(', '.join(CSV_TABLES)))
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--url', help='database to load into (by default, the configured database)')
+    parser.add_argument('--show-rejected', type=int, default=10, help='rejected rows to print for each file')
+    args = parser.parse_args()
+
+    loads = [argument.split('=', 1) for argument in args.files]
+    for load in loads:
+        if len(load) != 2 or load[0] not in CSV_TABLES:
+            parser.error('expected TABLE=FILE with TABLE one of {}, got {}'.format(', '.join(CSV_TABLES), '='.join(load)))
+
+    bind = None
+    if args.url:
+        bind = create_engine(args.url)
+        init_db(bind)
+    for table, path in loads:
+        result = load_csv(table, path, args.batch_size, bind)
+        print('{}: {} loaded, {} rejected, in {:.2f} s ({:.0f} rows/s)'.format(
+            table, result.loaded, len(result.rejected), result.seconds, result.rows_per_second()))
+        for rejected in result.rejected[:args.show_rejected]:
+            print('  line {}: {}'.format(rejected.line, rejected.reason), file=sys.stderr)
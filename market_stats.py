@@ -0,0 +1,159 @@
+import argparse
+import math
+import sys
+from sqlalchemy import select, func, Integer
+from create import Offices, Agents, Homes, sale_days_on_market, get_engine
+from query_data import sales_source, sales_in_period, current_month, rolling_days
+
+### Days-on-market statistics
+# The mean, median, 90th percentile and histogram of the days homes spent on the market, by month, office or
+# zipcode. SQLite does the pass over the sales: it counts the sales of each group by whole day on the market
+# (the days stored with each sale, or worked out from its home's listing date, as query_data.days_on_market
+# does), so only one row per group and day comes back, however many sales there are. Each group's counts
+# make a DaysHistogram, with one bin per day holding its number of sales and their total days: the mean is
+# exact, and percentiles are interpolated (as numpy.percentile does) between the mean days of the bins they
+# fall in, so they are exact for whole days and never more than a day out otherwise. Histograms are small
+# and can be merged, to combine groups (like the months of a quarter) without reading the sales again.
+
+# The column each grouping is read from, and the tables to join to reach it from a sale (joined to its home)
+GROUPINGS = {
+    'month': lambda sales: (sales.month_sold, []),
+    'office': lambda sales: (Offices.name, [(Agents, sales.agent_id == Agents.agent_id), (Offices, Agents.office_id == Offices.office_id)]),
+    'zipcode': lambda sales: (Homes.zipcode, []),
+}
+
+
+class DaysHistogram:
+    """
+    The number of sales, and their total days, by whole day on the market.
+    Days below zero (sales dated before their listing) are counted in day 0.
+    """
+    def __init__(self):
+        self.counts = {}
+        self.totals = {}
+        self.count = 0
+        self.total = 0.0
+
+    def __repr__(self):
+        return "<DaysHistogram(Sales ={}, Mean ={}, Median ={})>".format(self.count, self.mean(), self.median())
+
+    def add(self, days, count=1, total=None):
+        """
+        Count sales on the market for days (a sale, or count sales of that whole day totalling total days).
+        """
+        day = max(int(math.floor(days)), 0)
+        total = days * count if total is None else total
+        self.counts[day] = self.counts.get(day, 0) + count
+        self.totals[day] = self.totals.get(day, 0.0) + total
+        self.count += count
+        self.total += total
+
+    def merge(self, other):
+        for day, count in other.counts.items():
+            self.counts[day] = self.counts.get(day, 0) + count
+            self.totals[day] = self.totals.get(day, 0.0) + other.totals[day]
+        self.count += other.count
+        self.total += other.total
+        return self
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def percentile(self, percent):
+        """
+        The days on the market below which percent of the sales fall, taking each sale's days as the mean
+        of its day's bin and interpolating between the closest ranks.
+        """
+        if not self.count:
+            return None
+        position = (self.count - 1) * percent / 100
+        lower = math.floor(position)
+        ranks = [lower, min(lower + 1, self.count - 1)]
+        values = []
+        seen = 0
+        for day in sorted(self.counts):
+            seen += self.counts[day]
+            while ranks and ranks[0] < seen:
+                values.append(self.totals[day] / self.counts[day])
+                ranks.pop(0)
+            if not ranks:
+                break
+        return values[0] + (values[1] - values[0]) * (position - lower)
+
+    def median(self):
+        return self.percentile(50)
+
+    def histogram(self, width=7):
+        """
+        The number of sales in each bin of width days, as a list of (first day of the bin, sales), from day 0.
+        """
+        if not self.count:
+            return []
+        bins = [0] * (max(self.counts) // width + 1)
+        for day, count in self.counts.items():
+            bins[day // width] += count
+        return [(index * width, count) for index, count in enumerate(bins)]
+
+    def as_dict(self, width=7):
+        return {
+            'count': self.count,
+            'mean': self.mean(),
+            'median': self.median(),
+            'p90': self.percentile(90),
+            'histogram': self.histogram(width),
+        }
+
+
+def days_on_market_stats(by='month', period=None, history=False, bind=None):
+    """
+    A DaysHistogram of the days on the market of the sales in each month, office or zipcode (by), for a month
+    key or period (or every sale), including the archived sales with history. Returns a dictionary of group to
+    DaysHistogram. Sales without days on the market (homes without a listing date) aren't counted.
+    """
+    if by not in GROUPINGS:
+        raise ValueError('Unknown grouping {!r}, expected one of {}'.format(by, ', '.join(GROUPINGS)))
+    bind = get_engine() if bind is None else bind
+    sales = sales_source(history)
+    group, joins = GROUPINGS[by](sales)
+    days = sale_days_on_market(sales)
+    day = func.cast(days, Integer)
+    query = select(group, day, func.count(), func.sum(days)).select_from(sales).join(Homes, sales.home_id == Homes.home_id)
+    for table, on in joins:
+        query = query.join(table, on)
+    query = query.where(days.isnot(None))
+    if period is not None:
+        query = query.where(sales_in_period(period, sales))
+    query = query.group_by(group, day)
+
+    histograms = {}
+    with bind.connect() as conn:
+        for key, whole_days, count, total in conn.execution_options(stream_results=True).execute(query):
+            # whole_days is truncated towards zero, which only differs from the floor below zero (day 0 anyway)
+            histograms.setdefault(key, DaysHistogram()).add(whole_days, count, total)
+    return histograms
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Days on the market by month, office or zipcode')
+    parser.add_argument('--by', choices=list(GROUPINGS), default='office')
+    period = parser.add_mutually_exclusive_group()
+    period.add_argument('--month', type=int, help='month key, like 202206 (by default, the current month)')
+    period.add_argument('--days', type=int, help='the last number of days')
+    period.add_argument('--all', action='store_true', help='every sale')
+    parser.add_argument('--history', action='store_true', help='include the sales of archived months')
+    args = parser.parse_args()
+
+    if args.all:
+        period = None
+    elif args.days:
+        period = rolling_days(args.days)
+    else:
+        period = args.month or current_month()
+
+    try:
+        print('{:<32} {:>8} {:>8} {:>8} {:>8}'.format(args.by, 'sales', 'mean', 'median', 'p90'))
+        for key, histogram in sorted(days_on_market_stats(args.by, period, args.history).items(), key=lambda item: str(item[0])):
+            print('{:<32} {:8} {:8.1f} {:8.1f} {:8.1f}'.format(str(key), histogram.count, histogram.mean(), histogram.median(), histogram.percentile(90)))
+    except BrokenPipeError:
+        # the tool reading stdout (like head) stopped early, which is fine
+        sys.stdout = None
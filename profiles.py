@@ -0,0 +1,52 @@
+from sqlalchemy.orm import selectinload
+from create import Offices, Agents, Listings, Sales
+
+### Office and agent profiles
+# The relationships between offices, agents, listings, sales and homes are loaded lazily: reading agent.sales
+# runs a query the first time, so a page showing every agent of an office with their listings and sales runs
+# two queries per agent, plus one per home. Profiles load everything the page shows up front instead: the
+# agents, listings and sales of a whole batch of agents at once (SELECT ... WHERE agent_id IN (...), through
+# selectinload), with the home of each listing and sale joined into the same query. An office profile takes
+# four queries however many agents it has (SQLAlchemy sends the IDs 500 at a time, so one more of each per
+# 500 agents beyond the first).
+
+# Loader options for an agent's listings and sales, and their homes
+AGENT_PROFILE = [
+    selectinload(Agents.listings).joinedload(Listings.home),
+    selectinload(Agents.sales).joinedload(Sales.home),
+]
+
+def office_profile(session, office_id):
+    """
+    An office, with its agents and their listings and sales (and their homes) loaded. None if there is no such office.
+    """
+    return session.query(Offices).\
+        options(selectinload(Offices.agents).options(*AGENT_PROFILE)).\
+        filter(Offices.office_id == office_id).\
+        one_or_none()
+
+
+def agent_profiles(session, agent_ids):
+    """
+    The agents with the given IDs, in ID order, with their listings and sales (and their homes) loaded.
+    """
+    return session.query(Agents).\
+        options(*AGENT_PROFILE).\
+        filter(Agents.agent_id.in_(list(agent_ids))).\
+        order_by(Agents.agent_id).\
+        all()
+
+
+def profile_dict(agent):
+    """
+    An agent's profile as a dictionary, for a page: the agent, and their listings and sales with the home of each.
+    """
+    return {
+        'agent_id': agent.agent_id,
+        'name': ' '.join(part for part in (agent.first_name, agent.last_name) if part),
+        'email': agent.email,
+        'listings': [{'listing_id': listing.listing_id, 'home_id': listing.home_id,
+                      'address': listing.home.address if listing.home else None} for listing in agent.listings],
+        'sales': [{'sale_id': sale.sale_id, 'home_id': sale.home_id, 'address': sale.home.address if sale.home else None,
+                   'price_sold': sale.price_sold, 'date_sold': sale.date_sold} for sale in agent.sales],
+    }
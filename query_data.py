@@ -1,192 +1,406 @@
-from create import Offices, Homes, Agents, Listings, Buyers, Sellers, Sales, Commission, engine, Base
+from create import Offices, Homes, Agents, Listings, Buyers, Sellers, Sales, Commission, OfficeMonthlySales, AgentMonthlySales, SalesHistory, Base, get_engine, get_session, \
+    month_key, sale_days_on_market, verify_report_indexes, check_monthly_sales, get_instrumentation, REPORT_INDEXES, PERIOD_REPORT_INDEX
 import datetime
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy import func, insert
-from sqlalchemy.schema import Index
-
-# Start the session to query data into the database
-Session = sessionmaker(bind=engine)
-session = Session()
-
-# Used to print results more legibly
+import os
+import sys
+from collections import namedtuple
+from sqlalchemy import func, and_
+from sqlalchemy.orm import aliased
+from report_snapshots import SnapshotManager
+
+# Used to print results more legibly, one row at a time as they are read
 def print_result(outputs):
-    for output in outputs:
+    for output in stream(outputs):
         print(output)
 
+# Key for the current month, in the same format as Sales.month_sold
+def current_month():
+    return month_key(datetime.date.today())
+
+
+### REPORTING PERIODS
+# Reports take either a month key (like 202201) or a Period: a range of days from start up to, but not 
+# including, end. Periods made of whole months are read from the month keys and monthly summary tables,
+# other periods (like the last 30 days) from Sales.date_sold. Both are index range scans.
+Period = namedtuple('Period', ['start', 'end'])
+
+def _first_of_next_month(day):
+    return datetime.date(day.year + day.month // 12, day.month % 12 + 1, 1)
+
+def month_period(year, month, last_month=None):
+    """A single month, or every month from month up to last_month (as month keys, in the same year or later)."""
+    start = datetime.date(year, month, 1)
+    last = start if last_month is None else datetime.date(last_month // 100, last_month % 100, 1)
+    return Period(start, _first_of_next_month(last))
+
+def quarter_period(year, quarter):
+    first_month = 3 * (quarter - 1) + 1
+    return month_period(year, first_month, year * 100 + first_month + 2)
+
+def year_to_date(today=None):
+    today = today or datetime.date.today()
+    return Period(datetime.date(today.year, 1, 1), today + datetime.timedelta(days=1))
+
+def rolling_days(days, today=None):
+    """The last number of days, including today."""
+    today = today or datetime.date.today()
+    return Period(today - datetime.timedelta(days=days - 1), today + datetime.timedelta(days=1))
+
+# The first and last month keys of a month key or a period of whole months, or None for other periods
+def period_months(period):
+    if isinstance(period, int):
+        return period, period
+    if period.start.day == 1 and period.end.day == 1:
+        return month_key(period.start), month_key(period.end - datetime.timedelta(days=1))
+    return None
+
+# Filter a month key column to the months of a month key or whole-month period
+def in_months(column, months):
+    first, last = months
+    return column == first if first == last else column.between(first, last)
+
+# Filter sales (or sales_source(history)) to the ones made in a month key or period
+def sales_in_period(period, sales=Sales):
+    months = period_months(period)
+    if months is not None:
+        return in_months(sales.month_sold, months)
+    return and_(sales.date_sold >= datetime.datetime.combine(period.start, datetime.time()),
+                sales.date_sold < datetime.datetime.combine(period.end, datetime.time()))
+
+### HISTORY
+# Sales of closed months may have been moved to the archive tables (see archive.py). The reports below read the
+# sales table, unless they are asked for history: then they read the sales_history view of every sale, archived
+# or not. Whole months of questions 1-3 are read from the summary tables, which keep archived months anyway.
+def sales_source(history=False):
+    return aliased(Sales, SalesHistory, adapt_on_names=True) if history else Sales
+
 
 ### QUESTION 1: Find the top 5 offices with the most sales for that month
-Index('idx_offices_agents', Agents.agent_id, Agents.office_id) # composite index to group agents by office
+# Whole months are read from the monthly leaderboard tables, which are kept up to date as sales are recorded 
+# (see create.record_sale_summaries), so the cost depends on the number of offices and not on the sales history.
+# Other periods are aggregated from the sales made in the period.
+def _top_offices(session, period, leaderboard_total, sales_total, label, history=False):
+    months = period_months(period)
+    if months is None:
+        sales = sales_source(history)
+        total = sales_total(sales)
+        query = session.query(Offices.name, total.label(label)).\
+            select_from(sales).\
+            join(Agents, sales.agent_id == Agents.agent_id).\
+            join(Offices, Agents.office_id == Offices.office_id).\
+            filter(sales_in_period(period, sales)).\
+            group_by(Offices.office_id)
+    else:
+        total = func.sum(leaderboard_total)
+        query = session.query(Offices.name, total.label(label)).\
+            join(Offices, OfficeMonthlySales.office_id == Offices.office_id).\
+            filter(in_months(OfficeMonthlySales.month, months)).\
+            group_by(OfficeMonthlySales.office_id)
+    # the lowest office ID first among equal totals, as in leaderboards.Leaderboards
+    return query.order_by(total.desc(), Offices.office_id).limit(5)
+
 # Top sales by number of sales made (ignoring price of sale)
-top_office_sale_counts = session.query(
-    Offices.name, func.count(Sales.sale_id)
-    ).\
-        join(Agents, Sales.agent_id == Agents.agent_id).\
-        join(Offices, Agents.office_id == Offices.office_id).\
-        group_by(Offices.office_id).\
-        order_by(func.count(Sales.sale_id).desc()).\
-        limit(5)
-
-print('Question 1 (part 1): Top 5 offices this month, by number of sales:')
-print_result(top_office_sale_counts)
-print('--------------------------\n')
+def top_office_sale_counts(session, period, history=False):
+    return _top_offices(session, period, OfficeMonthlySales.sale_count, lambda sales: func.count(sales.sale_id), 'sale_count', history)
 
 # Top sales by account of all sales (highlighting magnitude of sales made)
-top_office_sale_amount = session.query(
-    Offices.name, func.sum(Sales.price_sold)
-    ).\
-        join(Agents, Sales.agent_id == Agents.agent_id).\
-        join(Offices, Agents.office_id == Offices.office_id).\
-        group_by(Offices.office_id).\
-        order_by(func.sum(Sales.price_sold).desc()).\
-        limit(5)
-
-print('Question 1 (part 2): Top 5 offices this month, by amount earned:')
-print_result(top_office_sale_amount)
-print('--------------------------\n')
+def top_office_sale_amount(session, period, history=False):
+    return _top_offices(session, period, OfficeMonthlySales.sale_volume, lambda sales: func.sum(sales.price_sold), 'sale_volume', history)
 
 ### QUESTION 1 SANITY CHECK ###
-# This wouldn't be included for the real estate company's summary information 
+# This wouldn't be included for the real estate company's summary information
 # and would be too large an output with reallife data (imagine hundreds of sales)
-# However, it is useful to check our results from above for the purpose of this assignment. 
-validate_top_offices = session.query(
-    Offices.name, Sales.sale_id, Sales.price_sold, Agents.agent_id, Agents.office_id
-    ).\
-        join(Agents, Offices.office_id == Agents.office_id).\
-        join(Sales, Agents.agent_id == Sales.agent_id).\
-        order_by(Agents.office_id).\
-        all()
-
-print('Expanding all office sales data to check question 1:')
-print_result(validate_top_offices)
-print('==========================\n')
+# However, it is useful to check our results from above for the purpose of this assignment.
+def validate_top_offices(session, history=False):
+    sales = sales_source(history)
+    return session.query(
+        Offices.name, sales.sale_id, sales.price_sold, Agents.agent_id, Agents.office_id
+        ).\
+            join(Agents, Offices.office_id == Agents.office_id).\
+            join(sales, Agents.agent_id == sales.agent_id).\
+            order_by(Agents.office_id)
 
 
 ### QUESTION 2: Find the top 5 estate agents who have sold the most for the month
-Index('idx_agent_groups', Sales.agent_id) # index to group same agents together 
-top_agents= session.query(
-    Agents.first_name, Agents.last_name, func.sum(Sales.price_sold), Agents.email
-    ).\
-        join(Agents, Sales.agent_id == Agents.agent_id).\
-        group_by(Agents.agent_id).\
-        order_by(func.sum(Sales.price_sold).desc()).\
-        limit(5)
-
-print('Question 2: Top 5 agents this month, by their total amount in sales:')
-print_result(top_agents)
-print('--------------------------\n')
+# Also read from the agent monthly leaderboard table for whole months
+def top_agents(session, period, history=False):
+    months = period_months(period)
+    if months is None:
+        sales = sales_source(history)
+        total = func.sum(sales.price_sold)
+        query = session.query(Agents.first_name, Agents.last_name, total.label('sale_volume'), Agents.email).\
+            select_from(sales).\
+            join(Agents, sales.agent_id == Agents.agent_id).\
+            filter(sales_in_period(period, sales)).\
+            group_by(Agents.agent_id)
+    else:
+        total = func.sum(AgentMonthlySales.sale_volume)
+        query = session.query(Agents.first_name, Agents.last_name, total.label('sale_volume'), Agents.email).\
+            join(Agents, AgentMonthlySales.agent_id == Agents.agent_id).\
+            filter(in_months(AgentMonthlySales.month, months)).\
+            group_by(AgentMonthlySales.agent_id)
+    return query.order_by(total.desc(), Agents.agent_id).limit(5)
 
 ### QUESTION 2 SANITY CHECK ###
-# Again, just checking our results above but not realistic for the scenario. 
-validate_top_agents = session.query(
-    Sales.sale_id, Agents.first_name, Agents.last_name, Sales.price_sold
-    ).\
-        join(Sales, Agents.agent_id == Sales.agent_id).\
-        order_by(Sales.sale_id).\
-        order_by(Agents.agent_id).\
-        all()
-
-print('Expanding all agent sales data to check question 2:')
-print_result(validate_top_agents)
-print('==========================\n')
+# Again, just checking our results above but not realistic for the scenario.
+def validate_top_agents(session, history=False):
+    sales = sales_source(history)
+    return session.query(
+        sales.sale_id, Agents.first_name, Agents.last_name, sales.price_sold
+        ).\
+            join(sales, Agents.agent_id == sales.agent_id).\
+            order_by(sales.sale_id).\
+            order_by(Agents.agent_id)
 
 
 ### QUESTION 3: Calculate the commission that each estate agent must receive and store the results in a separate table.
-# referencing INSERT ... FROM SELECT documentation: https://docs.sqlalchemy.org/en/20/core/dml.html#sqlalchemy.sql.expression.Insert
-# Select all data from other tables to populate the new Commission Table
-session.query(Commission).delete() 
-selection_agent_commissions= session.query(
-    Agents.agent_id, Agents.first_name, Agents.last_name, Agents.email, func.sum(Sales.commission)
-    ).\
-        join(Agents, Sales.agent_id == Agents.agent_id).\
-        group_by(Agents.agent_id).\
-        order_by(func.sum(Sales.commission).desc()).\
-        filter(Sales.month_sold == int(str(datetime.date.today().year) + str(datetime.date.today().month)))
-
-#Insert our selection into the table
-insertion = insert(Commission).from_select(['commission_id', 'first_name', 'last_name', 'email', 'commission_amount'], selection_agent_commissions)
-session.execute(insertion)
-session.commit()
-
-# Query all data (except IDs) from the commission table to print
-commission_data = session.query(
-    Commission.first_name, Commission.last_name, Commission.email, Commission.commission_amount)
-
-print('Question 3: Commission data (now stored in a new table):')
-print_result(commission_data)
-print('--------------------------\n')
+# The Commission table is a ledger of each agent's commission per month, updated as every sale is recorded
+# (see create.record_sale_summaries), so for whole months the report only reads those months of the ledger 
+# rather than aggregating all sales. Other periods are summed from the sales made in the period.
+def commission_ledger(session, period, history=False):
+    months = period_months(period)
+    if months is None:
+        sales = sales_source(history)
+        return agent_commissions(session, period, sales=sales).with_entities(
+            Agents.first_name, Agents.last_name, Agents.email, func.sum(sales.commission).label('commission_amount'))
+    if months[0] == months[1]:
+        return session.query(
+            Agents.first_name, Agents.last_name, Agents.email, Commission.commission_amount
+            ).\
+                join(Agents, Commission.agent_id == Agents.agent_id).\
+                filter(Commission.month == months[0]).\
+                order_by(Commission.commission_amount.desc())
+    return session.query(
+        Agents.first_name, Agents.last_name, Agents.email, func.sum(Commission.commission_amount).label('commission_amount')
+        ).\
+            join(Agents, Commission.agent_id == Agents.agent_id).\
+            filter(in_months(Commission.month, months)).\
+            group_by(Commission.agent_id).\
+            order_by(func.sum(Commission.commission_amount).desc())
 
 ### QUESTION 3 SANITY CHECK ###
-# Check to make sure only this month is included in the commission table (only one old sale is in the datebase)
-session.query(Commission).delete()
-# monthly filter is removed
-validate_agent_commissions= session.query(
-    Agents.agent_id, Agents.first_name, Agents.last_name, Agents.email, func.sum(Sales.commission)
-    ).\
-        join(Agents, Sales.agent_id == Agents.agent_id).\
-        group_by(Agents.agent_id).\
-        order_by(func.sum(Sales.commission).desc())
-
-#Insert our selection into the table
-insertion = insert(Commission).from_select(['commission_id', 'first_name', 'last_name', 'email', 'commission_amount'], selection_agent_commissions)
-session.execute(insertion)
-session.commit()
-
-# Query all data (except IDs) from the commission table to print
-commission_data = session.query(
-    Commission.first_name, Commission.last_name, Commission.email, Commission.commission_amount)
-
-print('Commission data across all months (should have more entries and commission than above):')
-print_result(validate_agent_commissions)
-print('==========================\n')
+# Commission summed straight from the sales table, which the ledger should agree with
+# without a period, commission is summed across all months
+def agent_commissions(session, period=None, history=False, sales=None):
+    sales = sales_source(history) if sales is None else sales
+    query = session.query(
+        Agents.agent_id, Agents.first_name, Agents.last_name, Agents.email, func.sum(sales.commission).label('commission_amount')
+        ).\
+            join(Agents, sales.agent_id == Agents.agent_id).\
+            group_by(Agents.agent_id).\
+            order_by(func.sum(sales.commission).desc())
+    if period is not None:
+        query = query.filter(sales_in_period(period, sales))
+    return query
 
 
 ### QUESTION 4: For all houses that were sold that month, calculate the average number of days on the market.
-days_on_market = session.query(
-    Homes.address,  func.julianday(Sales.date_sold) - func.julianday(Homes.date_listed)
-    ).\
-        join(Sales, Homes.home_id == Sales.home_id).\
-        filter(Sales.month_sold == int(str(datetime.date.today().year) + str(datetime.date.today().month)))
-
-print('Question 4: Days on the market for home sales this month:')
-print_result(days_on_market)
-print('----------------------------\n')
+# Days on the market are stored with each sale when it is recorded (see create.price_sales), and only worked out
+# from the listing and sale dates for sales recorded without them (see create.sale_days_on_market), here, in the
+# sanity check below and in market_stats.py, which gives their distribution (median, p90 and histograms by
+# month, office or zipcode).
+def average_days_on_market(session, period=None, history=False):
+    sales = sales_source(history)
+    query = session.query(
+        func.round(func.avg(sale_days_on_market(sales)), 1).label('days_on_market')
+        ).\
+            select_from(sales).\
+            join(Homes, Homes.home_id == sales.home_id)
+    if period is not None:
+        query = query.filter(sales_in_period(period, sales))
+    return query
 
 ### QUESTION 4 SANITY CHECK ###
-# Check only this month's sales are returned (only one old sale is in the datebase)
-validate_days_on_market = session.query(
-    Homes.address,  func.julianday(Sales.date_sold) - func.julianday(Homes.date_listed)
-    ).\
-        join(Sales, Homes.home_id == Sales.home_id)
-
-print('Checking days on the market without filtering for this month:')
-print_result(validate_days_on_market)
-print('=============================\n')
-
-
-### QUESTION 5: For all houses that were sold that month, calculate the average selling price. 
-average_selling_price = session.query(
-    func.round(func.avg(Sales.price_sold), 2)
-    ).\
-        filter(Sales.month_sold == int(str(datetime.date.today().year) + str(datetime.date.today().month)))
-
-print('Question 5: Average selling price for homes sold this month:')
-print_result(average_selling_price)
-print('----------------------------\n')
+# The days on the market of each home sold
+# without a period, days on the market are returned for every sale
+def days_on_market(session, period=None, history=False):
+    sales = sales_source(history)
+    query = session.query(
+        Homes.address, sale_days_on_market(sales).label('days_on_market')
+        ).\
+            join(sales, Homes.home_id == sales.home_id)
+    if period is not None:
+        query = query.filter(sales_in_period(period, sales))
+    return query
+
+
+### QUESTION 5: For all houses that were sold that month, calculate the average selling price.
+# without a period, the average is taken across all months (used for the sanity check)
+def average_selling_price(session, period=None, history=False):
+    sales = sales_source(history)
+    query = session.query(
+        func.round(func.avg(sales.price_sold), 2).label('average_price')
+        )
+    if period is not None:
+        query = query.filter(sales_in_period(period, sales))
+    return query
 
 ### QUESTION 5 SANITY CHECK ###
-# Check only this month's sales were returned above (only one old sale is in the datebase)
-validate_average_selling_price = session.query(func.round(func.avg(Sales.price_sold), 2))
-
-all_selling_prices = session.query(
-    Homes.address, Sales.price_sold
-    ).\
-        join(Sales, Homes.home_id == Sales.home_id).\
-        filter(Sales.month_sold == int(str(datetime.date.today().year) + str(datetime.date.today().month)))
-
-print('All costs of houses sold this month for a sanity-check of the average:')
-print_result(all_selling_prices)
-print('----------------------------\n')
-
-print('Checking average selling price across all months (this should be different from above if filter worked):')
-print_result(validate_average_selling_price)
-print('=============================\n')
\ No newline at end of file
+def all_selling_prices(session, period, history=False):
+    sales = sales_source(history)
+    return session.query(
+        Homes.address, sales.price_sold
+        ).\
+            join(sales, Homes.home_id == sales.home_id).\
+            filter(sales_in_period(period, sales))
+
+
+### STREAMING REPORTS
+# The functions above return queries, so nothing is read until they are iterated. stream() reads the rows
+# in batches (yield_per, with a server-side cursor where the database has them) rather than loading them
+# all at once, so even a report over the whole sales history (like the sanity checks) runs in constant memory.
+def stream(query, batch_size=1000):
+    """
+    Yield the rows of a query (or any other iterable of rows) a batch at a time.
+    """
+    if hasattr(query, 'yield_per'):
+        query = query.execution_options(stream_results=True).yield_per(batch_size)
+    yield from query
+
+# The names of the columns of a report query, for headers
+def columns(query):
+    return [column['name'] for column in query.column_descriptions]
+
+# Every report, including the sanity checks, by name as a function of the session, period and history.
+# Reports in PERIOD_REPORTS need a period, the others cover all the sales without one.
+REPORTS = {
+    'top_office_sale_counts': top_office_sale_counts,
+    'top_office_sale_amount': top_office_sale_amount,
+    'validate_top_offices': lambda session, period=None, history=False: validate_top_offices(session, history),
+    'top_agents': top_agents,
+    'validate_top_agents': lambda session, period=None, history=False: validate_top_agents(session, history),
+    'commission_ledger': commission_ledger,
+    'agent_commissions': agent_commissions,
+    'average_days_on_market': average_days_on_market,
+    'days_on_market': days_on_market,
+    'average_selling_price': average_selling_price,
+    'all_selling_prices': all_selling_prices,
+}
+PERIOD_REPORTS = {'top_office_sale_counts', 'top_office_sale_amount', 'top_agents', 'commission_ledger', 'all_selling_prices'}
+
+def report(session, name, period=None, history=False):
+    """
+    The query of a report by name, for a month key or period (or all sales, where the report allows it),
+    including the archived sales with history.
+    """
+    if name not in REPORTS:
+        raise ValueError('Unknown report {!r}, expected one of {}'.format(name, ', '.join(REPORTS)))
+    if period is None and name in PERIOD_REPORTS:
+        raise ValueError('The {} report needs a month or period'.format(name))
+    return REPORTS[name](session, period, history=history)
+
+def report_rows(session, name, period=None, batch_size=1000, history=False):
+    """
+    A generator of the rows of a report by name, read a batch at a time.
+    """
+    return stream(report(session, name, period, history), batch_size)
+
+
+# The report queries by name for a month key or period. For a month, they should use the index 
+# listed for each in create.REPORT_INDEXES, and for other periods they should all use create.PERIOD_REPORT_INDEX
+def report_queries(session, period):
+    return {
+        'top_office_sale_counts': top_office_sale_counts(session, period),
+        'top_office_sale_amount': top_office_sale_amount(session, period),
+        'top_agents': top_agents(session, period),
+        'agent_commissions': commission_ledger(session, period),
+        'days_on_market': days_on_market(session, period),
+        'average_days_on_market': average_days_on_market(session, period),
+        'average_selling_price': average_selling_price(session, period),
+    }
+
+
+if __name__ == '__main__':
+    # Start the session to query data into the database. With REAL_ESTATE_DB_SNAPSHOTS set to a directory,
+    # the reports run on a snapshot of the database kept there (see report_snapshots.py), not the live file
+    snapshots_directory = os.environ.get('REAL_ESTATE_DB_SNAPSHOTS')
+    session = SnapshotManager(snapshots_directory).session() if snapshots_directory else get_session()
+    month = current_month()
+
+    print('Question 1 (part 1): Top 5 offices this month, by number of sales:')
+    print_result(top_office_sale_counts(session, month))
+    print('--------------------------\n')
+
+    print('Question 1 (part 2): Top 5 offices this month, by amount earned:')
+    print_result(top_office_sale_amount(session, month))
+    print('--------------------------\n')
+
+    print('Expanding all office sales data to check question 1:')
+    print_result(validate_top_offices(session))
+    print('==========================\n')
+
+    print('Question 2: Top 5 agents this month, by their total amount in sales:')
+    print_result(top_agents(session, month))
+    print('--------------------------\n')
+
+    print('Expanding all agent sales data to check question 2:')
+    print_result(validate_top_agents(session))
+    print('--------------------------\n')
+
+    # The leaderboards read above should agree with totals aggregated from the raw sales
+    print('Leaderboard rows which disagree with the raw sales for questions 1 & 2 (should be empty):')
+    print_result(check_monthly_sales(month, bind=session.bind))
+    print('==========================\n')
+
+    print('Question 3: Commission data (stored in the commission ledger table):')
+    print_result(commission_ledger(session, month))
+    print('--------------------------\n')
+
+    ### QUESTION 3 SANITY CHECK ###
+    # The ledger should match commission summed from this month's sales
+    print('Commission data summed from this month\'s sales (should match the ledger above):')
+    print_result(agent_commissions(session, month))
+    print('--------------------------\n')
+
+    # Check to make sure only this month is included above (only one old sale is in the datebase)
+    # monthly filter is removed
+    print('Commission data across all months (should have more entries and commission than above):')
+    print_result(agent_commissions(session))
+    print('==========================\n')
+
+    print('Question 4: Average days on the market for home sales this month:')
+    print_result(average_days_on_market(session, month))
+    print('----------------------------\n')
+
+    print('Days on the market of each home sold this month, for a sanity-check of the average:')
+    print_result(days_on_market(session, month))
+    print('----------------------------\n')
+
+    ### QUESTION 4 SANITY CHECK ###
+    # Check only this month's sales are returned (only one old sale is in the datebase)
+    print('Checking days on the market without filtering for this month:')
+    print_result(days_on_market(session))
+    print('=============================\n')
+
+    print('Question 5: Average selling price for homes sold this month:')
+    print_result(average_selling_price(session, month))
+    print('----------------------------\n')
+
+    # Check only this month's sales were returned above (only one old sale is in the datebase)
+    print('All costs of houses sold this month for a sanity-check of the average:')
+    print_result(all_selling_prices(session, month))
+    print('----------------------------\n')
+
+    print('Checking average selling price across all months (this should be different from above if filter worked):')
+    print_result(average_selling_price(session))
+    print('=============================\n')
+
+    ### INDEX CHECK ###
+    # Check each report is planned with the index declared for it in create.py, rather than a full scan of sales
+    print('Query plans for the monthly reports:')
+    for name, (uses_index, plan) in verify_report_indexes(get_engine(), report_queries(session, month)).items():
+        print(name, 'uses its index' if uses_index else 'DOES NOT use its index', plan)
+    print('----------------------------\n')
+
+    print('Query plans for the reports over the last 30 days:')
+    rolling_indexes = dict.fromkeys(REPORT_INDEXES, PERIOD_REPORT_INDEX)
+    for name, (uses_index, plan) in verify_report_indexes(get_engine(), report_queries(session, rolling_days(30)), rolling_indexes).items():
+        print(name, 'uses its index' if uses_index else 'DOES NOT use its index', plan)
+    print('=============================\n')
+
+    # With REAL_ESTATE_DB_SLOW_QUERY_MS set, show the timings, slow queries and full scans of everything above
+    instrumentation = get_instrumentation()
+    if instrumentation is not None:
+        print('Query instrumentation:')
+        instrumentation.export_json(sys.stdout)
+        print()
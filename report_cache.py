@@ -0,0 +1,118 @@
+import datetime
+import threading
+from collections import OrderedDict
+from create import Offices, Homes, Agents, Sales, Commission, OfficeMonthlySales, AgentMonthlySales, HISTORY_VERSION, month_key, write_versions
+from query_data import report
+
+### Report result cache
+# Dashboards ask for the same reports many times a minute, while the tables behind them only change when
+# sales are recorded. Results are cached by report name and period, each with the write versions (see
+# create.WriteVersions) of the tables the report reads. Looking up a report reads the current versions
+# (one small query), and reruns the report if any of them moved. Reports of past months (or periods which
+# ended before this month) only depend on the history version, so recording this month's sales doesn't
+# invalidate them. The least recently used results are evicted past max_entries, or max_rows in total, and
+# a single result bigger than max_rows is returned without caching it.
+
+# The tables each cacheable report reads, for a month or for any other period
+REPORT_TABLES = {
+    'top_office_sale_counts': [Offices, Agents, Sales, OfficeMonthlySales],
+    'top_office_sale_amount': [Offices, Agents, Sales, OfficeMonthlySales],
+    'top_agents': [Agents, Sales, AgentMonthlySales],
+    'commission_ledger': [Agents, Sales, Commission],
+    'agent_commissions': [Agents, Sales],
+    'average_days_on_market': [Homes, Sales],
+    'days_on_market': [Homes, Sales],
+    'average_selling_price': [Sales],
+    'all_selling_prices': [Homes, Sales],
+}
+
+# True for a month key or period which is over, so no new sales should be recorded in it
+def is_past(period, today=None):
+    if period is None:
+        return False
+    this_month = (today or datetime.date.today()).replace(day=1)
+    if isinstance(period, int):
+        return period < month_key(this_month)
+    return period.end <= this_month
+
+
+class ReportCache:
+    """
+    A size-bounded LRU cache of report results (see query_data.REPORTS), invalidated by the write
+    versions of the tables each report reads. Safe to share between threads.
+    """
+    def __init__(self, max_entries=256, max_rows=100000):
+        self.max_entries = max_entries
+        self.max_rows = max_rows
+        self._entries = OrderedDict() # (name, period) -> (versions, rows)
+        self._rows = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    def __repr__(self):
+        return "<ReportCache(Entries ={}, Hits ={}, Misses ={})>".format(len(self._entries), self.hits, self.misses)
+
+    def get(self, session, name, period=None):
+        """
+        The rows of a report by name, for a month key or period, from the cache if the tables it reads
+        haven't been written to since it was cached. Returns a tuple of rows, or a list for results
+        bigger than max_rows, which are not cached.
+        """
+        if name not in REPORT_TABLES:
+            raise ValueError('The {} report is not cached, expected one of {}'.format(name, ', '.join(REPORT_TABLES)))
+        current = write_versions(session.connection())
+        tables = [HISTORY_VERSION] if is_past(period) else [table.__tablename__ for table in REPORT_TABLES[name]]
+        versions = tuple(current.get(table, 0) for table in tables)
+        key = (name, period)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == versions:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            if entry is not None:
+                self.invalidations += 1
+
+        # the report runs outside the lock, so other threads can still read the cache meanwhile
+        rows = report(session, name, period).all()
+        if len(rows) > self.max_rows:
+            # too big to cache, and caching it would only evict everything else
+            return rows
+        rows = tuple(rows)
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._rows -= len(previous[1])
+            self._entries[key] = (versions, rows)
+            self._rows += len(rows)
+            while self._entries and (len(self._entries) > self.max_entries or self._rows > self.max_rows):
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._rows -= len(evicted)
+                self.evictions += 1
+        return rows
+
+    def clear(self):
+        """
+        Drop every cached result, for example after editing names of offices or agents in past months' reports.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._rows = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'invalidations': self.invalidations,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'rows': self._rows,
+            }
@@ -0,0 +1,85 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from create import create_reader_engine, get_session
+from query_data import report
+
+### Parallel report runner
+# The reports of a month don't depend on each other, so they can run at the same time, each on its own
+# read-only connection (see create.create_reader_engine). Threads are enough: SQLite releases the GIL
+# while it runs a query, so several queries make progress at once on several cores. With a concurrency
+# of 1, the reports run one after another on a single session, as query_data.py does.
+
+# The reports making up a monthly report, in the order they are presented
+MONTHLY_REPORTS = ('top_office_sale_counts', 'top_office_sale_amount', 'top_agents', 'commission_ledger',
+                   'average_days_on_market', 'days_on_market', 'average_selling_price')
+
+
+class MonthlyReport:
+    """
+    The results of a set of reports for one period: the rows of each report and the time it took,
+    by report name, and the wall-clock time taken for all of them.
+    """
+    def __init__(self, period, results, timings, elapsed, concurrency):
+        self.period = period
+        self.results = results
+        self.timings = timings
+        self.elapsed = elapsed
+        self.concurrency = concurrency
+
+    def __repr__(self):
+        return "<MonthlyReport(Period ={}, Reports ={}, Elapsed ={:.3f}s)>".format(self.period, len(self.results), self.elapsed)
+
+    def __getitem__(self, name):
+        return self.results[name]
+
+    # Time the reports would have taken one after another, over the time they took
+    def speedup(self):
+        return sum(self.timings.values()) / self.elapsed if self.elapsed else 1.0
+
+    def as_dict(self):
+        return {
+            'period': str(self.period),
+            'concurrency': self.concurrency,
+            'elapsed': self.elapsed,
+            'reports': {name: {'seconds': self.timings[name], 'rows': [list(row) for row in rows]}
+                        for name, rows in self.results.items()},
+        }
+
+
+def _run_report(bind, name, period):
+    session = get_session(bind)
+    try:
+        start = time.perf_counter()
+        rows = report(session, name, period).all()
+        return rows, time.perf_counter() - start
+    finally:
+        session.close()
+
+
+def run_reports(period, names=MONTHLY_REPORTS, concurrency=4, bind=None):
+    """
+    Run the reports by name for a month key or period, up to concurrency of them at a time, each on its
+    own read-only connection (from bind, or a reader engine on the configured database). Returns a MonthlyReport.
+    """
+    engine = create_reader_engine(pool_size=concurrency) if bind is None else bind
+    start = time.perf_counter()
+    try:
+        if concurrency <= 1:
+            session = get_session(engine)
+            try:
+                outcomes = {}
+                for name in names:
+                    report_start = time.perf_counter()
+                    outcomes[name] = (report(session, name, period).all(), time.perf_counter() - report_start)
+            finally:
+                session.close()
+        else:
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                futures = {name: pool.submit(_run_report, engine, name, period) for name in names}
+                outcomes = {name: future.result() for name, future in futures.items()}
+    finally:
+        if bind is None:
+            engine.dispose()
+    elapsed = time.perf_counter() - start
+    return MonthlyReport(period, {name: rows for name, (rows, _) in outcomes.items()},
+                         {name: seconds for name, (_, seconds) in outcomes.items()}, elapsed, concurrency)
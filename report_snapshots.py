@@ -0,0 +1,167 @@
+import glob
+import os
+import sqlite3
+import threading
+import time
+from create import create_reader_engine, get_engine, get_session
+
+### Reporting snapshots
+# Long reports over the whole sales history (like the sanity checks in query_data.py) hold a read transaction
+# on the live database for as long as they run, and compete with transaction() for the disk. A SnapshotManager
+# copies the live database to a snapshot file with SQLite's online backup API, and runs report sessions on the
+# newest snapshot instead. In WAL mode (see create.create_writer_engine), the copy is read in one consistent
+# read transaction, which doesn't block writers: sales committed while it runs are left for the next snapshot.
+# Sessions get a snapshot at most max_staleness seconds old, taking a new one if the newest is older. Snapshots
+# can also be taken periodically in the background, so reports rarely wait for one. Only the newest few are
+# kept; older ones are deleted (reports still running on one keep reading it until they close their session).
+
+# Snapshot files are named after the time they were taken, in nanoseconds, so they sort oldest first
+SNAPSHOT_FILE = 'report_{:020d}.db'
+SNAPSHOT_PATTERN = 'report_' + '[0-9]' * 20 + '.db'
+
+def _taken_at(path):
+    return int(os.path.basename(path)[len('report_'):-len('.db')]) / 1e9
+
+
+class SnapshotManager:
+    """
+    Takes snapshots of the database of source (an engine, by default the shared engine) into directory,
+    and opens report sessions on the newest one. Safe to share between threads.
+    """
+    def __init__(self, directory, source=None, max_staleness=300, keep=2, pool_size=4):
+        self.directory = directory
+        self.source = get_engine() if source is None else source
+        self.max_staleness = max_staleness
+        self.keep = keep
+        self.pool_size = pool_size
+        self.last_error = None
+        self._engines = {}
+        self._lock = threading.Lock()
+        self._stopping = None
+        self._thread = None
+        os.makedirs(directory, exist_ok=True)
+        # snapshots left by an earlier run are still usable; a backup interrupted part way isn't
+        for partial in glob.glob(os.path.join(directory, SNAPSHOT_PATTERN + '.partial')):
+            os.remove(partial)
+        self._snapshots = sorted(glob.glob(os.path.join(directory, SNAPSHOT_PATTERN)))
+
+    def __repr__(self):
+        return "<SnapshotManager(Directory ={}, Snapshots ={})>".format(self.directory, len(self.snapshots()))
+
+    def snapshots(self):
+        """
+        Paths of the snapshots kept, oldest first.
+        """
+        with self._lock:
+            return list(self._snapshots)
+
+    def age(self):
+        """
+        Seconds since the newest snapshot was taken, or None before the first.
+        """
+        snapshots = self.snapshots()
+        return time.time() - _taken_at(snapshots[-1]) if snapshots else None
+
+    def take(self):
+        """
+        Copy the source database to a new snapshot file, with the online backup API. Returns its path.
+        """
+        path = os.path.join(self.directory, SNAPSHOT_FILE.format(time.time_ns()))
+        partial = path + '.partial'
+        source = self.source.raw_connection()
+        try:
+            target = sqlite3.connect(partial)
+            try:
+                # in one step, so the whole copy is read from a single, consistent read transaction
+                source.connection.backup(target)
+                # snapshots are only read, so they don't need the -wal and -shm files of WAL mode
+                target.execute('PRAGMA journal_mode=DELETE')
+            finally:
+                target.close()
+        finally:
+            source.close()
+        # a snapshot is only found by its final name once it is complete
+        os.replace(partial, path)
+        with self._lock:
+            self._snapshots.append(path)
+        return path
+
+    def rotate(self):
+        """
+        Delete all but the newest keep snapshots. Returns the number deleted.
+        """
+        with self._lock:
+            expired = self._snapshots[:-self.keep] if self.keep else list(self._snapshots)
+            self._snapshots = self._snapshots[len(expired):]
+            engines = [self._engines.pop(path) for path in expired if path in self._engines]
+        for engine in engines:
+            engine.dispose()
+        for path in expired:
+            os.remove(path)
+        return len(expired)
+
+    def refresh(self):
+        """
+        Take a new snapshot and rotate out the old ones. Returns the new snapshot's path.
+        """
+        path = self.take()
+        self.rotate()
+        return path
+
+    def engine(self, max_staleness=None):
+        """
+        A read-only engine on the newest snapshot, taking a new one first if there is none taken
+        within max_staleness seconds (by default, the manager's max_staleness).
+        """
+        max_staleness = self.max_staleness if max_staleness is None else max_staleness
+        age = self.age()
+        if age is None or age > max_staleness:
+            self.refresh()
+        with self._lock:
+            path = self._snapshots[-1]
+            engine = self._engines.get(path)
+            if engine is None:
+                engine = self._engines[path] = create_reader_engine('sqlite:///' + path, pool_size=self.pool_size)
+            return engine
+
+    def session(self, max_staleness=None):
+        """
+        A session on the newest snapshot, no older than max_staleness seconds (see engine()).
+        """
+        return get_session(self.engine(max_staleness))
+
+    ### Periodic snapshots
+    def start(self, interval=None):
+        """
+        Refresh the snapshots every interval seconds (by default, half of max_staleness) in a background
+        thread, until stop(). Errors are kept in last_error, and the next refresh is still attempted.
+        """
+        interval = self.max_staleness / 2 if interval is None else interval
+        if self._thread is not None:
+            return
+        self._stopping = threading.Event()
+
+        def run():
+            while not self._stopping.wait(interval):
+                try:
+                    self.refresh()
+                    self.last_error = None
+                except (sqlite3.Error, OSError) as error:
+                    self.last_error = error
+
+        self._thread = threading.Thread(target=run, name='report-snapshots', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopping.set()
+            self._thread.join()
+            self._thread = None
+
+    def close(self):
+        self.stop()
+        with self._lock:
+            engines = list(self._engines.values())
+            self._engines = {}
+        for engine in engines:
+            engine.dispose()
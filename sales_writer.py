@@ -0,0 +1,94 @@
+import random
+import threading
+import time
+from sqlalchemy.exc import OperationalError
+from create import create_writer_engine
+from insert_data import transaction, record_sales
+
+### Concurrent sales writer
+# A thread-safe service for recording sales from several ingest workers against the same SQLite file.
+# It writes through an engine in WAL mode with a busy timeout and a bounded connection pool (see
+# create.create_writer_engine), and retries a sale or batch which still fails because the database is
+# locked, waiting a little longer (with some random jitter) after each attempt.
+
+# SQLite reports lock contention as an OperationalError with one of these messages
+LOCK_ERRORS = ('database is locked', 'database table is locked', 'database is busy')
+
+def is_lock_error(error):
+    return isinstance(error, OperationalError) and any(message in str(error.orig) for message in LOCK_ERRORS)
+
+
+class SalesWriter:
+    """
+    Record sales from any number of threads, retrying lock contention with exponential backoff.
+    Keeps counters of the sales recorded, retries and failures, available from stats().
+    """
+    def __init__(self, bind=None, pool_size=4, max_retries=10, backoff=0.01, max_backoff=1.0):
+        self.bind = create_writer_engine(pool_size=pool_size) if bind is None else bind
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._lock = threading.Lock()
+        self._started = time.perf_counter()
+        self.recorded = 0
+        self.retries = 0
+        self.failed = 0
+
+    def __repr__(self):
+        return "<SalesWriter(Recorded={}, Retries={}, Failed={})>".format(self.recorded, self.retries, self.failed)
+
+    def _count(self, **counts):
+        with self._lock:
+            for counter, amount in counts.items():
+                setattr(self, counter, getattr(self, counter) + amount)
+
+    def retry(self, write):
+        """
+        Call write(), retrying it while it fails because the database is locked.
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                return write()
+            except OperationalError as error:
+                if not is_lock_error(error) or attempt == self.max_retries:
+                    raise
+                self._count(retries=1)
+                delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+                time.sleep(delay * random.uniform(0.5, 1.0))
+
+    def record(self, home_id, agent_id, buyer_id, price_sold):
+        """
+        Record a single sale, as insert_data.transaction() does.
+        """
+        try:
+            self.retry(lambda: transaction(home_id, agent_id, buyer_id, price_sold, bind=self.bind))
+        except Exception:
+            self._count(failed=1)
+            raise
+        self._count(recorded=1)
+
+    def record_many(self, sales, batch_size=1000):
+        """
+        Record a batch of sales, as insert_data.record_sales() does, retrying each batch on lock contention.
+        Returns the SalesLoadResult.
+        """
+        result = record_sales(sales, batch_size=batch_size, bind=self.bind, retry=self.retry)
+        self._count(recorded=result.inserted, failed=len(result.rejected))
+        return result
+
+    def stats(self):
+        """
+        Counters since the writer was created, with throughput in sales recorded per second.
+        """
+        with self._lock:
+            elapsed = time.perf_counter() - self._started
+            return {
+                'recorded': self.recorded,
+                'retries': self.retries,
+                'failed': self.failed,
+                'elapsed': elapsed,
+                'sales_per_second': self.recorded / elapsed if elapsed else 0.0,
+            }
+
+    def close(self):
+        self.bind.dispose()
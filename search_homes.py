@@ -0,0 +1,46 @@
+from collections import namedtuple
+from sqlalchemy import tuple_
+from create import Homes
+
+### Home search for the listing portal
+# Filters homes by zipcode, beds, baths and listed price, newest listings first, a page at a time.
+# Pages are found by keyset (seek) pagination: each page carries the (date_listed, home_id) of its last
+# home, and the next page starts right after it in the search index (see idx_homes_search_* in create.py),
+# so page 1000 is found as quickly as page 1, where OFFSET would read and skip every home before it.
+# Homes without a listing date aren't on the market, so they never match.
+
+# A page of results, and the position to pass as after= to get the next page (None on the last page)
+SearchPage = namedtuple('SearchPage', ['homes', 'next_page'])
+
+def search_query(session, zipcode=None, min_beds=None, min_baths=None, min_price=None, max_price=None, include_sold=False):
+    """
+    Query of every home matching the filters, newest listing first. Filters left as None aren't applied.
+    """
+    query = session.query(Homes).filter(Homes.date_listed.isnot(None))
+    if not include_sold:
+        query = query.filter(Homes.sold == False)
+    if zipcode is not None:
+        query = query.filter(Homes.zipcode == zipcode)
+    if min_beds is not None:
+        query = query.filter(Homes.beds >= min_beds)
+    if min_baths is not None:
+        query = query.filter(Homes.baths >= min_baths)
+    if min_price is not None:
+        query = query.filter(Homes.price_listed >= min_price)
+    if max_price is not None:
+        query = query.filter(Homes.price_listed <= max_price)
+    return query.order_by(Homes.date_listed.desc(), Homes.home_id.desc())
+
+
+def search_homes(session, zipcode=None, min_beds=None, min_baths=None, min_price=None, max_price=None, include_sold=False,
+                 after=None, page_size=20):
+    """
+    One page of the homes matching the filters, newest listing first, starting after the
+    position given by the previous page's next_page. Returns a SearchPage.
+    """
+    query = search_query(session, zipcode, min_beds, min_baths, min_price, max_price, include_sold)
+    if after is not None:
+        query = query.filter(tuple_(Homes.date_listed, Homes.home_id) < tuple_(*after))
+    homes = query.limit(page_size).all()
+    next_page = (homes[-1].date_listed, homes[-1].home_id) if len(homes) == page_size else None
+    return SearchPage(homes, next_page)
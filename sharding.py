@@ -0,0 +1,265 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import select, insert, func
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from create import Offices, Agents, Homes, Sellers, Buyers, Listings, Sales, create_writer_engine, create_reader_engine, get_session, bump_write_versions
+from insert_data import transaction, record_sales, SalesLoadResult, RejectedSale, SALE_FIELDS
+from query_data import top_office_sale_counts, top_office_sale_amount, top_agents, sales_in_period
+
+### Office sharding (optional)
+# With every office writing to one database file, SQLite's single writer lock limits how many sales can be
+# recorded at once. In sharded mode, each office gets its own database file, holding its agents' listings
+# and sales (and the summary tables built from them), so offices don't wait on each other's writes.
+#
+#   catalog.db        offices, agents, homes, sellers and buyers: the source of truth, which allocates IDs
+#   office_<id>.db    one per office: the full schema, with the office's sales, commission ledger and
+#                     leaderboards, its own agents, and a copy of the homes, sellers and buyers
+#
+# Reference rows are added through the router, which writes them to the catalog and copies them (with the same
+# IDs) to the shards. Agents stay in the office they were added to, and homes are only marked as sold in the
+# shard of the office that sold them. Reports run on every shard at once and are merged: offices and agents
+# each live in a single shard, so the top N overall are among the top N of each shard, and averages are taken
+# from the summed totals and counts of the shards. Reports read each shard through a read-only engine, since
+# the writer engines' transactions take the shard's write lock as they begin, even just to read.
+
+CATALOG_FILE = 'catalog.db'
+SHARD_FILE = 'office_{}.db'
+
+# Reference tables copied to every shard
+BROADCAST_TABLES = [Offices, Homes, Sellers, Buyers]
+
+
+def _copy_rows(source, target, table, where=None):
+    query = select(table.__table__)
+    if where is not None:
+        query = query.where(where)
+    with source.connect() as conn:
+        rows = [dict(row._mapping) for row in conn.execute(query)]
+    if rows:
+        with target.begin() as conn:
+            conn.execute(sqlite_insert(table).on_conflict_do_nothing(), rows)
+            bump_write_versions(conn, [table])
+
+
+class ShardRouter:
+    """
+    Routes writes to the database file of the office they belong to, and runs reports across every office.
+    Safe to share between threads.
+    """
+    def __init__(self, directory, pool_size=4):
+        self.directory = directory
+        self.pool_size = pool_size
+        self.catalog = create_writer_engine('sqlite:///' + os.path.join(directory, CATALOG_FILE), pool_size=pool_size)
+        self._shards = {}
+        self._readers = {}
+        self._agent_offices = {}
+        self._unknown_agents = set()
+        self._lock = threading.Lock()
+        with self.catalog.connect() as conn:
+            office_ids = conn.execute(select(Offices.office_id)).scalars().all()
+        for office_id in office_ids:
+            self.shard(office_id)
+
+    def __repr__(self):
+        return "<ShardRouter(Directory ={}, Shards ={})>".format(self.directory, len(self._shards))
+
+    def shard(self, office_id):
+        """
+        The engine of an office's database file, created (and filled with the reference data) on first use.
+        """
+        with self._lock:
+            engine = self._shards.get(office_id)
+        if engine is not None:
+            return engine
+        # filled outside the lock, so other offices' writes and lookups carry on meanwhile; copying the rows
+        # is idempotent, so two threads opening the same new shard at once both fill it, and one engine is kept
+        url = 'sqlite:///' + os.path.join(self.directory, SHARD_FILE.format(office_id))
+        engine = create_writer_engine(url, pool_size=self.pool_size)
+        for table in BROADCAST_TABLES:
+            _copy_rows(self.catalog, engine, table)
+        _copy_rows(self.catalog, engine, Agents, Agents.office_id == office_id)
+        reader = create_reader_engine(url, pool_size=self.pool_size)
+        with self._lock:
+            if office_id not in self._shards:
+                self._shards[office_id], self._readers[office_id] = engine, reader
+                return engine
+            published = self._shards[office_id]
+        engine.dispose()
+        reader.dispose()
+        return published
+
+    def shards(self):
+        """
+        The engine of every office's database file, for writing, by office ID.
+        """
+        with self._lock:
+            return dict(self._shards)
+
+    def readers(self):
+        """
+        A read-only engine on every office's database file, for reports, by office ID.
+        """
+        with self._lock:
+            return dict(self._readers)
+
+    ### Reference data
+    def add_office(self, name):
+        """
+        Add an office, and create its database file. Returns the new office ID.
+        """
+        with self.catalog.begin() as conn:
+            office_id = conn.execute(insert(Offices).values(name=name)).inserted_primary_key[0]
+        for engine in self.shards().values():
+            _copy_rows(self.catalog, engine, Offices, Offices.office_id == office_id)
+        self.shard(office_id)
+        return office_id
+
+    def add_agent(self, office_id, **fields):
+        """
+        Add an agent to an office (to the catalog and the office's shard). Returns the new agent ID.
+        """
+        if office_id not in self.shards():
+            raise ValueError("unknown office_id {}".format(office_id))
+        with self.catalog.begin() as conn:
+            agent_id = conn.execute(insert(Agents).values(office_id=office_id, **fields)).inserted_primary_key[0]
+        _copy_rows(self.catalog, self.shard(office_id), Agents, Agents.agent_id == agent_id)
+        with self._lock:
+            self._agent_offices[agent_id] = office_id
+            self._unknown_agents.discard(agent_id)
+        return agent_id
+
+    def add_reference(self, table, rows):
+        """
+        Add homes, sellers or buyers (dictionaries of column values), to the catalog and every shard.
+        Returns the new IDs.
+        """
+        if table not in (Homes, Sellers, Buyers):
+            raise ValueError("{} is not copied to every shard".format(table.__tablename__))
+        rows = list(rows)
+        if not rows:
+            return []
+        primary_key = table.__table__.primary_key.columns.values()[0]
+        if any(primary_key.name in row for row in rows):
+            raise ValueError("{} are allocated by the catalog".format(primary_key.name))
+        with self.catalog.begin() as conn:
+            conn.execute(insert(table), rows)
+            # the catalog's write lock is held since the insert, so the new rows have consecutive IDs
+            last_id = conn.execute(select(func.last_insert_rowid())).scalar()
+        first_id = last_id - len(rows) + 1
+        for engine in self.shards().values():
+            _copy_rows(self.catalog, engine, table, primary_key.between(first_id, last_id))
+        return list(range(first_id, last_id + 1))
+
+    def add_listing(self, home_id, agent_id, seller_id):
+        """
+        List a home with an agent, in the shard of the agent's office. Returns the new listing ID.
+        """
+        with self.shard(self.office_of(agent_id)).begin() as conn:
+            listing_id = conn.execute(insert(Listings).values(home_id=home_id, agent_id=agent_id, seller_id=seller_id)).inserted_primary_key[0]
+            bump_write_versions(conn, [Listings])
+        return listing_id
+
+    def office_of(self, agent_id):
+        """
+        The office ID of an agent, read from the catalog the first time it is asked for. Unknown agents
+        are remembered too, so a feed of sales by a missing agent only looks it up once.
+        """
+        with self._lock:
+            office_id = self._agent_offices.get(agent_id)
+            unknown = agent_id in self._unknown_agents
+        if office_id is None and not unknown:
+            with self.catalog.connect() as conn:
+                office_id = conn.execute(select(Agents.office_id).where(Agents.agent_id == agent_id)).scalar()
+            with self._lock:
+                if office_id is None:
+                    self._unknown_agents.add(agent_id)
+                else:
+                    self._agent_offices[agent_id] = office_id
+        if office_id is None:
+            raise ValueError("unknown agent_id {}".format(agent_id))
+        return office_id
+
+    ### Writes
+    def transaction(self, home_id, agent_id, buyer_id, price_sold):
+        """
+        Record a sale, as insert_data.transaction() does, in the shard of the agent's office.
+        """
+        transaction(home_id, agent_id, buyer_id, price_sold, bind=self.shard(self.office_of(agent_id)))
+
+    def record_sales(self, sales, batch_size=1000):
+        """
+        Record many sales, as insert_data.record_sales() does, in the shard of each agent's office.
+        Returns a SalesLoadResult, with rejections indexed by position in sales.
+        """
+        result = SalesLoadResult()
+
+        # each office's sales are written as soon as there are batch_size of them, so a long feed isn't held in memory
+        def flush(office_id, office_sales):
+            office_result = record_sales([sale for _, sale in office_sales], batch_size, bind=self.shard(office_id))
+            result.inserted += office_result.inserted
+            result.batches += office_result.batches
+            result.rejected.extend(rejection._replace(index=office_sales[rejection.index][0]) for rejection in office_result.rejected)
+
+        by_office = {}
+        for index, sale in enumerate(sales):
+            agent_id = sale.get('agent_id') if isinstance(sale, dict) else dict(zip(SALE_FIELDS, sale)).get('agent_id')
+            try:
+                office_id = self.office_of(agent_id)
+            except ValueError as error:
+                result.rejected.append(RejectedSale(index, sale, str(error)))
+                continue
+            office_sales = by_office.setdefault(office_id, [])
+            office_sales.append((index, sale))
+            if len(office_sales) >= batch_size:
+                flush(office_id, by_office.pop(office_id))
+        for office_id, office_sales in by_office.items():
+            flush(office_id, office_sales)
+        result.rejected.sort(key=lambda rejection: rejection.index)
+        return result
+
+    ### Scatter-gather reports
+    def _gather(self, query):
+        # run query(session) on every shard at once, each on its own read-only session
+        def run(engine):
+            session = get_session(engine)
+            try:
+                return query(session)
+            finally:
+                session.close()
+        # in office order, so merged results don't depend on the order the shards were opened in
+        engines = [engine for _, engine in sorted(self.readers().items())]
+        if not engines:
+            return []
+        with ThreadPoolExecutor(max_workers=min(len(engines), self.pool_size)) as pool:
+            return list(pool.map(run, engines))
+
+    def _top(self, report, period, total_index, limit):
+        rows = [row for shard_rows in self._gather(lambda session: report(session, period).limit(limit).all()) for row in shard_rows]
+        # the sort is stable, so ties stay in office order, and within an office in the ID order of its report
+        return sorted(rows, key=lambda row: -row[total_index])[:limit]
+
+    def top_office_sale_counts(self, period, limit=5):
+        return self._top(top_office_sale_counts, period, 1, limit)
+
+    def top_office_sale_amount(self, period, limit=5):
+        return self._top(top_office_sale_amount, period, 1, limit)
+
+    def top_agents(self, period, limit=5):
+        return self._top(top_agents, period, 2, limit)
+
+    def average_selling_price(self, period=None):
+        """
+        The average price of the sales of every office, from the total price and number of sales of each shard.
+        """
+        def totals(session):
+            query = session.query(func.sum(Sales.price_sold), func.count(Sales.price_sold))
+            return (query if period is None else query.filter(sales_in_period(period))).one()
+        shard_totals = self._gather(totals)
+        count = sum(count for _, count in shard_totals)
+        return round(sum(total or 0 for total, _ in shard_totals) / count, 2) if count else None
+
+    def close(self):
+        for engine in list(self.shards().values()) + list(self.readers().values()):
+            engine.dispose()
+        self.catalog.dispose()
@@ -0,0 +1,205 @@
+import argparse
+import bisect
+import json
+import math
+import mmap
+import os
+from array import array
+from collections import defaultdict
+from sqlalchemy import select, func
+from create import Sales, Homes, Agents, Offices, sale_days_on_market, get_engine
+
+### Columnar sales snapshot
+# For ad-hoc analysis (commission by office by month, price distribution by zipcode, ...) without writing
+# another join. load_snapshot() reads every sale, with its home, agent and office, once, into one compact
+# array per column, sorted by month. Text columns are dictionary-encoded: the array holds a small integer
+# code, looked up in a list of the distinct values. Aggregations are single passes over the arrays, and
+# a range of months is a slice found by binary search, so nothing goes back to SQLite.
+# NumPy isn't a dependency of this project, so the columns are standard library arrays (or, once saved
+# and reopened, typed memoryviews of a memory-mapped file, so reopening a snapshot reads nothing up front).
+
+# Column name, array type code and the expression it is loaded from. Missing numbers are stored as NaN for
+# floats and 0 for integers, missing text as the code of None.
+COLUMNS = [
+    ('sale_id', 'q', Sales.sale_id),
+    ('month', 'i', Sales.month_sold),
+    ('day_sold', 'i', func.julianday(Sales.date_sold) - 2440587.5), # days since 1970-01-01
+    ('price', 'd', Sales.price_sold),
+    ('commission', 'd', Sales.commission),
+    ('agent_id', 'i', Sales.agent_id),
+    ('office', 'i', Offices.name),
+    ('home_id', 'i', Sales.home_id),
+    ('zipcode', 'i', Homes.zipcode),
+    ('days_on_market', 'd', sale_days_on_market()),
+]
+TEXT_COLUMNS = ('office', 'zipcode')
+
+AGGREGATES = {
+    'sum': math.fsum,
+    'count': len,
+    'mean': lambda values: math.fsum(values) / len(values),
+    'min': min,
+    'max': max,
+}
+
+MAGIC = b'REALESTATE-SNAPSHOT-1\n'
+
+
+def _percentile(ordered, percent):
+    # linear interpolation between the closest ranks, as numpy.percentile does by default
+    position = (len(ordered) - 1) * percent / 100
+    lower = math.floor(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+class SalesSnapshot:
+    """
+    Column arrays of every sale at the time it was loaded, sorted by month, with the distinct values
+    of each text column. Build one with load_snapshot(), or reopen a saved one with open_snapshot().
+    """
+    def __init__(self, columns, dictionaries, mapped=None):
+        self.columns = columns
+        self.dictionaries = dictionaries
+        self._mapped = mapped
+
+    def __repr__(self):
+        return "<SalesSnapshot(Sales ={}, Months ={})>".format(len(self), len(set(self.columns['month'])))
+
+    def __len__(self):
+        return len(self.columns['sale_id'])
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def decode(self, name, code):
+        return self.dictionaries[name][code] if name in self.dictionaries else code
+
+    def month_slice(self, months=None):
+        """
+        The positions of the sales in a month key or (first, last) range of month keys, or all sales.
+        """
+        if months is None:
+            return slice(0, len(self))
+        first, last = (months, months) if isinstance(months, int) else months
+        month = self.columns['month']
+        return slice(bisect.bisect_left(month, first), bisect.bisect_right(month, last))
+
+    def _groups(self, by, value, months):
+        rows = self.month_slice(months)
+        by = (by,) if isinstance(by, str) else tuple(by)
+        keys = zip(*[self.columns[name][rows] for name in by]) if len(by) > 1 else self.columns[by[0]][rows]
+        values = self.columns[value][rows]
+        groups = defaultdict(list)
+        for key, number in zip(keys, values):
+            if number == number: # skip NaN, for missing values
+                groups[key].append(number)
+        return by, groups
+
+    def _decoded(self, by, key):
+        if len(by) == 1:
+            return self.decode(by[0], key)
+        return tuple(self.decode(name, code) for name, code in zip(by, key))
+
+    def aggregate(self, by, value='price', how='sum', months=None):
+        """
+        Group the sales (of a month or range of months) by one column or a tuple of columns, and
+        aggregate a numeric column with sum, count, mean, min or max. Returns a dictionary of group to result.
+        """
+        if how not in AGGREGATES:
+            raise ValueError('Unknown aggregate {!r}, expected one of {}'.format(how, ', '.join(AGGREGATES)))
+        by, groups = self._groups(by, value, months)
+        return {self._decoded(by, key): AGGREGATES[how](values) for key, values in groups.items()}
+
+    def percentiles(self, by, value='price', percents=(25, 50, 75), months=None):
+        """
+        Percentiles of a numeric column within each group. Returns a dictionary of group to a tuple of
+        one value per percent.
+        """
+        by, groups = self._groups(by, value, months)
+        results = {}
+        for key, values in groups.items():
+            values.sort()
+            results[self._decoded(by, key)] = tuple(_percentile(values, percent) for percent in percents)
+        return results
+
+    def save(self, path):
+        """
+        Write the snapshot to a file which open_snapshot() maps back into memory.
+        """
+        layout, offset = {}, 0
+        for name, typecode, _ in COLUMNS:
+            size = len(self) * array(typecode).itemsize
+            layout[name] = [typecode, offset, size]
+            offset += size + (-size % 8) # keep every column 8 byte aligned
+        header = json.dumps({'rows': len(self), 'columns': layout, 'dictionaries': self.dictionaries}).encode()
+        header += b' ' * (-(len(MAGIC) + 8 + len(header)) % 8)
+        with open(path, 'wb') as file:
+            file.write(MAGIC + len(header).to_bytes(8, 'little') + header)
+            for name, typecode, _ in COLUMNS:
+                column = self.columns[name]
+                data = column.tobytes() if isinstance(column, array) else column.cast('B').tobytes()
+                file.write(data + b'\0' * (-len(data) % 8))
+
+    def close(self):
+        if self._mapped is not None:
+            for name in list(self.columns):
+                self.columns[name].release()
+            self._mapped.close()
+            self._mapped = None
+
+
+def load_snapshot(bind=None, batch_size=10000):
+    """
+    Read every sale, with its home, agent and office, into a SalesSnapshot.
+    """
+    bind = get_engine() if bind is None else bind
+    columns = {name: array(typecode) for name, typecode, _ in COLUMNS}
+    codes = {name: {} for name in TEXT_COLUMNS}
+    appenders = [(columns[name].append, codes.get(name), typecode == 'd') for name, typecode, _ in COLUMNS]
+    query = select(*[expression for _, _, expression in COLUMNS]).select_from(Sales).\
+        outerjoin(Homes, Sales.home_id == Homes.home_id).\
+        outerjoin(Agents, Sales.agent_id == Agents.agent_id).\
+        outerjoin(Offices, Agents.office_id == Offices.office_id).\
+        order_by(Sales.month_sold, Sales.sale_id)
+    with bind.connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(query)
+        for rows in result.partitions(batch_size):
+            for row in rows:
+                for (append, dictionary, is_float), value in zip(appenders, row):
+                    if dictionary is not None:
+                        value = dictionary.setdefault(value, len(dictionary))
+                    elif value is None:
+                        value = math.nan if is_float else 0
+                    elif not is_float:
+                        value = int(value)
+                    append(value)
+    return SalesSnapshot(columns, {name: list(codes[name]) for name in TEXT_COLUMNS})
+
+
+def open_snapshot(path):
+    """
+    Map a snapshot saved with SalesSnapshot.save() into memory. Its columns are read from the file as they
+    are used, so opening it takes the same time however large it is. Call close() when done with it.
+    """
+    with open(path, 'rb') as file:
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    if mapped[:len(MAGIC)] != MAGIC:
+        mapped.close()
+        raise ValueError('{} is not a sales snapshot'.format(path))
+    header_length = int.from_bytes(mapped[len(MAGIC):len(MAGIC) + 8], 'little')
+    start = len(MAGIC) + 8
+    header = json.loads(mapped[start:start + header_length])
+    data = memoryview(mapped)[start + header_length:]
+    columns = {name: data[offset:offset + size].cast(typecode) for name, (typecode, offset, size) in header['columns'].items()}
+    data.release()
+    return SalesSnapshot(columns, header['dictionaries'], mapped)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Save a snapshot of the sales for analysis')
+    parser.add_argument('path')
+    args = parser.parse_args()
+    snapshot = load_snapshot()
+    snapshot.save(args.path)
+    print(snapshot, os.path.getsize(args.path), 'bytes')
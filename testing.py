@@ -1,20 +1,54 @@
+import io
+import json
+import os
+import tempfile
+import threading
 import unittest
-from create import Offices, Homes, Agents, Listings, Buyers, Sellers, Sales, Commission, engine, Base
-from sqlalchemy import create_engine, func, insert, update
+from unittest import mock
+from create import Offices, Homes, Agents, Listings, Buyers, Sellers, Sales, Commission, Base, ensure_indexes, verify_report_indexes, rebuild_commissions, migrate_commission_table, \
+    OfficeMonthlySales, AgentMonthlySales, rebuild_monthly_sales, check_monthly_sales, \
+    month_key, migrate_period_keys, REPORT_INDEXES, PERIOD_REPORT_INDEX, \
+    CommissionTiers, SaleChanges, ArchivedMonths, Migrations, migrate_days_on_market, recompute_commissions, create_writer_engine, create_reader_engine, init_db, explain_query_plan
+from sqlalchemy import create_engine, event, inspect, text, func, insert, update
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.ext.declarative import declarative_base
 import datetime
 from datetime import date
-from insert_data import transaction
+from insert_data import transaction, record_sales, seed
+from sales_writer import SalesWriter
+from generate_data import generate, Scale
+from export_data import export_report, write_jsonl
+from report_cache import ReportCache
+from instrumentation import Instrumentation, OTHER_STATEMENTS
+from report_runner import run_reports, MONTHLY_REPORTS
+from snapshot import load_snapshot, open_snapshot
+from load_data import load_csv
+from search_homes import search_homes, search_query
+from sharding import ShardRouter
+from change_feed import ChangeFeedConsumer, compact_changes
+from report_snapshots import SnapshotManager
+from leaderboards import Leaderboards
+from profiles import office_profile, agent_profiles, profile_dict
+from archive import archive_sales
+from market_stats import days_on_market_stats, DaysHistogram
+from query_data import report_queries, report, days_on_market, average_days_on_market, top_office_sale_counts, top_office_sale_amount, top_agents, average_selling_price, \
+    month_period, quarter_period, year_to_date, rolling_days, period_months
 
-class TestDatabase(unittest.TestCase):
+class DatabaseTestCase(unittest.TestCase):
+    """
+    Tests on an empty in-memory database (self.engine), created as init_db() creates it, 
+    with a session on it (self.session). 
+    """
     def setUp(self):
         self.engine = create_engine('sqlite:///:memory:')
-        self.engine.connect()
-        Base.metadata.create_all(self.engine)
-        Session = sessionmaker(bind=self.engine)
-        self.session = Session()
+        init_db(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+
+    def tearDown(self):
+        self.session.close()
 
+class TestDatabase(DatabaseTestCase):
     def test_database(self):
         '''
         Pseudo-Integration testing: testing high level interactions with the database 
@@ -33,7 +67,7 @@ class TestDatabase(unittest.TestCase):
         rows = self.session.query(func.count(Homes.home_id)).scalar()
         self.assertEqual(rows, 0, "Table is not emoty at initialization")
 
-        home = Homes(beds=1, baths=1, address='22 Nathaniel', zipcode='94103', price_listed= 800000.00, date_listed=date(2021,9,21), month_listed=20219)
+        home = Homes(beds=1, baths=1, address='22 Nathaniel', zipcode='94103', price_listed= 800000.00, date_listed=date(2021,9,21), month_listed=202109)
         self.session.add(home)
         self.session.commit()
 
@@ -51,7 +85,7 @@ class TestDatabase(unittest.TestCase):
         self.assertEqual(rows_after_delete, 0, "Information is not correctly cleared from the database")
 
         # Data remains consistent between queries (number of data rows is as expected)
-        home = Homes(beds=1, baths=1, address='22 Nathaniel', zipcode='94103', price_listed= 800000.00, date_listed=date(2021,9,21), month_listed=20219)
+        home = Homes(beds=1, baths=1, address='22 Nathaniel', zipcode='94103', price_listed= 800000.00, date_listed=date(2021,9,21), month_listed=202109)
         self.session.add(home)
         self.session.commit()
         rows_later = self.session.query(func.count(Homes.home_id)).scalar()
@@ -61,7 +95,7 @@ class TestDatabase(unittest.TestCase):
         """
         Test home information is accurately stored to database, with the right data type. 
         """
-        home = Homes(beds=1, baths=1.5, address='22 Nathaniel', zipcode='94103', price_listed= 800000.00, date_listed=date(2021,9,21), month_listed=20219)
+        home = Homes(beds=1, baths=1.5, address='22 Nathaniel', zipcode='94103', price_listed= 800000.00, date_listed=date(2021,9,21), month_listed=202109)
         self.session.add(home)
         self.session.commit()
 
@@ -72,7 +106,7 @@ class TestDatabase(unittest.TestCase):
         self.assertEqual(home.zipcode, '94103')
         self.assertEqual(home.price_listed,float(800000.00))
         self.assertEqual(home.date_listed, datetime.datetime(2021,9,21,0,0))
-        self.assertEqual(home.month_listed, int(20219))
+        self.assertEqual(home.month_listed, int(202109))
         self.assertEqual(home.sold, False)
 
     def test_agents(self):
@@ -133,9 +167,1123 @@ class TestDatabase(unittest.TestCase):
         Test transactions do not commit when an exception is raised
         (in this case by a bad input).
         """
-        transaction(1, 'WRONG INPUT', 1, 80000.00)
+        self.session.add(Homes(address='22 Nathaniel'))
+        self.session.commit()
+        with self.assertRaises(ValueError):
+            transaction(1, 'WRONG INPUT', 1, 80000.00, bind=self.engine)
         rows = self.session.query(func.count(Sales.sale_id)).scalar()
         self.assertEqual(rows, 0)
+        self.assertEqual(self.session.query(Homes).get(1).sold, False)
+
+class TestRecordSales(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.session.add_all([
+            Homes(beds=1, baths=1, address='22 Nathaniel', zipcode='94103', price_listed=800000.00, date_listed=date(2021,9,21), month_listed=202109),
+            Homes(beds=2, baths=1, address='16 Turk St', zipcode='94102', price_listed=50000.00, date_listed=date(2021,6,12), month_listed=202106),
+            Agents(office_id=1, first_name='Dwight', last_name='Schrute', email='dwight@estates.com'),
+            Buyers(first_name='Toph', last_name='Beifong', email='metal_bender@gmail.com'),
+        ])
+        self.session.commit()
+
+    def test_record_sales(self):
+        """
+        Valid sales are written with their commission and flip the home to sold, 
+        while bad rows are reported without stopping the rest of the load. 
+        """
+        result = record_sales([
+            (1, 1, 1, 800000.00),
+            (2, 'WRONG INPUT', 1, 50000.00),
+            (99, 1, 1, 50000.00),
+            {'home_id': 2, 'agent_id': 1, 'buyer_id': 1, 'price_sold': 50000.00, 'date_sold': datetime.datetime(2022,1,5)},
+        ], batch_size=2, bind=self.engine)
+
+        self.assertEqual(result.inserted, 2)
+        self.assertEqual(result.batches, 2)
+        self.assertEqual([rejection.index for rejection in result.rejected], [1, 2])
+        self.assertIn('unknown home_id', result.rejected[1].reason)
+
+        sales = self.session.query(Sales).order_by(Sales.sale_id).all()
+        self.assertEqual([sale.commission for sale in sales], [800000.00*0.05, 50000.00*0.1])
+        self.assertEqual(sales[1].month_sold, 202201)
+        self.assertEqual(self.session.query(func.count(Homes.home_id)).filter(Homes.sold == True).scalar(), 2)
+
+    def test_record_sales_invalid_values(self):
+        """
+        Prices which aren't positive numbers and dates which aren't dates are rejected one sale at a time, 
+        without rolling back the rest of their batch. 
+        """
+        result = record_sales([
+            (1, 1, 1, float('nan')),
+            {'home_id': 2, 'agent_id': 1, 'buyer_id': 1, 'price_sold': 50000.00, 'date_sold': '2022-06-01'},
+            (2, 1, 1, 50000.00),
+        ], bind=self.engine)
+
+        self.assertEqual(result.inserted, 1)
+        self.assertEqual([(rejection.index, rejection.reason) for rejection in result.rejected],
+                         [(0, 'price_sold must be positive'), (1, "date_sold must be a date, got '2022-06-01'")])
+        self.assertEqual([(sale.home_id, sale.commission) for sale in self.session.query(Sales)], [(2, 50000.00*0.1)])
+
+    def test_record_sales_batch_rollback(self):
+        """
+        A batch that fails in the database is rolled back as a whole. 
+        """
+        with self.engine.begin() as conn:
+            conn.execute(text("CREATE TRIGGER reject_sale BEFORE INSERT ON sales WHEN NEW.home_id = 2 BEGIN SELECT RAISE(ABORT, 'rejected'); END"))
+        result = record_sales([(1, 1, 1, 800000.00), (2, 1, 1, 50000.00)], bind=self.engine)
+
+        self.assertEqual(result.inserted, 0)
+        self.assertEqual(len(result.rejected), 2)
+        self.assertEqual(self.session.query(func.count(Sales.sale_id)).scalar(), 0)
+        self.assertEqual(self.session.query(func.count(Homes.home_id)).filter(Homes.sold == True).scalar(), 0)
+
+    def test_record_sales_unexpected_fields(self):
+        """
+        Sales which carry their own ID are rejected, so the rest of their batch is still recorded in full. 
+        """
+        self.session.add(Homes(beds=3, baths=2, address='1 Kellum Ct', zipcode='94103', price_listed=200000.00, date_listed=date(2021,6,1), month_listed=202106))
+        self.session.commit()
+        result = record_sales([(1, 1, 1, 800000.00), (2, 1, 1, 50000.00),
+                               {'home_id': 3, 'agent_id': 1, 'buyer_id': 1, 'price_sold': 200000.00, 'sale_id': 100}], bind=self.engine)
+
+        self.assertEqual(result.inserted, 2)
+        self.assertEqual([(rejection.index, rejection.reason) for rejection in result.rejected], [(2, 'unexpected sale_id')])
+        self.assertEqual(check_monthly_sales(bind=self.engine), [])
+        self.assertEqual([change.sale_id for change in self.session.query(SaleChanges).filter(SaleChanges.kind == 'sale').order_by(SaleChanges.change_id)], [1, 2])
+
+class TestReportIndexes(DatabaseTestCase):
+    def test_ensure_indexes(self):
+        """
+        Indexes missing from an existing database are created in place, and only once. 
+        """
+        with self.engine.begin() as conn:
+            conn.execute(text('DROP INDEX idx_sales_month_agent'))
+        self.assertEqual(ensure_indexes(self.engine), ['idx_sales_month_agent'])
+        self.assertEqual(ensure_indexes(self.engine), [])
+        index_names = {index['name'] for index in inspect(self.engine).get_indexes('sales')}
+        self.assertIn('idx_sales_month_agent', index_names)
+
+    def test_reports_use_indexes(self):
+        """
+        Every monthly report is planned with its covering index instead of a full table scan of sales. 
+        """
+        for name, (uses_index, plan) in verify_report_indexes(self.engine, report_queries(self.session, 202201)).items():
+            self.assertTrue(uses_index, "{} does not use its index: {}".format(name, plan))
+            self.assertFalse(any(line.startswith('SCAN sales') for line in plan))
+
+        # reading every entry of the index, rather than searching it, doesn't count
+        every_month = self.session.query(Sales.month_sold, func.sum(Sales.commission)).group_by(Sales.month_sold)
+        uses_index, plan = verify_report_indexes(self.engine, {'average_selling_price': every_month})['average_selling_price']
+        self.assertFalse(uses_index, plan)
+
+class TestCommissionLedger(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.session.add_all([Homes(address='22 Nathaniel'), Homes(address='16 Turk St'), Homes(address='5 Rue Delille'), 
+                              Agents(office_id=1, first_name='Dwight'), Agents(office_id=1, first_name='Jim'), Buyers(first_name='Toph')])
+        self.session.commit()
+        record_sales([
+            {'home_id': 1, 'agent_id': 1, 'buyer_id': 1, 'price_sold': 50000.00, 'date_sold': datetime.datetime(2022,1,1)},
+            {'home_id': 2, 'agent_id': 1, 'buyer_id': 1, 'price_sold': 150000.00, 'date_sold': datetime.datetime(2022,1,1)},
+            {'home_id': 3, 'agent_id': 2, 'buyer_id': 1, 'price_sold': 300000.00, 'date_sold': datetime.datetime(2022,2,1)},
+        ], batch_size=2, bind=self.engine)
+
+    def ledger(self):
+        return {(row.agent_id, row.month): (row.commission_amount, row.sale_count) for row in self.session.query(Commission)}
+
+    def test_ledger_updated_by_sales(self):
+        """
+        Each recorded sale adds to its agent's commission for the month, across batches. 
+        """
+        self.assertEqual(self.ledger(), {(1, 202201): (5000.00 + 11250.00, 2), (2, 202202): (18000.00, 1)})
+        record_sales([{'home_id': 1, 'agent_id': 1, 'buyer_id': 1, 'price_sold': 50000.00, 'date_sold': datetime.datetime(2022,1,1)}], bind=self.engine)
+        self.assertEqual(self.ledger()[(1, 202201)], (5000.00 + 11250.00 + 5000.00, 3))
+
+    def test_rebuild_commissions(self):
+        """
+        Rebuilding one month repairs only that month of the ledger. 
+        """
+        self.session.query(Commission).update({'commission_amount': 0})
+        self.session.commit()
+        rebuild_commissions(month=202201, bind=self.engine)
+        self.session.expire_all()
+        self.assertEqual(self.ledger(), {(1, 202201): (16250.00, 2), (2, 202202): (0, 1)})
+        rebuild_commissions(bind=self.engine)
+        self.session.expire_all()
+        self.assertEqual(self.ledger()[(2, 202202)], (18000.00, 1))
+
+    def test_migrate_commission_table(self):
+        """
+        A commission table in the old one-row-per-agent format is replaced by the ledger. 
+        """
+        self.session.close()
+        with self.engine.begin() as conn:
+            conn.execute(text('DROP TABLE commission'))
+            conn.execute(text('CREATE TABLE commission (commission_id INTEGER PRIMARY KEY, first_name TEXT, last_name TEXT, email TEXT, commission_amount FLOAT)'))
+        self.assertTrue(migrate_commission_table(self.engine))
+        self.assertFalse(migrate_commission_table(self.engine))
+        self.assertEqual(len(self.ledger()), 2)
+
+class TestMonthlyLeaderboards(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.session.add_all([Offices(name='SF Real Estate'), Offices(name='London Real Estate'),
+                              Homes(address='22 Nathaniel'), Homes(address='16 Turk St'), Homes(address='5 Rue Delille'),
+                              Agents(office_id=1, first_name='Dwight'), Agents(office_id=2, first_name='Jim'), Buyers(first_name='Toph')])
+        self.session.commit()
+        record_sales([
+            {'home_id': 1, 'agent_id': 1, 'buyer_id': 1, 'price_sold': 50000.00, 'date_sold': datetime.datetime(2022,1,1)},
+            {'home_id': 2, 'agent_id': 2, 'buyer_id': 1, 'price_sold': 150000.00, 'date_sold': datetime.datetime(2022,1,1)},
+            {'home_id': 3, 'agent_id': 2, 'buyer_id': 1, 'price_sold': 300000.00, 'date_sold': datetime.datetime(2022,2,1)},
+        ], bind=self.engine)
+
+    def test_leaderboards(self):
+        """
+        Leaderboards answer a single month or a range of months from the rollup tables. 
+        """
+        self.assertEqual(top_office_sale_counts(self.session, 202201).all(), [('SF Real Estate', 1), ('London Real Estate', 1)])
+        self.assertEqual(top_office_sale_amount(self.session, month_period(2022, 1, 202202)).all(), [('London Real Estate', 450000.00), ('SF Real Estate', 50000.00)])
+        self.assertEqual([row[0] for row in top_agents(self.session, 202202)], ['Jim'])
+        self.assertEqual(check_monthly_sales(bind=self.engine), [])
+
+    def test_check_and_rebuild(self):
+        """
+        The consistency checker finds leaderboard rows which disagree with the sales, and a rebuild repairs them. 
+        """
+        self.session.query(OfficeMonthlySales).filter(OfficeMonthlySales.office_id == 2).delete()
+        self.session.query(AgentMonthlySales).update({'sale_volume': 1.0})
+        self.session.commit()
+        mismatches = check_monthly_sales(month=202202, bind=self.engine)
+        self.assertEqual(mismatches, [('office_monthly_sales', (2, 202202), None, (1, 300000.00)), 
+                                      ('agent_monthly_sales', (2, 202202), (1, 1.0), (1, 300000.00))])
+        rebuild_monthly_sales(month=202202, bind=self.engine)
+        self.assertEqual(check_monthly_sales(month=202202, bind=self.engine), [])
+        self.assertEqual(len(check_monthly_sales(bind=self.engine)), 3)
+        rebuild_monthly_sales(bind=self.engine)
+        self.assertEqual(check_monthly_sales(bind=self.engine), [])
+
+class TestPeriods(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.session.add_all([Offices(name='SF Real Estate'), Homes(address='22 Nathaniel'), Agents(office_id=1, first_name='Dwight'), Buyers(first_name='Toph')])
+        self.session.commit()
+        record_sales([
+            {'home_id': 1, 'agent_id': 1, 'buyer_id': 1, 'price_sold': 100000.00, 'date_sold': datetime.datetime(2021,12,31)},
+            {'home_id': 1, 'agent_id': 1, 'buyer_id': 1, 'price_sold': 200000.00, 'date_sold': datetime.datetime(2022,1,15)},
+            {'home_id': 1, 'agent_id': 1, 'buyer_id': 1, 'price_sold': 400000.00, 'date_sold': datetime.datetime(2022,3,31)},
+            {'home_id': 1, 'agent_id': 1, 'buyer_id': 1, 'price_sold': 800000.00, 'date_sold': datetime.datetime(2022,4,1)},
+        ], bind=self.engine)
+
+    def test_month_keys_sort(self):
+        """
+        Month keys sort in time order across the turn of a year. 
+        """
+        self.assertLess(month_key(date(2021,12,1)), month_key(date(2022,1,1)))
+        self.assertEqual(month_key(date(2022,1,1)), 202201)
+
+    def test_periods(self):
+        """
+        Quarters, years to date and rolling windows select the sales made in those days. 
+        """
+        self.assertEqual(period_months(quarter_period(2022, 1)), (202201, 202203))
+        self.assertIsNone(period_months(rolling_days(30, today=date(2022,4,1))))
+        self.assertEqual(average_selling_price(self.session, quarter_period(2022, 1)).scalar(), 300000.00)
+        self.assertEqual(average_selling_price(self.session, year_to_date(today=date(2022,3,31))).scalar(), 300000.00)
+        self.assertEqual(average_selling_price(self.session, rolling_days(2, today=date(2022,4,1))).scalar(), 600000.00)
+        self.assertEqual(top_office_sale_counts(self.session, month_period(2021, 12, 202203)).all(), [('SF Real Estate', 3)])
+        self.assertEqual(top_agents(self.session, rolling_days(30, today=date(2022,4,1))).all(), [('Dwight', None, 1200000.00, None)])
+
+    def test_periods_use_indexes(self):
+        """
+        Whole-month periods and other ranges of days are both served by index range scans. 
+        """
+        for period, indexes in [(quarter_period(2022, 1), REPORT_INDEXES), (rolling_days(30), dict.fromkeys(REPORT_INDEXES, PERIOD_REPORT_INDEX))]:
+            results = verify_report_indexes(self.engine, report_queries(self.session, period), indexes)
+            for name, (uses_index, plan) in results.items():
+                self.assertTrue(uses_index, "{} does not use its index: {}".format(name, plan))
+
+    def test_migrate_period_keys(self):
+        """
+        Month keys in the old int(str(year) + str(month)) format are backfilled, and the summary tables rebuilt. 
+        """
+        self.session.query(Sales).update({'month_sold': 20221})
+        self.session.add(Homes(address='16 Turk St', date_listed=date(2021,9,21), month_listed=20219))
+        # init_db found no old keys in the new database, so it won't look again
+        self.assertFalse(migrate_period_keys(self.engine))
+        self.session.query(Migrations).delete()
+        self.session.commit()
+        self.assertTrue(migrate_period_keys(self.engine))
+        self.assertFalse(migrate_period_keys(self.engine))
+        self.session.expire_all()
+        self.assertEqual([sale.month_sold for sale in self.session.query(Sales).order_by(Sales.sale_id)], [202112, 202201, 202203, 202204])
+        self.assertEqual(self.session.query(Homes).get(2).month_listed, 202109)
+        self.assertEqual(check_monthly_sales(bind=self.engine), [])
+
+class TestCommissionTiers(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.session.add_all([Homes(address='22 Nathaniel'), Agents(office_id=1, first_name='Dwight'), Buyers(first_name='Toph')])
+        self.session.commit()
+
+    def record(self, prices, day):
+        record_sales([{'home_id': 1, 'agent_id': 1, 'buyer_id': 1, 'price_sold': price, 'date_sold': day} for price in prices], bind=self.engine)
+
+    def commissions(self):
+        self.session.expire_all()
+        return [sale.commission for sale in self.session.query(Sales).order_by(Sales.sale_id)]
+
+    def test_default_tiers(self):
+        """
+        New databases start with the default tiers, including the edges of each tier. 
+        """
+        self.record([99999.00, 100000.00, 200000.00, 200001.00, 1000000.00, 1100000.00], datetime.datetime(2022,1,1))
+        self.assertEqual(self.commissions(), [99999.00*0.1, 100000.00*0.075, 200000.00*0.075, 200001.00*0.06, 1000000.00*0.05, 1100000.00*0.04])
+
+    def test_recompute_commissions(self):
+        """
+        A new set of tiers applies from its effective date, and recomputing re-prices only the sales 
+        since that date (and their months of the commission ledger), chunk by chunk. 
+        """
+        self.record([50000.00, 300000.00], datetime.datetime(2022,1,10))
+        self.record([50000.00, 300000.00], datetime.datetime(2022,2,10))
+        self.session.add_all([CommissionTiers(effective_from=datetime.datetime(2022,2,1), max_price=100000.00, max_inclusive=True, rate=0.2),
+                              CommissionTiers(effective_from=datetime.datetime(2022,2,1), max_price=None, rate=0.01)])
+        self.session.commit()
+
+        self.assertEqual(recompute_commissions(since=date(2022,2,1), chunk_size=1, bind=self.engine), 2)
+        self.assertEqual(self.commissions(), [5000.00, 18000.00, 10000.00, 3000.00])
+        ledger = {row.month: row.commission_amount for row in self.session.query(Commission)}
+        self.assertEqual(ledger, {202201: 23000.00, 202202: 13000.00})
+
+        # Sales recorded after the change are priced with the new tiers straight away
+        self.record([50000.00], datetime.datetime(2022,3,1))
+        self.assertEqual(self.commissions()[-1], 10000.00)
+
+    def test_session_sales_priced(self):
+        """
+        Sales added through a session rather than record_sales() are recorded when they are flushed: 
+        priced, added to the commission ledger and leaderboards, and logged to the change feed. 
+        """
+        self.session.query(Homes).update({'date_listed': datetime.datetime(2022,1,1)})
+        sale = Sales(home_id=1, agent_id=1, buyer_id=1, price_sold=300000.00, date_sold=datetime.datetime(2022,1,11))
+        self.session.add(sale)
+        self.session.flush()
+        self.assertEqual((sale.commission, sale.days_on_market), (18000.00, 10.0))
+        self.session.commit()
+        self.assertEqual(self.commissions(), [18000.00])
+        self.assertEqual(self.session.query(Commission.month, Commission.commission_amount, Commission.sale_count).all(), [(202201, 18000.00, 1)])
+        self.assertEqual(check_monthly_sales(bind=self.engine), [])
+        self.assertEqual(self.session.query(SaleChanges.sale_id, SaleChanges.commission).all(), [(1, 18000.00)])
+
+        # without any tiers, sales can't be priced
+        self.session.query(CommissionTiers).delete()
+        self.session.commit()
+        with self.assertRaises(ValueError):
+            self.record([50000.00], datetime.datetime(2022,1,1))
+
+class TestSalesWriter(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        url = 'sqlite:///' + os.path.join(self.directory.name, 'real_estate.db')
+        # a short busy timeout, so contention shows up as lock errors which the writer must retry
+        self.engine = create_writer_engine(url, pool_size=4, busy_timeout=0.01)
+        Session = sessionmaker(bind=self.engine)
+        self.session = Session()
+        self.session.add_all([Offices(name='SF Real Estate')] + [Homes(address=str(number)) for number in range(10)] + 
+                             [Agents(office_id=1, first_name=str(number)) for number in range(4)] + [Buyers(first_name='Toph')])
+        self.session.commit()
+        self.session.close()
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.directory.cleanup()
+
+    def test_concurrent_writers(self):
+        """
+        Stress test: several threads recording sales at once through one writer lose no sales, 
+        and the commission ledger and leaderboards count every one of them. 
+        """
+        writer = SalesWriter(bind=self.engine, max_retries=100, backoff=0.001, max_backoff=0.05)
+
+        def record_one_by_one(agent_id):
+            for number in range(20):
+                writer.record(number % 10 + 1, agent_id, 1, 100000.00 + number)
+
+        def record_in_batches():
+            writer.record_many([(number % 10 + 1, 4, 1, 50000.00) for number in range(40)], batch_size=10)
+
+        threads = [threading.Thread(target=record_one_by_one, args=(agent_id,)) for agent_id in (1, 2, 3)]
+        threads.append(threading.Thread(target=record_in_batches))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        stats = writer.stats()
+        self.assertEqual((stats['recorded'], stats['failed']), (100, 0))
+        self.assertGreater(stats['sales_per_second'], 0)
+        session = sessionmaker(bind=self.engine)()
+        self.assertEqual(session.query(func.count(Sales.sale_id)).scalar(), 100)
+        self.assertEqual(session.query(func.sum(Commission.sale_count)).scalar(), 100)
+        self.assertEqual(session.query(func.count(Sales.sale_id)).filter(Sales.commission == None).scalar(), 0)
+        self.assertEqual(check_monthly_sales(bind=self.engine), [])
+        session.close()
+
+class TestGenerateData(unittest.TestCase):
+    def generated(self, seed):
+        engine = create_engine('sqlite:///:memory:')
+        Base.metadata.create_all(engine)
+        generate(Scale(offices=2, agents=5, sellers=10, buyers=10, homes=20, sales=50), seed=seed, bind=engine, batch_size=16)
+        return engine
+
+    def test_generate(self):
+        """
+        Generated data has the rows asked for, every sale is priced and counted in the
+        summary tables, sales come after their listing, and the same seed gives the same data.
+        """
+        engine = self.generated(seed=1)
+        session = sessionmaker(bind=engine)()
+        self.assertEqual(session.query(func.count(Homes.home_id)).scalar(), 20)
+        self.assertEqual(session.query(func.count(Listings.listing_id)).scalar(), 20)
+        self.assertEqual(session.query(func.count(Sales.sale_id)).scalar(), 50)
+        self.assertEqual(session.query(func.count(Sales.sale_id)).filter(Sales.commission == None).scalar(), 0)
+        self.assertEqual(session.query(func.sum(Commission.sale_count)).scalar(), 50)
+        self.assertEqual(check_monthly_sales(bind=engine), [])
+        self.assertEqual(session.query(func.count(Sales.sale_id)).join(Homes, Homes.home_id == Sales.home_id)
+                         .filter(Sales.date_sold <= Homes.date_listed).scalar(), 0)
+
+        sales = lambda engine: engine.execute(text('SELECT home_id, agent_id, price_sold, date_sold FROM sales ORDER BY sale_id')).fetchall()
+        self.assertEqual(sales(engine), sales(self.generated(seed=1)))
+        self.assertNotEqual(sales(engine), sales(self.generated(seed=2)))
+        session.close()
+
+class TestExport(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.session.add(Offices(name='Dunder Mifflin'))
+        self.session.add(Agents(office_id=1, first_name='Jim', last_name='Halpert', email='jim@dm.com'))
+        self.session.add_all([Homes(address='1 Slough Ave', date_listed=datetime.datetime(2022, 6, 1)),
+                              Homes(address='2 Slough Ave', date_listed=datetime.datetime(2022, 6, 5))])
+        self.session.add(Buyers(first_name='Toby'))
+        self.session.add_all([Sales(home_id=1, agent_id=1, buyer_id=1, price_sold=200000.00, date_sold=datetime.datetime(2022, 6, 11)),
+                              Sales(home_id=2, agent_id=1, buyer_id=1, price_sold=150000.00, date_sold=datetime.datetime(2022, 6, 25))])
+        self.session.commit()
+
+    def test_export(self):
+        """
+        Reports are streamed out as CSV with a header row, or JSON lines keyed by column,
+        and reports which need a period refuse to run without one.
+        """
+        output = io.StringIO()
+        self.assertEqual(export_report(self.session, 'days_on_market', output, 202206), 2)
+        self.assertEqual(output.getvalue().splitlines(), ['address,days_on_market', '1 Slough Ave,10.0', '2 Slough Ave,20.0'])
+
+        output = io.StringIO()
+        self.assertEqual(export_report(self.session, 'top_agents', output, 202206, format='jsonl', batch_size=1), 1)
+        self.assertEqual(json.loads(output.getvalue()),
+                         {'first_name': 'Jim', 'last_name': 'Halpert', 'sale_volume': 350000.0, 'email': 'jim@dm.com'})
+
+        output = io.StringIO()
+        self.assertEqual(write_jsonl(iter([(date(2022, 6, 1), 1)]), output, ['day', 'count']), 1)
+        self.assertEqual(output.getvalue(), '{"day": "2022-06-01", "count": 1}\n')
+
+        with self.assertRaises(ValueError):
+            export_report(self.session, 'top_agents', io.StringIO())
+        with self.assertRaises(ValueError):
+            export_report(self.session, 'days_on_market', io.StringIO(), format='xml')
+
+class TestReportCache(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.session.add(Offices(name='Dunder Mifflin'))
+        self.session.add(Agents(office_id=1, first_name='Jim', last_name='Halpert'))
+        self.session.add_all([Homes(address=str(number)) for number in range(4)])
+        self.session.add(Buyers(first_name='Toby'))
+        self.session.commit()
+        self.this_month = month_key(date.today())
+        self.last_month = month_key(date.today().replace(day=1) - datetime.timedelta(days=1))
+        record_sales([{'home_id': 1, 'agent_id': 1, 'buyer_id': 1, 'price_sold': 100000.00, 'date_sold': date.today().replace(day=1) - datetime.timedelta(days=1)},
+                      (2, 1, 1, 200000.00)], bind=self.engine)
+
+    def test_cache(self):
+        """
+        Results are reused until a table the report reads is written to, past months
+        survive sales recorded this month, and the least recently used results are evicted.
+        """
+        cache = ReportCache(max_entries=3)
+        self.assertEqual(cache.get(self.session, 'average_selling_price', self.this_month)[0][0], 200000.00)
+        self.assertEqual(cache.get(self.session, 'average_selling_price', self.last_month)[0][0], 100000.00)
+        cache.get(self.session, 'average_selling_price', self.this_month)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+        # a sale this month invalidates this month, but not last month
+        record_sales([(3, 1, 1, 400000.00)], bind=self.engine)
+        self.assertEqual(cache.get(self.session, 'average_selling_price', self.this_month)[0][0], 300000.00)
+        cache.get(self.session, 'average_selling_price', self.last_month)
+        self.assertEqual((cache.hits, cache.misses, cache.invalidations), (2, 3, 1))
+
+        # a sale backdated to last month invalidates it
+        record_sales([{'home_id': 4, 'agent_id': 1, 'buyer_id': 1, 'price_sold': 300000.00, 'date_sold': date.today().replace(day=1) - datetime.timedelta(days=1)}],
+                     bind=self.engine)
+        self.assertEqual(cache.get(self.session, 'average_selling_price', self.last_month)[0][0], 200000.00)
+        self.assertEqual(cache.invalidations, 2)
+
+        for name in ['top_agents', 'top_office_sale_counts']:
+            cache.get(self.session, name, self.this_month)
+        self.assertEqual((cache.stats()['entries'], cache.evictions), (3, 1))
+        with self.assertRaises(ValueError):
+            cache.get(self.session, 'validate_top_agents')
+
+    def test_cache_oversized(self):
+        """
+        A result bigger than max_rows is returned without being cached, and without evicting the others.
+        """
+        record_sales([(3, 1, 1, 400000.00)], bind=self.engine)
+        cache = ReportCache(max_rows=1)
+        cache.get(self.session, 'average_selling_price', self.this_month)
+        rows = cache.get(self.session, 'all_selling_prices', self.this_month)
+        self.assertEqual(len(rows), 2)
+        self.assertEqual((cache.stats()['entries'], cache.stats()['rows'], cache.evictions), (1, 1, 0))
+
+class TestInstrumentation(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.session.add(Offices(name='Dunder Mifflin'))
+        self.session.add(Agents(office_id=1, first_name='Jim'))
+        self.session.add_all([Homes(address=str(number)) for number in range(3)])
+        self.session.add(Buyers(first_name='Toby'))
+        self.session.commit()
+
+    def test_instrumentation(self):
+        """
+        Statements are counted and timed, rows written are counted, slow queries are logged,
+        full scans have their plan captured (and index searches don't), and everything exports as JSON.
+        """
+        instrumentation = Instrumentation(slow_threshold=0).attach(self.engine)
+        record_sales([(1, 1, 1, 100000.00), (2, 1, 1, 200000.00)], bind=self.engine)
+        for _ in range(3):
+            average_selling_price(self.session, month_key(date.today())).all()
+        self.session.query(Sales.sale_id, Sales.price_sold).all()
+        with self.assertLogs('real_estate.slow_queries', 'WARNING'):
+            average_selling_price(self.session).all()
+
+        snapshot = instrumentation.snapshot()
+        statements = {statement['statement']: statement for statement in snapshot['statements']}
+        monthly_average = [statement for statement in statements.values() if 'average_price' in statement['statement'] and 'WHERE' in statement['statement']]
+        self.assertEqual([statement['count'] for statement in monthly_average], [3])
+        self.assertEqual(sum(monthly_average[0]['histogram'].values()), 3)
+        self.assertIn(2, [statement['rows'] for statement in statements.values() if statement['statement'].startswith('INSERT INTO sales')])
+        self.assertEqual(len(snapshot['slow_queries']), sum(statement['count'] for statement in statements.values()))
+
+        full_scans = [scan['statement'] for scan in snapshot['full_scans']]
+        self.assertTrue(any('FROM sales' in statement and 'WHERE' not in statement for statement in full_scans))
+        self.assertNotIn(monthly_average[0]['statement'], full_scans)
+
+        output = io.StringIO()
+        instrumentation.export_json(output)
+        self.assertEqual(json.loads(output.getvalue())['full_scans'], snapshot['full_scans'])
+        instrumentation.detach()
+        average_selling_price(self.session).all()
+        self.assertEqual(instrumentation.snapshot()['statements'], snapshot['statements'])
+
+    def test_instrumentation_statement_keys(self):
+        """
+        Queries with IN lists of different lengths are counted as one statement, and statements past
+        max_statements are counted together rather than growing the map.
+        """
+        instrumentation = Instrumentation(max_statements=2).attach(self.engine)
+        for ids in ([1], [1, 2], [1, 2, 3]):
+            self.session.query(Homes.address).filter(Homes.home_id.in_(ids)).all()
+        self.session.query(Buyers.first_name).all()
+        self.session.query(Agents.first_name).all()
+        instrumentation.detach()
+
+        counts = {statement['statement']: statement['count'] for statement in instrumentation.snapshot()['statements']}
+        self.assertEqual(sorted(counts.values()), [1, 1, 3])
+        self.assertIn('IN (?, ...)', [key for key, count in counts.items() if count == 3][0])
+        self.assertEqual(counts[OTHER_STATEMENTS], 1)
+        self.assertEqual(len(instrumentation._explained), 2)
+
+class TestReportRunner(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.url = 'sqlite:///' + os.path.join(self.directory.name, 'real_estate.db')
+        engine = create_engine(self.url)
+        init_db(engine)
+        generate(Scale(offices=3, agents=10, sellers=10, buyers=10, homes=40, sales=200), bind=engine)
+        engine.dispose()
+        self.reader = create_reader_engine(self.url, pool_size=3)
+
+    def tearDown(self):
+        self.reader.dispose()
+        self.directory.cleanup()
+
+    def test_run_reports(self):
+        """
+        Reports run in parallel give the same results as run one after another, and
+        reader connections can't write.
+        """
+        for period in [202106, rolling_days(90, date(2021, 6, 30))]:
+            sequential = run_reports(period, concurrency=1, bind=self.reader)
+            parallel = run_reports(period, concurrency=3, bind=self.reader)
+            self.assertEqual(list(parallel.results), list(MONTHLY_REPORTS))
+            self.assertEqual(parallel.results, sequential.results)
+            self.assertTrue(parallel['days_on_market'])
+            self.assertEqual(set(parallel.timings), set(MONTHLY_REPORTS))
+            self.assertGreater(parallel.speedup(), 0)
+
+        with self.assertRaises(OperationalError):
+            with self.reader.begin() as conn:
+                conn.execute(text('DELETE FROM sales'))
+        with self.assertRaises(ValueError):
+            create_reader_engine('sqlite:///:memory:')
+
+class TestSnapshot(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        generate(Scale(offices=3, agents=10, sellers=10, buyers=10, homes=40, sales=300), bind=self.engine)
+
+    def test_snapshot(self):
+        """
+        Aggregations over the snapshot match the same aggregation in SQL, percentiles
+        interpolate between ranks, and a saved snapshot reopens with the same results.
+        """
+        snapshot = load_snapshot(self.engine, batch_size=64)
+        self.assertEqual(len(snapshot), 300)
+        expected = self.engine.execute(text(
+            'SELECT offices.name, sales.month_sold, sum(sales.commission) FROM sales '
+            'JOIN agents ON sales.agent_id = agents.agent_id JOIN offices ON agents.office_id = offices.office_id '
+            'GROUP BY offices.name, sales.month_sold')).fetchall()
+        commission = snapshot.aggregate(('office', 'month'), 'commission')
+        self.assertEqual(set(commission), {(name, month) for name, month, _ in expected})
+        for name, month, total in expected:
+            self.assertAlmostEqual(commission[(name, month)], total, places=4)
+
+        months = (202101, 202106)
+        counts = snapshot.aggregate('zipcode', how='count', months=months)
+        self.assertEqual(sum(counts.values()), self.engine.execute(
+            text('SELECT count(*) FROM sales WHERE month_sold BETWEEN 202101 AND 202106')).scalar())
+        zipcode, count = next(iter(counts.items()))
+        prices = sorted(price for price, code in zip(snapshot['price'], snapshot['zipcode'])
+                        if snapshot.decode('zipcode', code) == zipcode and price == price)
+        lowest, median, highest = snapshot.percentiles('zipcode', 'price', (0, 50, 100))[zipcode]
+        self.assertEqual((lowest, highest), (prices[0], prices[-1]))
+        self.assertLessEqual(lowest, median)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'sales.snapshot')
+            snapshot.save(path)
+            reopened = open_snapshot(path)
+            self.assertEqual(len(reopened), 300)
+            self.assertEqual(reopened.aggregate(('office', 'month'), 'commission'), commission)
+            self.assertEqual(reopened.aggregate('zipcode', how='count', months=months), counts)
+            reopened.close()
+        with self.assertRaises(ValueError):
+            snapshot.aggregate('office', how='median')
+
+class TestLoadCsv(DatabaseTestCase):
+    def test_load_csv(self):
+        """
+        Rows are loaded in batches with their natural keys resolved to IDs, invalid rows,
+        unknown references and duplicates are rejected with their line, and reloading adds nothing.
+        """
+        load = lambda table, text, **kwargs: load_csv(table, io.StringIO(text), bind=self.engine, **kwargs)
+        self.assertEqual(load('offices', 'name\nDunder Mifflin\nWernham Hogg\n').loaded, 2)
+        agents = load('agents', 'first_name,last_name,email,office\n'
+                                'Jim,Halpert,jim@dm.com,Dunder Mifflin\n'
+                                'David,Brent,david@wh.com,Wernham Hogg\n'
+                                'Ryan,Howard,ryan@dm.com,Vance Refrigeration\n'
+                                'Jim,Halpert,jim@dm.com,Dunder Mifflin\n', batch_size=1)
+        self.assertEqual((agents.loaded, agents.batches), (2, 2))
+        self.assertEqual([(rejected.line, rejected.reason) for rejected in agents.rejected],
+                         [(4, 'unknown office Vance Refrigeration'), (5, 'duplicate jim@dm.com')])
+        self.assertEqual(self.session.query(Agents.office_id).filter(Agents.email == 'david@wh.com').scalar(), 2)
+
+        load('sellers', 'first_name,last_name,email\nToby,Flenderson,toby@dm.com\n')
+        homes = load('homes', 'address,zipcode,beds,baths,price_listed,date_listed\n'
+                              '1725 Slough Ave,18505,3,2,150000,2022-06-01\n'
+                              '1 Paper St,18505,two,1,90000,2022-06-02\n')
+        self.assertEqual([rejected.reason for rejected in homes.rejected], ["invalid beds 'two'"])
+        home = self.session.query(Homes).one()
+        self.assertEqual((home.beds, home.date_listed, home.month_listed, home.sold), (3, datetime.datetime(2022, 6, 1), 202206, False))
+
+        listings = load('listings', 'address,zipcode,agent_email,seller_email\n'
+                                    '1725 Slough Ave,18505,jim@dm.com,toby@dm.com\n'
+                                    '1 Paper St,18505,jim@dm.com,toby@dm.com\n')
+        self.assertEqual([rejected.reason for rejected in listings.rejected], ['unknown home 1 Paper St, 18505'])
+        self.assertEqual(self.session.query(Listings.home_id, Listings.agent_id, Listings.seller_id).all(), [(1, 1, 1)])
+        self.assertGreater(listings.rows_per_second(), 0)
+
+        self.assertEqual(load('offices', 'name\nDunder Mifflin\n').loaded, 0)
+        self.assertEqual(self.session.query(func.count(Offices.office_id)).scalar(), 2)
+
+class TestSearchHomes(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        # several homes share each listing date, so pages have to break ties by home ID
+        self.session.add_all([Homes(address=str(number), zipcode='1000{}'.format(number % 3), beds=number % 5, baths=1,
+                                    price_listed=100000 + 10000 * number, date_listed=datetime.datetime(2022, 1, 1 + number % 7),
+                                    sold=number % 10 == 0) for number in range(100)])
+        self.session.add(Homes(address='unlisted', zipcode='10000', beds=4, price_listed=200000))
+        self.session.commit()
+
+    def test_search_homes(self):
+        """
+        Paging through a search returns every matching home exactly once, newest first,
+        and both the first and later pages are read from a search index.
+        """
+        filters = {'zipcode': '10001', 'min_beds': 2, 'min_price': 150000, 'max_price': 900000}
+        expected = [home.home_id for home in self.session.query(Homes).filter(
+            Homes.zipcode == '10001', Homes.beds >= 2, Homes.price_listed.between(150000, 900000),
+            Homes.sold == False, Homes.date_listed.isnot(None)).order_by(Homes.date_listed.desc(), Homes.home_id.desc())]
+        self.assertTrue(len(expected) > 4)
+
+        found, after, pages = [], None, 0
+        while True:
+            page = search_homes(self.session, **filters, after=after, page_size=4)
+            found.extend(home.home_id for home in page.homes)
+            pages += 1
+            if page.next_page is None:
+                break
+            after = page.next_page
+        self.assertEqual(found, expected)
+        self.assertEqual(pages, len(expected) // 4 + 1)
+
+        self.assertEqual(len(search_homes(self.session, include_sold=True, page_size=200).homes), 100)
+        ensure_indexes(self.engine)
+        plan = explain_query_plan(self.engine, search_query(self.session, **filters).limit(4).statement)
+        self.assertIn('idx_homes_search_zipcode', plan[0])
+        self.assertFalse(any('TEMP B-TREE' in detail for detail in plan))
+
+class TestSharding(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.router = ShardRouter(self.directory.name)
+
+    def tearDown(self):
+        self.router.close()
+        self.directory.cleanup()
+
+    def test_sharding(self):
+        """
+        Sales are written to the shard of the agent's office, and merged reports give the
+        top offices and agents overall, and the average of every sale rather than of each office.
+        """
+        scranton, stamford = self.router.add_office('Scranton'), self.router.add_office('Stamford')
+        jim = self.router.add_agent(scranton, first_name='Jim')
+        dwight = self.router.add_agent(scranton, first_name='Dwight')
+        andy = self.router.add_agent(stamford, first_name='Andy')
+        homes = self.router.add_reference(Homes, [{'address': str(number)} for number in range(6)])
+        buyer, = self.router.add_reference(Buyers, [{'first_name': 'Toby'}])
+        seller, = self.router.add_reference(Sellers, [{'first_name': 'Jan'}])
+        with self.assertRaises(ValueError):
+            self.router.add_reference(Buyers, [{'buyer_id': 100, 'first_name': 'Pam'}])
+        self.router.add_listing(homes[0], andy, seller)
+
+        self.router.transaction(homes[0], andy, buyer, 400000.00)
+        result = self.router.record_sales([(homes[1], jim, buyer, 100000.00), (homes[2], dwight, buyer, 100000.00),
+                                           (homes[3], 42, buyer, 100000.00), (homes[4], dwight, buyer, 100000.00)])
+        self.assertEqual(result.inserted, 3)
+        self.assertEqual([(rejected.index, rejected.reason) for rejected in result.rejected], [(2, 'unknown agent_id 42')])
+
+        counts = {}
+        for office_id, engine in self.router.shards().items():
+            session = sessionmaker(bind=engine)()
+            counts[office_id] = (session.query(func.count(Sales.sale_id)).scalar(), session.query(func.count(Listings.listing_id)).scalar())
+            session.close()
+        self.assertEqual(counts, {scranton: (3, 0), stamford: (1, 1)})
+
+        month = month_key(date.today())
+        self.assertEqual([tuple(row) for row in self.router.top_office_sale_counts(month)], [('Scranton', 3), ('Stamford', 1)])
+        self.assertEqual([tuple(row) for row in self.router.top_office_sale_amount(month)], [('Stamford', 400000.00), ('Scranton', 300000.00)])
+        self.assertEqual([row[0] for row in self.router.top_agents(month, limit=2)], ['Andy', 'Dwight'])
+        # (400000 + 3 * 100000) / 4, not the average of the offices' averages (250000)
+        self.assertEqual(self.router.average_selling_price(month), 175000.00)
+
+        # reports read the shards without taking their write locks, so sales are recorded while they run
+        def count_while_writing(session):
+            count = session.query(func.count(Sales.sale_id)).scalar()
+            # a sale by one of the agents of the shard being read (each shard only holds its own office's agents)
+            self.router.transaction(homes[5], session.query(Agents.agent_id).first()[0], buyer, 100000.00)
+            return count
+        self.assertEqual(sorted(self.router._gather(count_while_writing)), [1, 3])
+        self.assertEqual([tuple(row) for row in self.router.top_office_sale_counts(month)], [('Scranton', 4), ('Stamford', 2)])
+
+        # a new router finds the offices, and the agents, already in the directory
+        self.router.close()
+        self.router = ShardRouter(self.directory.name)
+        self.assertEqual(set(self.router.shards()), {scranton, stamford})
+        self.assertEqual(self.router.office_of(andy), stamford)
+
+    def test_sharding_batches(self):
+        """
+        Each office's sales are written a batch at a time as they stream in, unknown agents are looked up
+        in the catalog once, and offices tied in a merged report are in office order.
+        """
+        scranton, stamford = self.router.add_office('Scranton'), self.router.add_office('Stamford')
+        jim, andy = self.router.add_agent(scranton, first_name='Jim'), self.router.add_agent(stamford, first_name='Andy')
+        homes = self.router.add_reference(Homes, [{'address': str(number)} for number in range(4)])
+        buyer, = self.router.add_reference(Buyers, [{'first_name': 'Toby'}])
+        lookups = []
+        event.listen(self.router.catalog, 'before_cursor_execute', lambda *args: lookups.append(args[2]))
+
+        result = self.router.record_sales(iter([(homes[0], andy, buyer, 100000.00), (homes[1], 42, buyer, 100000.00), (homes[2], jim, buyer, 100000.00),
+                                                (homes[3], 42, buyer, 100000.00)]), batch_size=1)
+        self.assertEqual((result.inserted, result.batches), (2, 2))
+        self.assertEqual([rejected.index for rejected in result.rejected], [1, 3])
+        self.assertEqual(len(lookups), 1)
+        self.assertEqual([tuple(row) for row in self.router.top_office_sale_counts(month_key(date.today()))], [('Scranton', 1), ('Stamford', 1)])
+
+class TestSeed(DatabaseTestCase):
+    def test_seed_change_feed(self):
+        """
+        Every sample sale is logged to the change feed, including the one added without transaction().
+        """
+        seed(self.engine)
+        changes = []
+        ChangeFeedConsumer('payouts', bind=self.engine).consume(lambda batch: changes.extend(change for change in batch if change.kind == 'sale'))
+        self.assertEqual(len(changes), self.session.query(func.count(Sales.sale_id)).scalar())
+        self.assertIn((7, datetime.datetime(2022,9,21)), [(change.home_id, change.date_sold) for change in changes])
+
+class TestChangeFeed(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.session.add(Offices(name='Dunder Mifflin'))
+        self.session.add(Agents(office_id=1, first_name='Jim'))
+        self.session.add_all([Homes(address=str(number)) for number in range(4)])
+        self.session.add(Buyers(first_name='Toby'))
+        self.session.commit()
+
+    def changes(self, consumer):
+        changes = []
+        consumer.consume(lambda batch: changes.extend((change.kind, change.home_id, change.sale_id) for change in batch))
+        return changes
+
+    def test_change_feed(self):
+        """
+        Sales and homes flipping to sold are logged in order, consumers only read changes
+        after their saved position, and compaction only removes changes every consumer has read.
+        """
+        transaction(1, 1, 1, 100000.00, bind=self.engine)
+        record_sales([(2, 1, 1, 200000.00), (1, 1, 1, 300000.00)], bind=self.engine)
+        payouts = ChangeFeedConsumer('payouts', bind=self.engine, batch_size=2)
+        self.assertEqual(self.changes(payouts), [('home_sold', 1, None), ('sale', 1, 1), ('home_sold', 2, None), ('sale', 2, 2), ('sale', 1, 3)])
+        self.assertEqual(self.changes(payouts), [])
+
+        home = self.session.query(Homes).get(2)
+        home.sold = False
+        self.session.commit()
+        transaction(3, 1, 1, 400000.00, bind=self.engine)
+        # a consumer picks up from its saved position after a restart
+        payouts = ChangeFeedConsumer('payouts', bind=self.engine)
+        self.assertEqual(self.changes(payouts), [('home_unsold', 2, None), ('home_sold', 3, None), ('sale', 3, 4)])
+        sale = self.session.query(SaleChanges).filter(SaleChanges.sale_id == 4).one()
+        self.assertEqual((sale.price_sold, sale.commission, sale.month_sold), (400000.00, 24000.00, month_key(date.today())))
+
+        dashboard = ChangeFeedConsumer('dashboard', bind=self.engine)
+        dashboard.acknowledge(dashboard.poll()[:3])
+        self.assertEqual(compact_changes(bind=self.engine, segment_size=2), 3)
+        self.assertEqual(len(self.changes(dashboard)), 5)
+        self.assertEqual(compact_changes(bind=self.engine), 5)
+        # change IDs carry on after the log is emptied
+        transaction(4, 1, 1, 100000.00, bind=self.engine)
+        self.assertEqual([change.change_id for change in payouts.poll()], [9, 10])
+
+class TestReportSnapshots(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.engine = create_writer_engine('sqlite:///' + os.path.join(self.directory.name, 'real_estate.db'))
+        generate(Scale(offices=2, agents=4, sellers=4, buyers=4, homes=10, sales=20), bind=self.engine)
+        self.snapshots = SnapshotManager(os.path.join(self.directory.name, 'snapshots'), self.engine, max_staleness=3600)
+
+    def tearDown(self):
+        self.snapshots.close()
+        self.engine.dispose()
+        self.directory.cleanup()
+
+    def sale_count(self, session):
+        try:
+            return session.query(func.count(Sales.sale_id)).scalar()
+        finally:
+            session.close()
+
+    def test_report_snapshots(self):
+        """
+        Snapshots are consistent copies taken without waiting for writers, sessions reuse the newest
+        snapshot until it is staler than allowed, and only the newest snapshots are kept.
+        """
+        # a write transaction is open (holding the write lock) while the snapshot is taken
+        with self.engine.begin() as conn:
+            conn.execute(insert(Sales).values(home_id=1, agent_id=1, buyer_id=1, price_sold=1.0))
+            self.snapshots.take()
+        self.assertEqual(self.sale_count(self.snapshots.session()), 20)
+        record_sales([(2, 1, 1, 100000.00)], bind=self.engine)
+        self.assertEqual(self.sale_count(self.snapshots.session()), 20)
+        self.assertEqual(self.sale_count(self.snapshots.session(max_staleness=0)), 22)
+        self.assertLess(self.snapshots.age(), 60)
+
+        self.snapshots.refresh()
+        self.assertEqual(len(self.snapshots.snapshots()), 2)
+        with self.assertRaises(OperationalError):
+            with self.snapshots.engine().begin() as conn:
+                conn.execute(text('DELETE FROM sales'))
+        # snapshots kept are found again after a restart
+        self.snapshots.close()
+        self.snapshots = SnapshotManager(self.snapshots.directory, self.engine, max_staleness=3600)
+        self.assertEqual(len(self.snapshots.snapshots()), 2)
+        self.assertEqual(self.sale_count(self.snapshots.session()), 22)
+
+class TestLeaderboards(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.session.add_all([Offices(name='Scranton'), Offices(name='Stamford')])
+        self.session.add_all([Agents(office_id=1, first_name='Jim'), Agents(office_id=1, first_name='Dwight'), Agents(office_id=2, first_name='Karen')])
+        self.session.add_all([Homes(address=str(number)) for number in range(6)])
+        self.session.add(Buyers(first_name='Toby'))
+        self.session.commit()
+        self.month = month_key(date.today())
+
+    def assertMatchesQueries(self, leaderboards):
+        self.assertEqual(leaderboards.top_agents(), [tuple(row) for row in top_agents(self.session, self.month)])
+        self.assertEqual(leaderboards.top_offices(), [tuple(row) for row in top_office_sale_counts(self.session, self.month)])
+        self.assertEqual(leaderboards.top_offices(by='sale_volume'), [tuple(row) for row in top_office_sale_amount(self.session, self.month)])
+
+    def test_leaderboards(self):
+        """
+        Leaderboards seeded from the database follow new sales, start again when the month changes,
+        and reconcile with the database.
+        """
+        transaction(1, 1, 1, 300000.00, bind=self.engine)
+        leaderboards = Leaderboards(bind=self.engine)
+        self.assertMatchesQueries(leaderboards)
+
+        record_sales([(2, 2, 1, 500000.00), (3, 3, 1, 100000.00), (4, 3, 1, 150000.00)], bind=self.engine)
+        self.assertEqual(leaderboards.update(), 6)
+        self.assertMatchesQueries(leaderboards)
+        self.assertEqual(leaderboards.top_offices(1, by='commission_amount'), [('Scranton', 48000.00)])
+        self.assertEqual([agent.first_name for agent in leaderboards.top_agents(by='sale_count')], ['Karen', 'Jim', 'Dwight'])
+
+        # a sale by a new agent, and a backdated sale which doesn't count this month
+        self.session.add(Agents(office_id=2, first_name='Andy'))
+        self.session.commit()
+        transaction(5, 4, 1, 900000.00, bind=self.engine)
+        record_sales([{'home_id': 6, 'agent_id': 1, 'buyer_id': 1, 'price_sold': 100.00, 'date_sold': datetime.datetime(2020, 1, 1)}], bind=self.engine)
+        leaderboards.update()
+        self.assertEqual(leaderboards.top_agents(1), [('Andy', None, 900000.00, None)])
+        self.assertMatchesQueries(leaderboards)
+
+        # the leaderboard tables drift from memory (as after a rebuild)
+        with self.engine.begin() as conn:
+            conn.execute(update(AgentMonthlySales).where(AgentMonthlySales.agent_id == 2).values(sale_volume=1.0))
+        self.assertEqual(leaderboards.reconcile(), [('agents', 2, (1, 500000.00, 30000.00), (1, 1.0, 30000.00))])
+        self.assertEqual(leaderboards.reconcile(), [])
+
+        with mock.patch('leaderboards.current_month', return_value=self.month + 1):
+            leaderboards.update()
+        self.assertEqual((leaderboards.month, leaderboards.top_agents(), leaderboards.top_offices()), (self.month + 1, [], []))
+
+class TestProfiles(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.session.add(Offices(name='Scranton'))
+        self.session.add_all([Agents(office_id=1, first_name=str(number)) for number in range(12)])
+        self.session.add_all([Homes(address=str(number)) for number in range(24)])
+        self.session.add(Buyers(first_name='Toby'))
+        self.session.add(Sellers(first_name='Jan'))
+        self.session.add_all([Listings(home_id=home_id, agent_id=(home_id - 1) % 12 + 1, seller_id=1) for home_id in range(1, 25)])
+        self.session.add_all([Sales(home_id=home_id, agent_id=(home_id - 1) % 12 + 1, buyer_id=1, price_sold=1000.0 * home_id) for home_id in range(1, 13)])
+        self.session.commit()
+        self.session.close()
+        self.statements = []
+        event.listen(self.engine, 'before_cursor_execute', self.count)
+
+    def tearDown(self):
+        event.remove(self.engine, 'before_cursor_execute', self.count)
+        super().tearDown()
+
+    def count(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    def test_profiles(self):
+        """
+        Profiles load an office's agents, listings, sales and homes in a fixed number of queries,
+        where reading them lazily takes queries per agent.
+        """
+        office = office_profile(self.session, 1)
+        profiles = [profile_dict(agent) for agent in office.agents]
+        self.assertEqual(len(self.statements), 4)
+        self.assertEqual(len(profiles), 12)
+        self.assertEqual([listing['address'] for listing in profiles[0]['listings']], ['0', '12'])
+        self.assertEqual([(sale['address'], sale['price_sold']) for sale in profiles[0]['sales']], [('0', 1000.0)])
+        self.assertIsNone(office_profile(self.session, 2))
+
+        self.session.close()
+        self.statements.clear()
+        agents = agent_profiles(self.session, [3, 1])
+        self.assertEqual([profile_dict(agent) for agent in agents], [profiles[0], profiles[2]])
+        self.assertEqual(len(self.statements), 3)
+
+        self.session.close()
+        self.statements.clear()
+        lazy = [profile_dict(agent) for agent in self.session.query(Offices).get(1).agents]
+        self.assertEqual(lazy, profiles)
+        self.assertGreater(len(self.statements), 12 * 2)
+
+class TestArchive(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.session.add(Offices(name='Scranton'))
+        self.session.add_all([Agents(office_id=1, first_name='Jim'), Agents(office_id=1, first_name='Dwight')])
+        self.session.add_all([Homes(address=str(number)) for number in range(8)])
+        self.session.add(Buyers(first_name='Toby'))
+        self.session.commit()
+        record_sales([{'home_id': home_id, 'agent_id': home_id % 2 + 1, 'buyer_id': 1, 'price_sold': 100000.0 * home_id, 'date_sold': date_sold}
+                      for home_id, date_sold in [(1, datetime.datetime(2020, 11, 5)), (2, datetime.datetime(2020, 12, 5)),
+                                                 (3, datetime.datetime(2020, 12, 20)), (4, datetime.datetime(2021, 1, 5)),
+                                                 (5, datetime.datetime(2021, 2, 5))]], bind=self.engine)
+
+    def test_archive_sales(self):
+        """
+        Closed months move to per-year archive tables, the summary tables keep them, reports
+        read them when asked for history, and sale IDs aren't reused.
+        """
+        leaderboard = top_agents(self.session, 202012).all()
+        self.assertEqual(archive_sales(before=202102, bind=self.engine), {202011: 1, 202012: 2, 202101: 1})
+        self.assertEqual([sale.sale_id for sale in self.session.query(Sales)], [5])
+        with self.engine.connect() as conn:
+            self.assertEqual(conn.execute(text('SELECT COUNT(*) FROM sales_archive_2020')).scalar(), 3)
+            self.assertEqual(conn.execute(text('SELECT COUNT(*) FROM sales_archive_2021')).scalar(), 1)
+        self.assertEqual(self.session.query(ArchivedMonths).get(202012).sale_volume, 500000.0)
+
+        self.assertIsNone(average_selling_price(self.session, 202012).scalar())
+        self.assertEqual(average_selling_price(self.session, 202012, history=True).scalar(), 250000.0)
+        self.assertEqual(report(self.session, 'all_selling_prices', month_period(2020, 11, 202012), history=True).count(), 3)
+        self.assertEqual(top_agents(self.session, 202012).all(), leaderboard)
+        rebuild_monthly_sales(bind=self.engine)
+        rebuild_commissions(bind=self.engine)
+        self.assertEqual(top_agents(self.session, 202012).all(), leaderboard)
+        self.assertEqual(check_monthly_sales(bind=self.engine), [])
+
+        # a sale recorded late for an archived month is archived by the next run
+        record_sales([(6, 1, 1, 600000.0), {'home_id': 7, 'agent_id': 1, 'buyer_id': 1, 'price_sold': 700000.0, 'date_sold': datetime.datetime(2020, 12, 31)}],
+                     bind=self.engine)
+        self.assertEqual(sorted(sale.sale_id for sale in self.session.query(Sales)), [5, 6, 7])
+        # the newest sale stays until a newer one is recorded
+        self.assertEqual(archive_sales(before=202103, bind=self.engine), {202102: 1})
+        transaction(8, 2, 1, 800000.0, bind=self.engine)
+        self.assertEqual(archive_sales(bind=self.engine), {202012: 1})
+        self.assertEqual(sorted(sale.sale_id for sale in self.session.query(Sales)), [6, 8])
+        self.session.expire_all()
+        self.assertEqual(self.session.query(ArchivedMonths).get(202012).sale_count, 3)
+        self.assertEqual(days_on_market(self.session, history=True).count(), 8)
+        self.assertEqual(check_monthly_sales(bind=self.engine), [])
+
+    def test_recompute_archived_commissions(self):
+        """
+        Re-pricing commissions after the tiers change re-prices archived sales too, and the ledger
+        and archived months' totals follow.
+        """
+        archive_sales(before=202102, bind=self.engine)
+        self.session.add(CommissionTiers(effective_from=datetime.datetime(2020,12,1), max_price=None, rate=0.01))
+        self.session.commit()
+        ledger = lambda: {month: amount for month, amount in self.session.query(Commission.month, func.sum(Commission.commission_amount)).group_by(Commission.month)}
+
+        self.assertEqual(recompute_commissions(since=date(2021,1,1), bind=self.engine), 2)
+        self.assertEqual(ledger(), {202011: 7500.0, 202012: 33000.0, 202101: 4000.0, 202102: 5000.0})
+        self.assertEqual(recompute_commissions(bind=self.engine), 5)
+        self.assertEqual(ledger(), {202011: 7500.0, 202012: 5000.0, 202101: 4000.0, 202102: 5000.0})
+        self.session.expire_all()
+        self.assertEqual({row.month: row.commission_amount for row in self.session.query(ArchivedMonths)}, {202011: 7500.0, 202012: 5000.0, 202101: 4000.0})
+
+class TestMarketStats(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.session.add_all([Offices(name='Scranton'), Offices(name='Stamford')])
+        self.session.add_all([Agents(office_id=1, first_name='Jim'), Agents(office_id=2, first_name='Karen')])
+        # homes listed on January 1st, sold 1 to 20 days later
+        self.session.add_all([Homes(address=str(number), zipcode='1850{}'.format(number % 2), date_listed=datetime.datetime(2022, 1, 1)) for number in range(1, 21)])
+        self.session.add(Buyers(first_name='Toby'))
+        self.session.commit()
+        record_sales([{'home_id': number, 'agent_id': number % 2 + 1, 'buyer_id': 1, 'price_sold': 100000.0,
+                       'date_sold': datetime.datetime(2022, 1, 1) + datetime.timedelta(days=number)} for number in range(1, 21)], bind=self.engine)
+
+    def test_days_on_market_stats(self):
+        """
+        Days on the market are stored as sales are recorded, and summarised by month, office and zipcode.
+        """
+        self.assertEqual([sale.days_on_market for sale in self.session.query(Sales).order_by(Sales.sale_id)], [float(days) for days in range(1, 21)])
+        self.assertEqual(average_days_on_market(self.session, 202201).scalar(), 10.5)
+
+        months = days_on_market_stats('month', bind=self.engine)
+        self.assertEqual(list(months), [202201])
+        january = months[202201]
+        self.assertEqual((january.count, january.mean()), (20, 10.5))
+        # exact, for whole days
+        self.assertAlmostEqual(january.median(), 10.5)
+        self.assertAlmostEqual(january.percentile(90), 18.1)
+        self.assertEqual((january.percentile(0), january.percentile(100)), (1.0, 20.0))
+        self.assertEqual(january.histogram(7), [(0, 6), (7, 7), (14, 7)])
+
+        offices = days_on_market_stats('office', period=202201, bind=self.engine)
+        self.assertEqual(offices['Scranton'].mean(), 11.0) # the even days
+        self.assertEqual(offices['Stamford'].mean(), 10.0)
+        zipcodes = days_on_market_stats('zipcode', bind=self.engine)
+        self.assertEqual(zipcodes['18500'].count, 10)
+        merged = DaysHistogram().merge(zipcodes['18500']).merge(zipcodes['18501'])
+        self.assertEqual(merged.as_dict(), january.as_dict())
+        self.assertEqual(days_on_market_stats('month', period=202202, bind=self.engine), {})
+        with self.assertRaises(ValueError):
+            days_on_market_stats('agent', bind=self.engine)
+
+        # sales stored without their days on the market are worked out from the dates, the same way everywhere
+        self.session.query(Sales).filter(Sales.sale_id > 10).update({'days_on_market': None})
+        self.session.commit()
+        self.assertEqual(average_days_on_market(self.session, 202201).scalar(), 10.5)
+        self.assertEqual(sorted(days for _, days in days_on_market(self.session, 202201)), [float(days) for days in range(1, 21)])
+        self.assertEqual(days_on_market_stats('month', bind=self.engine)[202201].as_dict(), january.as_dict())
+
+    def test_migrate_days_on_market(self):
+        """
+        Databases created before days on the market were stored get the column, in archived sales too,
+        filled in from the dates, and a fill interrupted part way carries on from its last chunk.
+        """
+        stored_days = lambda: self.engine.execute(text('SELECT days_on_market FROM sales_history ORDER BY sale_id')).scalars().all()
+        self.assertEqual(archive_sales(before=202202, bind=self.engine), {202201: 19})
+        with self.engine.begin() as conn:
+            conn.execute(text('DROP INDEX idx_sales_month_days'))
+            conn.execute(text('DROP VIEW sales_history'))
+            conn.execute(text('ALTER TABLE sales DROP COLUMN days_on_market'))
+            conn.execute(text('ALTER TABLE sales_archive_2022 DROP COLUMN days_on_market'))
+            conn.execute(text('CREATE INDEX idx_sales_month_home ON sales (month_sold, home_id, date_sold)'))
+        self.assertTrue(migrate_days_on_market(self.engine, chunk_size=7))
+        init_db(self.engine)
+        self.assertFalse(migrate_days_on_market(self.engine))
+        self.assertEqual(stored_days(), [float(days) for days in range(1, 21)])
+
+        # sales stored without their days once the fill has finished aren't looked for again
+        self.session.query(Sales).update({'days_on_market': None})
+        self.session.commit()
+        self.assertFalse(migrate_days_on_market(self.engine))
+
+        with self.engine.begin() as conn:
+            conn.execute(text('DROP VIEW sales_history'))
+            conn.execute(text('ALTER TABLE sales_archive_2022 DROP COLUMN days_on_market'))
+        filled_chunks = []
+        def interrupt(conn, tables, months=(), history=False):
+            filled_chunks.append(tables)
+            if len(filled_chunks) == 3:
+                raise RuntimeError('interrupted')
+        with mock.patch('create.bump_write_versions', side_effect=interrupt), self.assertRaises(RuntimeError):
+            migrate_days_on_market(self.engine, chunk_size=5)
+        self.assertEqual(self.session.query(Migrations.position).filter(Migrations.name == 'days_on_market sales_archive_2022').scalar(), 10)
+        self.assertTrue(migrate_days_on_market(self.engine, chunk_size=5))
+        self.assertFalse(migrate_days_on_market(self.engine))
+        self.assertEqual(stored_days(), [float(days) for days in range(1, 20)] + [None])
+        self.assertEqual(days_on_market_stats('month', bind=self.engine)[202201].count, 1)
+        self.assertEqual(days_on_market_stats('month', history=True, bind=self.engine)[202201].mean(), 10.5)
+        indexes = {index['name'] for index in inspect(self.engine).get_indexes('sales')}
+        self.assertIn('idx_sales_month_days', indexes)
+        self.assertNotIn('idx_sales_month_home', indexes)
 
 if __name__ == '__main__':
     unittest.main()